@@ -4,6 +4,8 @@ import json
 import requests
 import time
 
+from protocol import FRAMED_MAGIC, RECV_SIZE, FrameBuffer, encode_frame, is_chunk
+
 def ask_ai(prompt, model="qwen3:4b"):
     """
     Envia prompt para o Ollama e retorna a resposta da IA
@@ -157,14 +159,16 @@ class AIClient:
         ADDR (tuple): Endereco completo (IP, porta)
         FORMAT (str): Codificacao de caracteres (utf-8)
         client (socket): Socket de conexao com o servidor
+        framed (bool): Usa o protocolo enquadrado (cabecalho de tamanho)
     """
-    def __init__(self, server_ip=None, port=5050):
+    def __init__(self, server_ip=None, port=5050, framed=True):
         """
         Inicializa o cliente AI
         
         Args:
             server_ip (str, optional): IP do servidor. Se None, tenta descobrir automaticamente
             port (int): Porta do servidor (padrao: 5050)
+            framed (bool): Se True, negocia o protocolo enquadrado no handshake
         
         Raises:
             ConnectionError: Se nao conseguir encontrar ou conectar ao servidor
@@ -182,10 +186,14 @@ class AIClient:
         self.PORT = port
         self.ADDR = (self.SERVER_IP, self.PORT)
         self.FORMAT = 'utf-8'
+        self.framed = framed
         
         # Criar e conectar socket TCP
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.client.connect(self.ADDR)
+        if self.framed:
+            # Handshake: avisa o servidor que usaremos quadros
+            self.client.sendall(FRAMED_MAGIC)
         
         # Registrar como "ChatBot" no servidor
         self.send_name("ChatBot")
@@ -201,10 +209,14 @@ class AIClient:
         Processo:
             - Converte dicionario para JSON
             - Codifica em UTF-8
-            - Envia via socket
+            - Envia via socket (dentro de um quadro no modo enquadrado)
         """
         try:
-            self.client.send(json.dumps(message).encode(self.FORMAT))
+            payload = json.dumps(message).encode(self.FORMAT)
+            if self.framed:
+                self.client.sendall(encode_frame(payload))
+            else:
+                self.client.send(payload)
         except Exception as e:
             print(f"Erro ao enviar: {e}")
 
@@ -238,12 +250,11 @@ class AIClient:
         }
         self.send(message)
 
-    def handle_messages(self):
+    def process_server_message(self, msg):
         """
-        Thread principal para processar mensagens recebidas do servidor
+        Processa uma mensagem completa recebida do servidor
         
         Funcionalidades:
-            - Monitora mensagens em loop infinito
             - Detecta mensagens privadas no formato: [remetente -> destinatario]: mensagem
             - Responde apenas quando destinatario for "ChatBot"
             - Processa mensagem com IA e envia resposta
@@ -251,39 +262,62 @@ class AIClient:
         Formato esperado das mensagens privadas:
             "[NomeUsuario -> ChatBot]: Qual e a capital do Brasil?"
         """
+        print(f"DEBUG: Mensagem recebida: {msg}")
+        # Separar tipo da mensagem do conteudo
+        key, value = msg.split("=", 1)
+        if key == "msg":
+            # Detecta mensagens privadas no formato [remetente -> destinatario]: mensagem
+            if "[" in value and " -> " in value and "]:" in value:
+                # Extrai o remetente
+                sender = value[value.find("[")+1:value.find(" ->")]
+                
+                # Extrai o destinatário
+                start_dest = value.find(" -> ") + 4  # +4 para pular " -> "
+                end_dest = value.find("]:", start_dest)
+                destinatario = value[start_dest:end_dest].strip()
+                
+                print(f"DEBUG: destinatario extraído: '{destinatario}'")
+                
+                # Extrai a mensagem
+                message = value[value.find("]:")+2:].strip()
+                
+                # Exibe toda mensagem privada recebida
+                print(f"\n💬 Mensagem privada de {sender} para {destinatario}: {message}")
+
+                # Só responde se o destinatário for o próprio ChatBot
+                if destinatario == "ChatBot":
+                    print(f"🎯 Processando mensagem para ChatBot...")
+                    response = ask_ai(message)
+                    time.sleep(1)
+                    self.send_response(sender, response)
+
+    def handle_messages(self):
+        """
+        Thread principal para receber mensagens do servidor
+        
+        Funcionalidades:
+            - Monitora o socket em loop infinito
+            - No modo enquadrado, remonta quadros grudados ou quebrados
+              e processa cada mensagem completa
+            - No modo antigo, cada recv e tratado como uma mensagem
+        """
+        frame_buffer = FrameBuffer()
         while True:
             try:
-                # Receber mensagem do servidor
-                msg = self.client.recv(2048).decode(self.FORMAT)
-                print(f"DEBUG: Mensagem recebida: {msg}")
-                if msg:
-                    # Separar tipo da mensagem do conteudo
-                    key, value = msg.split("=", 1)
-                    if key == "msg":
-                        # Detecta mensagens privadas no formato [remetente -> destinatario]: mensagem
-                        if "[" in value and " -> " in value and "]:" in value:
-                            # Extrai o remetente
-                            sender = value[value.find("[")+1:value.find(" ->")]
-                            
-                            # Extrai o destinatário
-                            start_dest = value.find(" -> ") + 4  # +4 para pular " -> "
-                            end_dest = value.find("]:", start_dest)
-                            destinatario = value[start_dest:end_dest].strip()
-                            
-                            print(f"DEBUG: destinatario extraído: '{destinatario}'")
-                            
-                            # Extrai a mensagem
-                            message = value[value.find("]:")+2:].strip()
-                            
-                            # Exibe toda mensagem privada recebida
-                            print(f"\n💬 Mensagem privada de {sender} para {destinatario}: {message}")
-
-                            # Só responde se o destinatário for o próprio ChatBot
-                            if destinatario == "ChatBot":
-                                print(f"🎯 Processando mensagem para ChatBot...")
-                                response = ask_ai(message)
-                                time.sleep(1)
-                                self.send_response(sender, response)
+                if self.framed:
+                    data = self.client.recv(RECV_SIZE)
+                    if not data:
+                        print("❌ Conexão encerrada pelo servidor.")
+                        break
+                    for payload in frame_buffer.feed(data):
+                        if is_chunk(payload):
+                            continue # Pedacos de arquivo: o bot nao baixa arquivos
+                        self.process_server_message(payload.decode(self.FORMAT))
+                else:
+                    # Receber mensagem do servidor
+                    msg = self.client.recv(2048).decode(self.FORMAT)
+                    if msg:
+                        self.process_server_message(msg)
                                 
             except Exception as e:
                 print(f"❌ Erro ao receber mensagem: {e}")
@@ -0,0 +1,165 @@
+#asynclog.py
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from collections import deque
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {value: name for name, value in LEVELS.items()}
+
+class AsyncLog:
+    """
+    Log do servidor sem bloquear quem registra
+
+    Funcionalidades:
+        - Cada linha vira um registro (horario, nivel, tag, texto) numa fila
+          limitada em memoria; uma thread escritora esvazia a fila em lotes
+          (uma escrita por lote). Terminal lento ou journal travado atrasam
+          so a escritora
+        - Fila cheia: a linha e descartada e contada (dropped); a escritora
+          avisa quantas linhas perdeu. Quem registra nunca espera
+        - Niveis (debug/info/warning/error): abaixo do nivel, a chamada
+          retorna antes de montar qualquer texto
+        - sample=True (linhas por mensagem/conexao): so 1 a cada `sample`
+          linhas de cada tag e registrada
+        - Texto com argumentos (texto.format(*args)) so e montado na
+          escritora; os argumentos devem ser valores imutaveis (str, int...)
+        - Formato "text" ("[Tag] texto", como os prints) ou "json" (uma linha
+          JSON por registro, com ts e level)
+
+    O processo do modo --workers faz fork: antes dele a fila e esvaziada, e o
+    filho comeca com fila e escritora proprias.
+    """
+    def __init__(self, level=INFO, max_lines=10000, sample=1, fmt="text", stream=None):
+        self.level = level
+        self.max_lines = max_lines
+        self.sample = sample
+        self.fmt = fmt
+        self.stream = stream
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self._reported_drops = 0
+        self._seen = {} # tag -> linhas com sample=True ate agora
+        self._reset()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(before=self.flush, after_in_child=self._reset)
+        atexit.register(self.flush)
+
+    def _reset(self):
+        self._queue = deque()
+        self._wake = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._drop_lock = threading.Lock()
+        self._thread = None
+
+    def configure(self, level=None, max_lines=None, sample=None, fmt=None):
+        if level is not None:
+            self.level = level
+        if max_lines is not None:
+            self.max_lines = max_lines
+        if sample is not None:
+            self.sample = max(1, sample)
+        if fmt is not None:
+            self.fmt = fmt
+
+    def enabled(self, level):
+        """
+        Para linhas caras de montar (ex.: estatisticas): so calcular se sairem
+        """
+        return level >= self.level
+
+    def log(self, level, tag, text, *args, sample=False):
+        if level < self.level:
+            return
+        if sample and self.sample > 1:
+            seen = self._seen[tag] = self._seen.get(tag, 0) + 1
+            if seen % self.sample != 1:
+                self.sampled_out += 1
+                return
+        if len(self._queue) >= self.max_lines:
+            with self._drop_lock:
+                self.dropped += 1
+            return
+        self._queue.append((time.time(), level, tag, text, args))
+        if self._thread is None:
+            self._start()
+        if not self._wake.is_set():
+            self._idle.clear()
+            self._wake.set()
+
+    def debug(self, tag, text, *args, sample=False):
+        self.log(DEBUG, tag, text, *args, sample=sample)
+
+    def info(self, tag, text, *args, sample=False):
+        self.log(INFO, tag, text, *args, sample=sample)
+
+    def warning(self, tag, text, *args, sample=False):
+        self.log(WARNING, tag, text, *args, sample=sample)
+
+    def error(self, tag, text, *args):
+        self.log(ERROR, tag, text, *args)
+
+    def _start(self):
+        with self._drop_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._writer, daemon=True)
+                self._thread.start()
+
+    def _format(self, record):
+        ts, level, tag, text, args = record
+        try:
+            text = text.format(*args) if args else text
+        except Exception as e: # Argumento inesperado (ex.: conteudo que nao e texto) nao derruba a escritora
+            text = f"{text} {args} (formato invalido: {e})"
+        if self.fmt == "json":
+            return json.dumps({"ts": round(ts, 6), "level": LEVEL_NAMES.get(level, level), "tag": tag, "msg": text},
+                              ensure_ascii=False)
+        return f"[{tag}] {text}" if tag else text
+
+    def _writer(self):
+        queue = self._queue
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            lines = []
+            while queue:
+                lines.append(self._format(queue.popleft()))
+            dropped = self.dropped
+            if dropped != self._reported_drops:
+                lines.append(self._format((time.time(), WARNING, "Log", "{} linhas descartadas (fila cheia)",
+                                           (dropped - self._reported_drops,))))
+                self._reported_drops = dropped
+            if lines:
+                stream = self.stream or sys.stdout
+                try:
+                    stream.write("\n".join(lines) + "\n")
+                    stream.flush()
+                except (OSError, ValueError):
+                    pass # Saida fechada: as linhas se perdem, o servidor continua
+                self.written += len(lines)
+            if not queue:
+                self._idle.set()
+
+    def flush(self, timeout=2):
+        """
+        Espera a escritora esvaziar a fila (antes de fork e ao encerrar)
+        """
+        if self._thread is not None and self._thread.is_alive():
+            self._idle.wait(timeout)
+
+    def stats(self):
+        return {
+            "queued": len(self._queue),
+            "written": self.written,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out
+        }
+
+logger = AsyncLog() # Log compartilhado pelos modulos do servidor (configurado em server.py)
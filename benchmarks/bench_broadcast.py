@@ -0,0 +1,86 @@
+#benchmarks/bench_broadcast.py
+
+import os
+import sys
+import time
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import server
+
+# Mede o custo por destinatario de um broadcast, sem rede:
+# - "por destinatario": formata + codifica + enquadra a mensagem para cada
+#   destinatario (como era feito antes, via send_message_to_user)
+# - "uma vez": send_message_to_all, que serializa uma unica vez e entrega os
+#   mesmos bytes a todos
+# Os destinatarios sao registros falsos cujo writer apenas guarda a referencia.
+#
+# Uso: python benchmarks/bench_broadcast.py --recipients 200
+
+def make_recipients(count):
+    """
+    Registra `count` conexoes falsas (modo enquadrado) no servidor
+    """
+    sinks = []
+    for i in range(count):
+        sink = []
+        client_connection = server.new_connection(None, ("127.0.0.1", 10000 + i), writer=lambda data, is_file=False, s=sink: s.append(data))
+        client_connection["conn"] = f"fake-{i}" # Apenas uma chave unica para o registro
+        client_connection["framed"] = True
+        client_connection["name"] = f"user{i}"
+        server.connections.register(client_connection)
+        sinks.append(sink)
+    return sinks
+
+def per_recipient(sender, message):
+    # Caminho antigo: cada destinatario paga formatacao + encode + quadro
+    for conn in server.connections.snapshot():
+        if conn["conn"] != sender["conn"]:
+            server.send_message_to_user(sender, conn, message)
+
+def encode_once(sender, message):
+    server.send_message_to_all(sender, message)
+
+def serialize_only(sender, message):
+    # Custo fixo do caminho "uma vez": formatar, codificar e enquadrar
+    server.EncodedMessage(server.format_message(message)).frame()
+
+def measure(fn, sender, message, sinks, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(sender, message)
+        best = min(best, time.perf_counter() - started)
+        for sink in sinks:
+            sink.clear()
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark: custo por destinatario do broadcast")
+    parser.add_argument("--recipients", type=int, default=200)
+    parser.add_argument("--sizes", default="1K,64K,1M,5M", help="Tamanhos do payload (K/M)")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    sinks = make_recipients(args.recipients)
+    sender = {"conn": "sender", "name": "bench"}
+
+    print(f"{'payload':>8} {'por destinatario (us/dest)':>28} {'uma vez (us/dest)':>20} "
+          f"{'serializacao (ms)':>18} {'marginal (us/dest)':>19} {'ganho':>8}")
+    for size_text in args.sizes.split(","):
+        unit = {"K": 1024, "M": 1024 * 1024}.get(size_text[-1].upper(), 1)
+        size = int(size_text.rstrip("KkMm")) * unit
+        message = {"sender": "bench", "destination": "4all", "type": "file",
+                   "content": "A" * size, "filename": "bench.bin"}
+        old = measure(per_recipient, sender, message, sinks, args.repeat)
+        new = measure(encode_once, sender, message, sinks, args.repeat)
+        fixed = measure(serialize_only, sender, message, sinks, args.repeat)
+        # Marginal: o que cada destinatario adiciona alem da serializacao unica
+        marginal = max(new - fixed, 0.0) / args.recipients * 1e6
+        print(f"{size_text:>8} {old / args.recipients * 1e6:>28.2f} {new / args.recipients * 1e6:>20.2f} "
+              f"{fixed * 1e3:>18.2f} {marginal:>19.2f} {old / new:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#benchmarks/bench_envelope.py
+
+import os
+import sys
+import json
+import time
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from protocol import (FORMAT, ALL_USERS, encode_envelope, decode_envelope,
+                      encode_client_message, decode_client_message)
+
+# Compara, por mensagem de chat, o JSON/texto com o envelope binario (protocol.py):
+# - cliente -> servidor: serializar (json.dumps) e interpretar (json.loads)
+# - servidor -> cliente: montar o "seq=N||msg=[remetente -> destino]: conteudo"
+#   e separar os campos de volta no cliente
+# Mede tempo por mensagem e bytes no fio, para conteudos curtos e longos.
+#
+# Uso: python benchmarks/bench_envelope.py --messages 200000
+
+def per_message(function, items, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for item in items:
+            function(item)
+        elapsed = (time.perf_counter() - started) / len(items)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def text_payload(message):
+    # Como server.py: format_message + numeracao do diario
+    destination = "todos" if message["destination"] == "4all" else message["destination"]
+    return f"seq={message['seq']}||msg=[{message['sender']} -> {destination}]: {message['content']}".encode(FORMAT)
+
+def parse_text(payload):
+    # Como o cliente: tipo, seq e depois remetente/destino/conteudo
+    key, value = payload.decode(FORMAT).split("=", 1)
+    seq, value = value.split("||", 1)
+    _, value = value.split("=", 1)
+    header, content = value.split("]: ", 1)
+    sender, destination = header[1:].split(" -> ", 1)
+    return int(seq), sender, destination, content
+
+def parse_envelope(payload, names):
+    _, sender, destination, seq, control, body = decode_envelope(payload)
+    destination = "todos" if destination == ALL_USERS else names.get(destination, control)
+    return seq, names[sender], destination, body.decode(FORMAT)
+
+def run(label, content, args):
+    users = [f"usuario{i}" for i in range(100)]
+    ids = {name: number for number, name in enumerate(users, 1)}
+    names = {number: name for name, number in ids.items()}
+    client_messages = [{"type": "msg", "control": "4all" if i % 3 else users[i % 100], "message": content}
+                       for i in range(args.messages)]
+    chat = [{"sender": users[i % 100], "destination": "4all" if i % 3 else users[(i + 1) % 100],
+             "content": content, "seq": i + 1} for i in range(args.messages)]
+
+    json_payloads = [json.dumps(message).encode(FORMAT) for message in client_messages]
+    envelope_payloads = [encode_client_message(message, ids) for message in client_messages]
+    text_payloads = [text_payload(message) for message in chat]
+    server_envelopes = [encode_envelope("msg", message["content"].encode(FORMAT), "", ids[message["sender"]],
+                                        ALL_USERS if message["destination"] == "4all" else ids[message["destination"]],
+                                        message["seq"]) for message in chat]
+
+    rows = [
+        ("cliente: serializar",
+         per_message(lambda message: json.dumps(message).encode(FORMAT), client_messages, args.repeat),
+         per_message(lambda message: encode_client_message(message, ids), client_messages, args.repeat),
+         json_payloads, envelope_payloads),
+        ("servidor: interpretar",
+         per_message(lambda payload: json.loads(payload.decode(FORMAT)), json_payloads, args.repeat),
+         per_message(lambda payload: decode_client_message(payload, names.get), envelope_payloads, args.repeat),
+         json_payloads, envelope_payloads),
+        ("servidor: montar",
+         per_message(text_payload, chat, args.repeat),
+         per_message(lambda message: encode_envelope(
+             "msg", message["content"].encode(FORMAT), "", ids[message["sender"]],
+             ALL_USERS if message["destination"] == "4all" else ids[message["destination"]], message["seq"]),
+             chat, args.repeat),
+         text_payloads, server_envelopes),
+        ("cliente: interpretar",
+         per_message(parse_text, text_payloads, args.repeat),
+         per_message(lambda payload: parse_envelope(payload, names), server_envelopes, args.repeat),
+         text_payloads, server_envelopes),
+    ]
+    assert [parse_text(payload) for payload in text_payloads[:100]] == \
+           [parse_envelope(payload, names) for payload in server_envelopes[:100]]
+
+    print(f"\nconteudo {label} ({len(content.encode(FORMAT))} bytes)")
+    print(f"{'etapa':>22} {'texto (us)':>11} {'envelope (us)':>14} {'ganho':>7} {'bytes texto':>12} {'bytes envelope':>15}")
+    for name, text_time, envelope_time, text_list, envelope_list in rows:
+        text_bytes = sum(map(len, text_list)) / len(text_list)
+        envelope_bytes = sum(map(len, envelope_list)) / len(envelope_list)
+        print(f"{name:>22} {text_time * 1e6:>11.3f} {envelope_time * 1e6:>14.3f} "
+              f"{(1 - envelope_time / text_time) * 100:>6.0f}% {text_bytes:>12.1f} {envelope_bytes:>15.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark: envelope binario x JSON/texto")
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=3, help="Repeticoes (vale a melhor)")
+    args = parser.parse_args()
+
+    run("curto", "oi, tudo bem?", args)
+    run("com acentos", "Reunião às 15h na sala de conferência; não esqueçam o relatório.", args)
+    run("longo", "mensagem \"longa\" com aspas e quebra\nde linha " * 40, args)
+
+if __name__ == "__main__":
+    main()
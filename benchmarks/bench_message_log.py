@@ -0,0 +1,77 @@
+#benchmarks/bench_message_log.py
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from messagelog import MessageLog, FSYNC_POLICIES
+
+# Mede a vazao de gravacao do log de mensagens em cada politica de fsync
+# (always: fsync por mensagem | batch: a cada N mensagens | interval: thread
+# periodica | never: o sistema operacional decide) e o tempo de reinicio:
+# reabrir o log e recarregar as ultimas mensagens, como o servidor faz.
+#
+# Uso: python benchmarks/bench_message_log.py --messages 20000 --size 200
+# (--dir aponta para o disco a medir; o padrao e o diretorio temporario)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def bench_policy(directory, policy, args):
+    record = {"type": "msg", "sender": "bench", "destination": "4all", "content": "x" * args.size}
+    log = MessageLog(directory, policy, batch_size=args.batch, interval=args.interval)
+    latencies = []
+    started = time.perf_counter()
+    for message_id in range(1, args.messages + 1):
+        before = time.perf_counter()
+        log.append(message_id, record)
+        latencies.append(time.perf_counter() - before)
+    elapsed = time.perf_counter() - started
+    fsyncs = log.stats()["fsyncs"]
+    log.close()
+
+    # Reinicio: reabrir (recuperacao do fim do log) + recarregar o historico recente
+    started = time.perf_counter()
+    log = MessageLog(directory, policy)
+    recent = log.tail(args.restore)
+    restart = time.perf_counter() - started
+    assert len(recent) == min(args.restore, args.messages) and log.last_id == args.messages
+    # Pagina antiga lida do disco pelo indice esparso
+    started = time.perf_counter()
+    page = log.read_before(args.messages // 2, 50)
+    seek = time.perf_counter() - started
+    assert len(page) == 50
+    log.close()
+    return args.messages / elapsed, percentile(latencies, 0.99), fsyncs, restart, seek
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark: log de mensagens por politica de fsync")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--size", type=int, default=200, help="Bytes de conteudo por mensagem")
+    parser.add_argument("--batch", type=int, default=64, help="Mensagens por fsync na politica batch")
+    parser.add_argument("--interval", type=float, default=1.0, help="Segundos entre fsyncs na politica interval")
+    parser.add_argument("--restore", type=int, default=1000, help="Mensagens recarregadas no reinicio")
+    parser.add_argument("--policies", default=",".join(FSYNC_POLICIES))
+    parser.add_argument("--dir", default=None, help="Onde criar os logs de teste")
+    args = parser.parse_args()
+
+    print(f"{'politica':>10} {'msgs/s':>10} {'p99 append (us)':>16} {'fsyncs':>8} "
+          f"{'reinicio (ms)':>14} {'pagina antiga (ms)':>19}")
+    for policy in args.policies.split(","):
+        directory = tempfile.mkdtemp(prefix=f"bench_log_{policy}_", dir=args.dir)
+        try:
+            rate, p99, fsyncs, restart, seek = bench_policy(directory, policy, args)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        print(f"{policy:>10} {rate:>10.0f} {p99 * 1e6:>16.1f} {fsyncs:>8} "
+              f"{restart * 1e3:>14.2f} {seek * 1e3:>19.2f}")
+
+if __name__ == "__main__":
+    main()
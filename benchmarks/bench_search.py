@@ -0,0 +1,98 @@
+#benchmarks/bench_search.py
+
+import os
+import sys
+import time
+import random
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from search import SearchIndex
+
+# Mede o indice de busca (search.py): tempo para indexar N mensagens (como
+# os historicos fazem a cada append) e latencia das consultas com o indice
+# cheio: palavra comum, palavra rara, varias palavras, remetente, periodo,
+# nome de arquivo e paginas seguintes.
+#
+# Uso: python benchmarks/bench_search.py --messages 1000000 --queries 200
+# (vocabulario com distribuicao de Zipf: poucas palavras muito comuns, muitas raras)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def build(args, rng):
+    vocabulary = [f"w{i}" for i in range(args.vocabulary)]
+    weights = [1 / (rank + 1) for rank in range(args.vocabulary)]
+    users = [f"user{i}" for i in range(args.users)]
+    index = SearchIndex(args.messages + 1)
+    start_ts = time.time() - args.messages # Uma mensagem por segundo
+    words = rng.choices(vocabulary, weights, k=args.messages * args.words)
+    started = time.perf_counter()
+    for number in range(args.messages):
+        sender = users[number % args.users]
+        ts = start_ts + number
+        if number % 50 == 0:
+            message = {"id": number + 1, "type": "file", "sender": sender, "destination": "all",
+                       "filename": f"relatorio_{number // 50 % 1000}.pdf", "ts": ts}
+        else:
+            content = " ".join(words[number * args.words:(number + 1) * args.words])
+            message = {"id": number + 1, "type": "msg", "sender": sender, "destination": "all", "content": content, "ts": ts}
+        if number % 10 == 5:
+            # Privada entre dois usuarios
+            message["destination"] = users[(number + 1) % args.users]
+            index.add(message, private=True)
+        else:
+            index.add(message)
+    return index, time.perf_counter() - started, vocabulary, users, start_ts
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark: indice de busca de mensagens")
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--words", type=int, default=8, help="Palavras por mensagem")
+    parser.add_argument("--vocabulary", type=int, default=50000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=200, help="Consultas por tipo")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    index, elapsed, vocabulary, users, start_ts = build(args, rng)
+    stats = index.stats()
+    print(f"indexadas {args.messages} mensagens em {elapsed:.1f} s ({args.messages / elapsed:.0f} msgs/s, "
+          f"{elapsed / args.messages * 1e6:.1f} us cada); {stats['terms']} termos, {stats['postings']} entradas")
+
+    span = args.messages
+    cases = {
+        "palavra comum": lambda: {"words": vocabulary[rng.randrange(5)]},
+        "palavra rara": lambda: {"words": vocabulary[rng.randrange(args.vocabulary // 2, args.vocabulary)]},
+        "3 palavras": lambda: {"words": " ".join(rng.sample(vocabulary[:200], 3))},
+        "remetente": lambda: {"sender": rng.choice(users)},
+        "remetente + palavra": lambda: {"sender": rng.choice(users), "words": vocabulary[rng.randrange(50)]},
+        "periodo (1 h)": lambda: (lambda t: {"since": t, "until": t + 3600})(start_ts + rng.randrange(span)),
+        "periodo + palavra": lambda: (lambda t: {"since": t, "until": t + 86400,
+                                                 "words": vocabulary[rng.randrange(100, 1000)]})(start_ts + rng.randrange(span)),
+        "nome de arquivo": lambda: {"filename": f"relatorio_{rng.randrange(1000)}"},
+        "sem resultado": lambda: {"words": "w1 inexistente"},
+    }
+    print(f"{'consulta':>22} {'p50 (ms)':>9} {'p99 (ms)':>9} {'max (ms)':>9} {'resultados':>11}")
+    for label, make in cases.items():
+        latencies, total = [], 0
+        for _ in range(args.queries):
+            query = make()
+            name = rng.choice(users)
+            before = time.perf_counter()
+            results, cursor = index.search(name, query.get("words", ""), query.get("sender"), query.get("filename"),
+                                           query.get("since"), query.get("until"))
+            if cursor:
+                results, cursor = index.search(name, query.get("words", ""), query.get("sender"), query.get("filename"),
+                                               query.get("since"), query.get("until"), cursor) # Pagina seguinte
+            latencies.append(time.perf_counter() - before)
+            total += len(results)
+        print(f"{label:>22} {percentile(latencies, 0.5) * 1e3:>9.3f} {percentile(latencies, 0.99) * 1e3:>9.3f} "
+              f"{max(latencies) * 1e3:>9.3f} {total / args.queries:>11.1f}")
+
+if __name__ == "__main__":
+    main()
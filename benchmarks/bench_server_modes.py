@@ -0,0 +1,177 @@
+#benchmarks/bench_server_modes.py
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from protocol import FRAMED_MAGIC, RECV_SIZE, FrameBuffer, encode_frame
+
+# Compara o servidor no modo thread (uma thread por conexao) com o modo
+# eventloop (selectors, uma unica thread):
+# - N conexoes ociosas registradas (custo de memoria/threads por usuario)
+# - K clientes ativos enviando M mensagens globais cada
+# - Um ouvinte mede quanto tempo leva para receber todas as mensagens
+# Com --workers N, cada modo roda em N processos (SO_REUSEPORT + barramento);
+# memoria e threads passam a ser a soma dos processos.
+#
+# Uso: python benchmarks/bench_server_modes.py --idle 2000 --active 10 --messages 200
+#      python benchmarks/bench_server_modes.py --workers 4 --active 40
+
+def proc_status(pid):
+    """
+    Le memoria residente (KB) e numero de threads do processo em /proc (Linux)
+    Retorna (rss_kb, threads) ou (None, None) se indisponivel
+    """
+    try:
+        rss, threads = None, None
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1])
+                elif line.startswith("Threads:"):
+                    threads = int(line.split()[1])
+        return rss, threads
+    except OSError:
+        return None, None
+
+def tree_status(pid):
+    """
+    proc_status somado ao dos processos filhos (workers do modo multiprocesso)
+    """
+    rss, threads = proc_status(pid)
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        children = []
+    for child in children:
+        child_rss, child_threads = proc_status(child)
+        if rss is not None and child_rss is not None:
+            rss += child_rss
+            threads += child_threads
+    return rss, threads
+
+def connect(port, name):
+    """
+    Abre uma conexao no modo enquadrado e registra o nome
+    """
+    sock = socket.create_connection(("127.0.0.1", port))
+    payload = json.dumps({"type": "name", "control": "dontcare", "message": name}).encode()
+    sock.sendall(FRAMED_MAGIC + encode_frame(payload))
+    return sock
+
+def wait_for_server(port, timeout=10):
+    """
+    Aguarda o servidor aceitar conexoes na porta
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("Servidor nao respondeu")
+
+def run_mode(mode, port, idle, active, messages, workers=1):
+    """
+    Executa o cenario completo contra um servidor novo no modo informado
+    """
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, "server.py"), "--mode", mode, "--port", str(port),
+                                "--workers", str(workers), "--log-dir", "",
+                                "--msg-rate", "0", "--max-connections", "0"], # Rajadas de mensagens de proposito
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    sockets = []
+    try:
+        wait_for_server(port)
+        time.sleep(0.5 if workers > 1 else 0) # Todos os workers escutando
+        base_rss, base_threads = tree_status(process.pid)
+
+        # Fase 1: conexoes ociosas
+        started = time.perf_counter()
+        for i in range(idle):
+            sockets.append(connect(port, f"idle{i}"))
+        connect_time = time.perf_counter() - started
+        time.sleep(1) # Dar tempo para o servidor processar os registros
+        idle_rss, idle_threads = tree_status(process.pid)
+
+        # Fase 2: ouvinte + clientes ativos
+        listener = connect(port, "listener")
+        senders = [connect(port, f"sender{i}") for i in range(active)]
+        sockets.extend(senders)
+        time.sleep(0.5)
+        listener.settimeout(0.5)
+        try:
+            while listener.recv(RECV_SIZE):
+                pass # Descartar boas-vindas
+        except socket.timeout:
+            pass
+
+        expected = active * messages
+        frame = lambda i: encode_frame(json.dumps({"type": "msg", "control": "4all", "message": f"bench {i}"}).encode())
+        started = time.perf_counter()
+        for sender in senders:
+            sender.sendall(b"".join(frame(i) for i in range(messages))) # Pipelining: um sendall por cliente
+
+        frame_buffer = FrameBuffer()
+        received = 0
+        listener.settimeout(30)
+        while received < expected:
+            try:
+                data = listener.recv(RECV_SIZE)
+            except socket.timeout:
+                break
+            if not data:
+                break
+            received += len(frame_buffer.feed(data))
+        elapsed = time.perf_counter() - started
+        listener.close()
+
+        return {
+            "mode": mode if workers == 1 else f"{mode}x{workers}",
+            "idle": idle,
+            "connect_s": connect_time,
+            "rss_base_kb": base_rss,
+            "rss_idle_kb": idle_rss,
+            "threads": idle_threads,
+            "delivered": received,
+            "expected": expected,
+            "elapsed_s": elapsed,
+            "msgs_per_s": received / elapsed if elapsed else 0.0,
+        }
+    finally:
+        for sock in sockets:
+            sock.close()
+        process.terminate()
+        process.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark: modo thread x modo eventloop")
+    parser.add_argument("--idle", type=int, default=1000, help="Conexoes ociosas")
+    parser.add_argument("--active", type=int, default=10, help="Clientes enviando mensagens")
+    parser.add_argument("--messages", type=int, default=200, help="Mensagens por cliente ativo")
+    parser.add_argument("--port", type=int, default=5150)
+    parser.add_argument("--modes", default="thread,eventloop")
+    parser.add_argument("--workers", type=int, default=1, help="Processos do servidor (SO_REUSEPORT)")
+    args = parser.parse_args()
+
+    results = []
+    for offset, mode in enumerate(args.modes.split(",")):
+        results.append(run_mode(mode, args.port + offset, args.idle, args.active, args.messages, args.workers))
+
+    print(f"{'modo':<12} {'conexoes':>8} {'conectar(s)':>11} {'RSS(MB)':>8} {'KB/conn':>8} {'threads':>7} {'entregues':>11} {'msg/s':>9}")
+    for r in results:
+        rss_mb = r["rss_idle_kb"] / 1024 if r["rss_idle_kb"] else float("nan")
+        per_conn = (r["rss_idle_kb"] - r["rss_base_kb"]) / r["idle"] if r["rss_idle_kb"] and r["idle"] else float("nan")
+        print(f"{r['mode']:<12} {r['idle']:>8} {r['connect_s']:>11.2f} {rss_mb:>8.1f} {per_conn:>8.1f} "
+              f"{str(r['threads']):>7} {r['delivered']:>5}/{r['expected']:<5} {r['msgs_per_s']:>9.0f}")
+
+if __name__ == "__main__":
+    main()
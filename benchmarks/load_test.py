@@ -0,0 +1,410 @@
+#benchmarks/load_test.py
+
+import os
+import sys
+import json
+import time
+import base64
+import random
+import socket
+import argparse
+import selectors
+import subprocess
+import multiprocessing
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from protocol import FRAMED_MAGIC, RECV_SIZE, FrameBuffer, FrameError, encode_frame
+from bench_server_modes import wait_for_server
+
+# Teste de carga: milhares de clientes sinteticos falando o protocolo do chat
+# (modo enquadrado) contra um server.py ja rodando ou iniciado aqui (--spawn).
+#
+# - Cada cliente registra um nome (latencia "name": conexao -> boas-vindas)
+# - Depois que todos entraram, as operacoes sao disparadas em ritmo fixo
+#   (--rate por segundo, no total) durante --duration segundos, sorteadas
+#   pela mistura --mix: msg (global), private, file (base64, privado) e
+#   online_usr
+# - Mensagens e arquivos levam o horario do envio: a latencia de entrega e
+#   medida em cada destinatario (uma amostra por destinatario); online_usr
+#   mede ida e volta
+# - Os clientes sao divididos entre --processes processos (um loop de
+#   selectors cada), para o gerador nao ser o gargalo
+#
+# O resultado (vazao, p50/p99/p999 por operacao, entregas esperadas x
+# recebidas e erros) pode ser gravado em JSON (--json) com o commit atual,
+# para comparar execucoes.
+#
+# Uso: python benchmarks/load_test.py --spawn eventloop --clients 2000 --rate 2000 --duration 20
+#      python benchmarks/load_test.py --port 5050 --clients 500 --mix msg=50,private=50 --json result.json
+
+OPS = ("msg", "private", "file", "online_usr")
+DEFAULT_MIX = "msg=60,private=30,online_usr=5,file=5"
+MARKER = "lt|"              # Inicio do conteudo das mensagens do teste: lt|operacao|horario|
+MAX_OUTBUF = 4 * 1024 * 1024 # Servidor que nao le: a operacao e descartada e contada como erro
+
+def parse_mix(text):
+    """
+    "msg=60,private=30" -> {"msg": 60, "private": 30}
+    """
+    mix = {}
+    for part in text.split(","):
+        op, _, weight = part.partition("=")
+        if op not in OPS:
+            raise argparse.ArgumentTypeError(f"operação desconhecida: {op} (válidas: {', '.join(OPS)})")
+        mix[op] = float(weight or 1)
+    return mix
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+class Samples:
+    """
+    Amostras de latencia com limite de memoria (amostragem por reservatorio)
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.values = []
+        self.seen = 0
+
+    def add(self, value):
+        self.seen += 1
+        if len(self.values) < self.limit:
+            self.values.append(value)
+        else:
+            index = random.randrange(self.seen)
+            if index < self.limit:
+                self.values[index] = value
+
+def new_stats(limit):
+    return {
+        "sent": {op: 0 for op in OPS},
+        "delivered": {op: 0 for op in OPS},
+        "samples": {op: Samples(limit) for op in OPS + ("name",)},
+        "errors": {},
+        "connected": 0,
+        "welcomed": 0
+    }
+
+def count_error(stats, kind):
+    stats["errors"][kind] = stats["errors"].get(kind, 0) + 1
+
+def send(selector, client, data, stats):
+    """
+    Envia sem bloquear; o que nao sair agora fica no buffer do cliente
+    """
+    if len(client["outbuf"]) > MAX_OUTBUF:
+        count_error(stats, "backpressure")
+        return False
+    client["outbuf"] += data
+    flush(selector, client, stats)
+    return True
+
+def flush(selector, client, stats):
+    try:
+        sent = client["sock"].send(client["outbuf"])
+    except (BlockingIOError, InterruptedError):
+        sent = 0
+    except OSError:
+        drop(selector, client, stats, "send_failed")
+        return
+    del client["outbuf"][:sent]
+    events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client["outbuf"] else 0)
+    if events != client["events"]:
+        client["events"] = events
+        selector.modify(client["sock"], events, client)
+
+def drop(selector, client, stats, reason):
+    if client["closed"]:
+        return
+    client["closed"] = True
+    count_error(stats, reason)
+    selector.unregister(client["sock"])
+    client["sock"].close()
+
+def handle_payload(client, payload, stats, started):
+    now = time.time()
+    text = payload.decode("utf-8", "replace")
+    if text.startswith("msg="):
+        position = text.find("]: " + MARKER)
+        if position != -1:
+            op, sent_at = text[position + 3:].split("|", 3)[1:3]
+            if float(sent_at) >= started: # Mensagens antigas (historico ao entrar) nao contam
+                stats["delivered"][op] += 1
+                stats["samples"][op].add(now - float(sent_at))
+        elif "[Servidor]: ❌" in text:
+            count_error(stats, "server_error")
+        elif not client["welcomed"] and "Bem-vindo" in text:
+            client["welcomed"] = True
+            stats["welcomed"] += 1
+            stats["samples"]["name"].add(now - client["connected_at"])
+    elif text.startswith("file="):
+        filename = text.split("||", 2)[1]
+        if filename.startswith(MARKER):
+            sent_at = float(filename.split("|")[2])
+            if sent_at >= started:
+                stats["delivered"]["file"] += 1
+                stats["samples"]["file"].add(now - sent_at)
+    elif text.startswith("online_users=") and client["online_pending"]:
+        sent_at = client["online_pending"].pop(0)
+        stats["delivered"]["online_usr"] += 1
+        stats["samples"]["online_usr"].add(now - sent_at)
+
+def pump(selector, timeout, stats, started):
+    for key, events in selector.select(timeout):
+        client = key.data
+        if events & selectors.EVENT_WRITE:
+            flush(selector, client, stats)
+        if client["closed"] or not events & selectors.EVENT_READ:
+            continue
+        try:
+            data = client["sock"].recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            continue
+        except OSError:
+            drop(selector, client, stats, "recv_failed")
+            continue
+        if not data:
+            drop(selector, client, stats, "disconnected")
+            continue
+        try:
+            for payload in client["frames"].feed(data):
+                handle_payload(client, payload, stats, started)
+        except (FrameError, ValueError, IndexError):
+            drop(selector, client, stats, "bad_frame")
+
+def operation_frame(op, sender, names, file_data):
+    sent_at = f"{time.time():.6f}"
+    if op == "msg":
+        message = {"type": "msg", "control": "4all", "message": f"{MARKER}msg|{sent_at}|{sender['padding']}"}
+    elif op == "online_usr":
+        sender["online_pending"].append(float(sent_at))
+        message = {"type": "online_usr", "control": "dontcare", "message": ""}
+    else:
+        destination = random.choice(names)
+        while destination == sender["name"] and len(names) > 1:
+            destination = random.choice(names)
+        if op == "private":
+            message = {"type": "msg", "control": destination, "message": f"{MARKER}private|{sent_at}|{sender['padding']}"}
+        else:
+            message = {"type": "file", "control": destination, "filename": f"{MARKER}file|{sent_at}|.bin", "message": file_data}
+    return encode_frame(json.dumps(message).encode())
+
+def run_clients(index, args, names, barrier, results):
+    """
+    Corpo de um processo gerador: conecta os seus clientes, espera os demais
+    processos (barrier) e dispara a sua parte das operacoes
+    """
+    random.seed(args.seed + index)
+    selector = selectors.DefaultSelector()
+    stats = new_stats(args.max_samples)
+    mine = names[index::args.processes]
+    padding = "x" * max(0, args.size - 40)
+    file_data = base64.b64encode(os.urandom(args.file_size)).decode()
+    clients = []
+    for name in mine:
+        try:
+            sock = socket.create_connection((args.host, args.port), timeout=10)
+        except OSError:
+            count_error(stats, "connect_failed")
+            continue
+        sock.setblocking(False)
+        client = {"sock": sock, "name": name, "frames": FrameBuffer(), "outbuf": bytearray(), "closed": False,
+                  "welcomed": False, "connected_at": time.time(), "online_pending": [], "padding": padding,
+                  "events": selectors.EVENT_READ}
+        selector.register(sock, selectors.EVENT_READ, client)
+        stats["connected"] += 1
+        clients.append(client)
+        hello = json.dumps({"type": "name", "control": "dontcare", "message": name}).encode()
+        send(selector, client, FRAMED_MAGIC + encode_frame(hello), stats)
+        if args.connect_rate:
+            time.sleep(1 / args.connect_rate * args.processes)
+        pump(selector, 0, stats, float("inf"))
+
+    deadline = time.time() + args.join_timeout
+    while time.time() < deadline and any(not c["welcomed"] and not c["closed"] for c in clients):
+        pump(selector, 0.05, stats, float("inf"))
+    barrier.wait()
+
+    ops = list(args.mix)
+    weights = [args.mix[op] for op in ops]
+    rate = args.rate / args.processes
+    started = time.time()
+    end = started + args.duration
+    issued = 0
+    active = [c for c in clients if c["welcomed"]]
+    while active and time.time() < end:
+        due = int((time.time() - started) * rate) - issued
+        for op in random.choices(ops, weights, k=max(0, due)):
+            sender = random.choice(active)
+            if not sender["closed"] and send(selector, sender, operation_frame(op, sender, names, file_data), stats):
+                stats["sent"][op] += 1
+            issued += 1
+        pump(selector, min(0.01, 1 / rate if rate else 0.01), stats, started)
+    elapsed = time.time() - started
+
+    drain_end = time.time() + args.drain
+    while time.time() < drain_end:
+        pump(selector, 0.05, stats, started)
+    for client in clients:
+        if not client["closed"]:
+            client["sock"].close()
+
+    stats["elapsed_s"] = elapsed
+    stats["samples"] = {op: samples.values for op, samples in stats["samples"].items()}
+    results.put(stats)
+
+def merge(all_stats):
+    total = new_stats(0)
+    total["samples"] = {op: [] for op in OPS + ("name",)}
+    total["elapsed_s"] = max(stats["elapsed_s"] for stats in all_stats)
+    for stats in all_stats:
+        for op in OPS:
+            total["sent"][op] += stats["sent"][op]
+            total["delivered"][op] += stats["delivered"][op]
+        for op, values in stats["samples"].items():
+            total["samples"][op].extend(values)
+        for kind, amount in stats["errors"].items():
+            total["errors"][kind] = total["errors"].get(kind, 0) + amount
+        total["connected"] += stats["connected"]
+        total["welcomed"] += stats["welcomed"]
+    return total
+
+def summarize(total, args):
+    """
+    Resultado final (o mesmo que vai para o JSON)
+    """
+    expected = {
+        "msg": total["sent"]["msg"] * max(0, total["welcomed"] - 1), # Todos menos o remetente
+        "private": total["sent"]["private"],
+        "file": total["sent"]["file"],
+        "online_usr": total["sent"]["online_usr"]
+    }
+    elapsed = total["elapsed_s"] or 1.0
+    ops = {}
+    for op in OPS + ("name",):
+        values = total["samples"][op]
+        ops[op] = {
+            "sent": total["sent"].get(op, total["connected"]),
+            "delivered": total["delivered"].get(op, total["welcomed"]),
+            "expected": expected.get(op, total["connected"]),
+            "p50_ms": percentile(values, 0.50) * 1000,
+            "p99_ms": percentile(values, 0.99) * 1000,
+            "p999_ms": percentile(values, 0.999) * 1000,
+            "max_ms": max(values) * 1000 if values else 0.0
+        }
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "args": {key: value for key, value in vars(args).items() if key != "mix"} | {"mix": args.mix},
+        "clients": args.clients,
+        "connected": total["connected"],
+        "joined": total["welcomed"],
+        "duration_s": elapsed,
+        "ops_per_s": sum(total["sent"].values()) / elapsed,
+        "deliveries_per_s": sum(total["delivered"].values()) / elapsed,
+        "ops": ops,
+        "errors": total["errors"]
+    }
+
+def fetch_server_metrics(port):
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics.json", timeout=5) as response:
+            return json.loads(response.read())
+    except (OSError, ValueError):
+        return None
+
+def print_report(result):
+    print(f"\ncommit {result['commit']} | {result['joined']}/{result['clients']} clientes | "
+          f"{result['duration_s']:.1f}s | {result['ops_per_s']:.0f} ops/s | {result['deliveries_per_s']:.0f} entregas/s")
+    print(f"{'operacao':<11} {'enviadas':>9} {'entregues/esperadas':>21} {'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8} {'max ms':>8}")
+    for op, entry in result["ops"].items():
+        if not entry["sent"]:
+            continue
+        print(f"{op:<11} {entry['sent']:>9} {entry['delivered']:>10}/{entry['expected']:<10} "
+              f"{entry['p50_ms']:>8.2f} {entry['p99_ms']:>8.2f} {entry['p999_ms']:>8.2f} {entry['max_ms']:>8.2f}")
+    print(f"erros: {result['errors'] or 'nenhum'}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga do servidor do chat")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--spawn", choices=["thread", "eventloop"], default=None,
+                        help="Inicia um server.py neste modo (senao usa o que ja esta rodando)")
+    parser.add_argument("--workers", type=int, default=1, help="Processos do servidor iniciado com --spawn")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Endpoint de metricas do servidor, incluido no resultado")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--processes", type=int, default=max(1, min(4, (os.cpu_count() or 2) // 2)),
+                        help="Processos geradores de carga")
+    parser.add_argument("--rate", type=float, default=1000, help="Operacoes por segundo (total)")
+    parser.add_argument("--duration", type=float, default=10, help="Segundos de carga")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"Pesos das operacoes (padrao: {DEFAULT_MIX})")
+    parser.add_argument("--size", type=int, default=100, help="Bytes por mensagem de texto")
+    parser.add_argument("--file-size", type=int, default=16 * 1024, help="Bytes por arquivo")
+    parser.add_argument("--connect-rate", type=float, default=0, help="Conexoes por segundo (0 = sem limite)")
+    parser.add_argument("--join-timeout", type=float, default=60, help="Espera maxima pelos registros")
+    parser.add_argument("--drain", type=float, default=2, help="Segundos recebendo depois da carga")
+    parser.add_argument("--max-samples", type=int, default=200000, help="Amostras de latencia por operacao e processo")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", default=None, help="Grava o resultado neste arquivo ('-' = saida padrao)")
+    args = parser.parse_args()
+
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard)) # Milhares de sockets
+    except (ImportError, ValueError, OSError):
+        pass
+
+    process = None
+    if args.spawn:
+        command = [sys.executable, os.path.join(ROOT, "server.py"), "--mode", args.spawn, "--port", str(args.port),
+                   "--workers", str(args.workers), "--log-dir", "",
+                   "--msg-rate", "0", "--file-rate-mb", "0", "--max-connections", "0"] # Mede o servidor, nao os limites
+        if args.metrics_port:
+            command += ["--metrics-port", str(args.metrics_port)]
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_for_server(args.port)
+        time.sleep(0.5 if args.workers > 1 else 0) # Todos os workers escutando
+
+    run_id = f"{random.randrange(16 ** 4):04x}" # Nomes novos a cada execucao
+    names = [f"lt{run_id}_{i}" for i in range(args.clients)]
+    context = multiprocessing.get_context("fork") if hasattr(os, "fork") else multiprocessing.get_context()
+    barrier = context.Barrier(args.processes)
+    results = context.Queue()
+    workers = [context.Process(target=run_clients, args=(index, args, names, barrier, results))
+               for index in range(args.processes)]
+    try:
+        for worker in workers:
+            worker.start()
+        timeout = args.join_timeout + args.duration + args.drain + 60 # Processo gerador que morreu nao trava o teste
+        all_stats = [results.get(timeout=timeout) for _ in workers]
+        for worker in workers:
+            worker.join()
+        result = summarize(merge(all_stats), args)
+        if args.metrics_port:
+            result["server"] = fetch_server_metrics(args.metrics_port)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    print_report(result)
+    if args.json == "-":
+        print(json.dumps(result, indent=1))
+    elif args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=1)
+        print(f"Resultado gravado em {args.json}")
+
+if __name__ == "__main__":
+    main()
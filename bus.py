@@ -0,0 +1,190 @@
+#bus.py
+
+import json
+import queue
+import selectors
+import threading
+
+from asynclog import logger
+from protocol import RECV_SIZE, FORMAT, FrameBuffer, FrameError, encode_frame
+
+# BARRAMENTO ENTRE WORKERS (modo multiprocesso, ver server.py --workers):
+#
+# Cada worker tem um socket Unix (socketpair) ligado ao processo principal,
+# que roda o BusHub. Os eventos sao JSON em quadros (protocol.py):
+#
+#   {"op": "join", "name", "worker", "addr", "framed"}  usuario entrou num worker
+#   {"op": "leave", "name", "worker"}                  usuario saiu
+#   {"op": "name_taken", "name"}                       hub -> worker: nome ja existe em outro worker
+#   {"op": "global", "message", "worker", "delivered"} mensagem global (todos os workers)
+#   {"op": "private", "message"}                       mensagem privada (so o worker do destinatario)
+#   {"op": "private_log", "message"}                   copia para o worker 0, que grava o historico privado
+#   {"op": "room", "message", "worker"}                mensagem de sala (todos os workers, cada um entrega aos seus membros)
+#
+# O hub processa os eventos um a um e repassa cada global a todos os workers,
+# inclusive a quem publicou: todos veem as mensagens globais na mesma ordem,
+# entao os ids do historico coincidem entre workers.
+
+PERSIST_WORKER = 0 # Worker que grava o log de mensagens (historico persistente)
+
+class BusHub:
+    """
+    Ponto central do barramento (roda no processo principal)
+
+    Funcionalidades:
+        - Repassa eventos globais e de presenca a todos os workers, com o
+          quadro serializado uma unica vez
+        - Entrega mensagens privadas apenas ao worker do destinatario
+        - Dono de cada nome: um "join" com nome ja usado em outro worker e
+          recusado (name_taken) em vez de repassado
+        - Worker que cai tem os usuarios removidos (leave) para os demais
+
+    serve_forever() retorna quando todos os workers encerraram.
+    """
+    def __init__(self, sockets):
+        self.sockets = dict(sockets) # id do worker -> socket
+        self.buffers = {worker_id: FrameBuffer() for worker_id in self.sockets}
+        self.owners = {} # nome -> id do worker onde o usuario esta conectado
+        self.selector = selectors.DefaultSelector()
+        for worker_id, sock in self.sockets.items():
+            self.selector.register(sock, selectors.EVENT_READ, worker_id)
+        self.events = 0
+
+    def serve_forever(self):
+        while self.sockets:
+            for key, _ in self.selector.select():
+                worker_id = key.data
+                try:
+                    data = key.fileobj.recv(RECV_SIZE)
+                except OSError:
+                    data = b""
+                if not data:
+                    self.drop_worker(worker_id)
+                    continue
+                try:
+                    for payload in self.buffers[worker_id].feed(data):
+                        self.handle(worker_id, payload)
+                except (FrameError, ValueError) as e:
+                    logger.warning("Bus", f"Evento inválido do worker {worker_id}: {e}")
+                    self.drop_worker(worker_id)
+
+    def handle(self, worker_id, payload):
+        event = json.loads(payload.decode(FORMAT))
+        self.events += 1
+        op = event.get("op")
+        if op == "join":
+            owner = self.owners.get(event["name"])
+            if owner is not None and owner != worker_id:
+                self.send(worker_id, encode_frame(json.dumps({"op": "name_taken", "name": event["name"]}).encode(FORMAT)))
+                return
+            self.owners[event["name"]] = worker_id
+        elif op == "leave":
+            if self.owners.get(event["name"]) != worker_id:
+                return
+            del self.owners[event["name"]]
+        elif op == "private":
+            owner = self.owners.get(event["message"]["destination"])
+            if owner is not None:
+                self.send(owner, encode_frame(payload))
+            return
+        elif op == "private_log":
+            self.send(PERSIST_WORKER, encode_frame(payload))
+            return
+        self.broadcast(encode_frame(payload))
+
+    def broadcast(self, frame):
+        for worker_id in list(self.sockets):
+            self.send(worker_id, frame)
+
+    def send(self, worker_id, frame):
+        sock = self.sockets.get(worker_id)
+        if sock is None:
+            return
+        try:
+            sock.sendall(frame)
+        except OSError:
+            self.drop_worker(worker_id)
+
+    def drop_worker(self, worker_id):
+        sock = self.sockets.pop(worker_id, None)
+        if sock is None:
+            return
+        logger.info("Bus", f"Worker {worker_id} desconectado do barramento")
+        self.selector.unregister(sock)
+        sock.close()
+        for name in [name for name, owner in self.owners.items() if owner == worker_id]:
+            del self.owners[name]
+            self.broadcast(encode_frame(json.dumps({"op": "leave", "name": name, "worker": worker_id}).encode(FORMAT)))
+
+class WorkerBus:
+    """
+    Ponta do barramento dentro de um worker
+
+    Funcionalidades:
+        - publish(): envia um evento ao hub (thread-safe); o envio sai por
+          uma thread escritora propria, entao quem publica (inclusive o loop
+          de eventos) nunca trava esperando o hub, e o hub nunca fica
+          bloqueado enviando para um worker que esta travado publicando
+        - read(): le os eventos disponiveis e chama handler(evento) para cada
+          um; no modo thread roda em run() numa thread propria, no modo
+          event-loop o socket entra no selector (ver EventLoopServer.add_reader)
+        - remote_users: usuarios conectados nos outros workers (presenca),
+          mantidos a partir dos eventos join/leave
+    """
+    def __init__(self, sock, worker_id, handler=None):
+        self.sock = sock
+        self.worker_id = worker_id
+        self.handler = handler
+        self.remote_users = {} # nome -> {"worker", "addr", "framed"}
+        self._outbox = queue.Queue() # Quadros a caminho do hub, em ordem
+        self._buffer = FrameBuffer()
+        threading.Thread(target=self._writer, daemon=True).start()
+
+    def publish(self, event):
+        self._outbox.put(encode_frame(json.dumps(event).encode(FORMAT)))
+
+    def _writer(self):
+        while True:
+            frame = self._outbox.get()
+            try:
+                self.sock.sendall(frame)
+            except OSError as e:
+                logger.warning("Bus", f"Falha ao publicar no barramento: {e}")
+                return
+
+    def read(self):
+        """
+        Processa o que chegou do hub (uma leitura)
+        Retorna False se o barramento foi fechado
+        """
+        data = self.sock.recv(RECV_SIZE)
+        if not data:
+            return False
+        for payload in self._buffer.feed(data):
+            event = json.loads(payload.decode(FORMAT))
+            self._track(event)
+            if self.handler is not None:
+                self.handler(event)
+        return True
+
+    def _track(self, event):
+        # Presenca dos outros workers; os proprios usuarios ficam no ConnectionRegistry
+        if event.get("worker") == self.worker_id:
+            return
+        if event["op"] == "join":
+            self.remote_users[event["name"]] = {"worker": event["worker"], "addr": event.get("addr", ""),
+                                                "framed": event.get("framed", True)}
+        elif event["op"] == "leave":
+            self.remote_users.pop(event["name"], None)
+
+    def run(self):
+        """
+        Loop de leitura do modo thread
+        """
+        try:
+            while self.read():
+                pass
+        except (OSError, FrameError, ValueError) as e:
+            logger.info("Bus", f"Barramento encerrado: {e}")
+            return
+        logger.info("Bus", "Barramento encerrado pelo processo principal")
@@ -8,6 +8,13 @@ import json
 import sys
 import platform
 import time
+import itertools
+import hashlib
+
+from protocol import (FRAMED_MAGIC, RECV_SIZE, CHUNK_SIZE, FrameBuffer, encode_frame, encode_frames,
+                      encode_chunk_header, is_chunk, decode_chunk, chunk_crc,
+                      Compressor, CODECS, SUPPORTED_CODECS, is_compressed, decompress_payload,
+                      ENVELOPE_VERSION, ALL_USERS, is_envelope, decode_envelope, encode_client_message)
 
 def discover_server(timeout=5):
     """
@@ -46,9 +53,13 @@ SERVER_IP = discover_server() # Descobre servidor automaticamente
 PORT = 5050
 ADDR = (SERVER_IP, PORT)
 FORMAT = 'utf-8'
+USE_FRAMING = True # Protocolo enquadrado (False = modo antigo, sem cabecalho de tamanho)
+RECONNECT_DELAYS = (0.5, 1, 2, 4, 8, 15, 30) # Espera antes de cada tentativa de reconexao (segundos)
 
 client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 client.connect(ADDR)
+if USE_FRAMING:
+    client.sendall(FRAMED_MAGIC) # Handshake: avisa o servidor que usaremos quadros
 
 # Controles de estado para evitar conflitos de entrada
 input_lock = threading.Lock() # Mutex para input thread-safe
@@ -56,6 +67,25 @@ waiting_for_file_decision = False # Flag para processar arquivo pendente
 pending_file_data = None # Dados do arquivo aguardando decisao
 name_registered = False  # Controle para saber se o nome foi aceito
 waiting_for_name = False  # Controle para reenvio de nome
+history_cursor = 0  # Cursor da pagina anterior do historico (0 = nao ha mais)
+room_cursors = {}  # sala -> cursor da pagina anterior do historico da sala
+requested_files = {}  # (remetente, arquivo) -> id pedido ao servidor via file_get: salvar direto ao chegar
+send_lock = threading.Lock() # Um pedaco de arquivo (cabecalho + sendfile) nao pode ser intercalado
+upload_ids = itertools.count(1) # Ids dos nossos envios de arquivo em pedacos
+uploads = {}  # id do envio -> {"event", "accepted", "reason"} (respostas do servidor)
+incoming_files = {} # id da transferencia -> arquivo sendo recebido em pedacos
+compressor = None # Compressor do codec aceito pelo servidor (None = sem compressao)
+user_name = None # Nome enviado ao servidor (para nao aparecer na propria lista de usuarios)
+presence_users = None # nome -> endereco, mantido pelos deltas de presenca (None = sem assinatura)
+presence_version = 0 # Versao da presenca recebida por ultimo
+session_token = None # Token da sessao retomavel (None = sem sessao: conexao caiu, chat acabou)
+last_seq = 0 # Ultima mensagem numerada recebida (o servidor reenvia as seguintes ao reconectar)
+search_query = None # Ultima busca enviada (para pedir a proxima pagina)
+search_cursor = 0 # Cursor da proxima pagina da busca (0 = nao ha mais)
+search_files = {} # id -> (remetente, arquivo) dos arquivos nos resultados da busca
+use_envelope = False # Envelope binario aceito pelo servidor (mensagens simples vao sem JSON)
+envelope_names = {} # id -> nome dos usuarios anunciados pelo servidor (envelope "user")
+envelope_ids = {} # nome -> id (destinatario das nossas mensagens no envelope)
 
 def safe_input(prompt):
     """
@@ -94,88 +124,586 @@ def display_online_users(users_data):
     except Exception as e:
         print(f"❌ Erro inesperado ao exibir usuários: {e}")
 
-def handle_messages():
+def display_rooms(rooms_data):
+    """
+    Exibe a lista de salas recebida do servidor
+    """
+    try:
+        rooms = json.loads(rooms_data)
+    except json.JSONDecodeError as e:
+        print(f"❌ Erro ao processar lista de salas: {e}")
+        return
+    print("\n" + "="*50)
+    print("🏠 SALAS")
+    print("="*50)
+    for room in rooms:
+        mark = "✅" if room.get("joined") else "  "
+        print(f"{mark} {room['name']:<24} | 👥 {room['members']}")
+    print("="*50)
+
+def display_search_results(results_data):
+    """
+    Exibe uma pagina de resultados da busca (da mais nova para a mais antiga)
     """
-    Thread dedicada para receber e processar mensagens do servidor
-    Roda continuamente em background processando:
+    global search_cursor
+    try:
+        data = json.loads(results_data)
+    except json.JSONDecodeError as e:
+        print(f"❌ Erro ao processar resultados da busca: {e}")
+        return
+    search_cursor = data.get("cursor", 0)
+    print("\n" + "="*50)
+    print("🔍 RESULTADOS DA BUSCA")
+    print("="*50)
+    if not data["results"]:
+        print("Nenhuma mensagem encontrada.")
+    for result in data["results"]:
+        when = time.strftime("%d/%m %H:%M", time.localtime(result["ts"]))
+        destination = "todos" if result["destination"] in ("all", "4all") else result["destination"]
+        if result["type"] == "file":
+            file_id = f" (id {result['id']})" if result.get("id") else ""
+            if result.get("id"):
+                search_files[result["id"]] = (result["sender"], result["filename"])
+            print(f"[{when}] {result['sender']} -> {destination}: 📎 {result['filename']}{file_id}")
+        else:
+            print(f"[{when}] {result['sender']} -> {destination}: {result['content']}")
+    print("="*50)
+    if search_cursor:
+        print("Há mais resultados: busque 'mais' para a próxima página.")
+    if search_files:
+        print("Arquivos: busque 'baixar <id>' para baixar.")
+
+def process_server_message(msg):
+    """
+    Processa uma mensagem completa recebida do servidor:
     - msg: mensagens de texto
     - online_users: lista de usuarios online
     - file: arquivos recebidos
+    - file_ref: arquivo grande do historico (baixado sob demanda)
+    - history_cursor: cursor para pedir mensagens mais antigas
+    - room_cursor/rooms: cursor do historico de uma sala e lista de salas
+    - file_begin/file_end/file_abort: arquivo recebido em pedacos
+    - file_accept/file_reject/file_exists/file_done: respostas aos nossos envios
+    - compression: codec escolhido pelo servidor para comprimir as mensagens
+    - presence/presence_delta: lista de usuarios online e suas mudancas
+    - ping: heartbeat do servidor, respondido com pong
+    - seq: mensagem numerada (sessao retomavel), o numero e guardado
+    - session/resumed/resume_failed: sessao criada, retomada ou perdida
+    - envelope: o servidor aceitou o envelope binario
     """
-    global waiting_for_file_decision, pending_file_data, name_registered, waiting_for_name
+    global waiting_for_file_decision, pending_file_data, name_registered, waiting_for_name, history_cursor, compressor
+    global presence_users, presence_version, session_token, last_seq, use_envelope
+
+    key, value = msg.split("=", 1) # Separar tipo da mensagem do conteudo
     
+    if key == "seq":
+        # Formato: N||mensagem
+        seq, inner = value.split("||", 1)
+        last_seq = max(last_seq, int(seq))
+        process_server_message(inner)
+
+    elif key == "session":
+        # Formato: token||ultimo seq ja enviado pelo servidor
+        session_token, seq = value.split("||", 1)
+        last_seq = int(seq)
+
+    elif key == "resumed":
+        if value == "history":
+            print("\n🔄 Reconectado! Muitas mensagens perdidas: segue o histórico recente.")
+        else:
+            print(f"\n🔄 Reconectado! {value} mensagens perdidas.")
+        if presence_users is not None:
+            presence_users = None
+            send({"type": "presence", "control": "dontcare", "message": "subscribe"})
+
+    elif key == "resume_failed":
+        # Sessao expirou no servidor: entrar de novo com o mesmo nome
+        print(f"\n⚠️  Não foi possível retomar a sessão ({value}). Entrando de novo como {user_name}...")
+        session_token = None
+        send(name_message(user_name))
+
+    elif key == "ping":
+        # Conexao ociosa: o servidor confere se ainda estamos aqui
+        send({"type": "pong", "control": "dontcare", "message": value})
+
+    elif key == "msg":
+        # Verificar se e mensagem do servidor sobre nome duplicado
+        if "[Servidor]:" in value and "já está sendo usado" in value:
+            waiting_for_name = True
+            name_registered = False
+            print(f"\n💬 {value}")
+        elif "[Servidor]:" in value and "Bem-vindo ao chat" in value:
+            name_registered = True
+            waiting_for_name = False
+            print(f"\n💬 {value}")
+            if USE_FRAMING:
+                # Lista de usuarios mantida pelo servidor: sem pedir (e esperar) a cada consulta
+                send({"type": "presence", "control": "dontcare", "message": "subscribe"})
+        elif "[Servidor]:" in value and "Digite um novo nome:" in value:
+            print(f"\n💬 {value}")
+            # Nao fazer nada aqui, deixar o loop principal tratar
+        else:
+            print(f"\n💬 {value}")
+        
+    elif key == "online_users":
+        # Trata a resposta da lista de usuários online
+        display_online_users(value)
+
+    elif key == "presence":
+        snapshot = json.loads(value)
+        presence_users = {user["name"]: user["addr"] for user in snapshot["users"]}
+        presence_version = snapshot["version"]
+
+    elif key == "presence_delta":
+        delta = json.loads(value)
+        if presence_users is None or delta["version"] <= presence_version:
+            return # Anterior ao snapshot
+        if delta["version"] != presence_version + 1:
+            # Perdemos uma mudanca (fila cheia no servidor): pedir a lista de novo
+            presence_users = None
+            send({"type": "presence", "control": "dontcare", "message": "subscribe"})
+            return
+        presence_version = delta["version"]
+        if delta["op"] == "join":
+            presence_users[delta["name"]] = delta.get("addr", "")
+        else:
+            presence_users.pop(delta["name"], None)
+        
+    elif key == "file":
+        # Formato: remetente||nome_arquivo||dados_base64
+        parts = value.split("||", 2)
+        if len(parts) == 3:
+            sender, filename, b64data = parts
+            file_size = (len(b64data) * 3) // 4  # Tamanho aproximado em bytes
+
+            if (sender, filename) in requested_files:
+                # Arquivo do historico que o usuario ja pediu para baixar
+                requested_files.pop((sender, filename), None)
+                print(f"\n📎 Arquivo '{filename}' de {sender} recebido.")
+                save_file(filename, b64data)
+                return
+            
+            # Armazenar dados do arquivo pendente
+            pending_file_data = {
+                'sender': sender,
+                'filename': filename,
+                'b64data': b64data,
+                'file_size': file_size
+            }
+            
+            # Marcar que estamos aguardando decisao sobre arquivo
+            waiting_for_file_decision = True
+            
+            print(f"\n" + "="*50)
+            print(f"📎 ARQUIVO RECEBIDO")
+            print(f"👤 De: {sender}")
+            print(f"📄 Arquivo: {filename}")
+            print(f"📊 Tamanho: {file_size/1024:.1f}KB")
+            print("="*50)
+            print("O que deseja fazer?")
+            print("1. 💾 Baixar arquivo")
+            print("2. ❌ Ignorar")
+            print("-"*30)
+            
+            # Nao capturar input aqui - sera tratado no menu principal
+            
+        else:
+            # Compatibilidade com formato antigo
+            try:
+                filename, b64data = value.split("||", 1)
+                print(f"\n📎 [Arquivo recebido - formato antigo]: {filename}")
+                with open("recebido_" + filename, "wb") as f:
+                    f.write(base64.b64decode(b64data))
+                print(f"✅ Salvo como: recebido_{filename}")
+            except:
+                print("❌ Erro ao processar arquivo (formato incompatível)")
+
+    elif key == "file_ref":
+        # Formato: remetente||nome_arquivo||id||tamanho||sha256
+        parts = value.split("||")
+        sender, filename, file_id, file_size = parts[:4]
+        pending_file_data = {
+            'sender': sender,
+            'filename': filename,
+            'file_id': file_id,
+            'file_size': int(file_size),
+            'sha256': parts[4] if len(parts) > 4 else ""
+        }
+        waiting_for_file_decision = True
+
+        print(f"\n" + "="*50)
+        print(f"📎 ARQUIVO NO HISTÓRICO")
+        print(f"👤 De: {sender}")
+        print(f"📄 Arquivo: {filename}")
+        print(f"📊 Tamanho: {int(file_size)/1024:.1f}KB")
+        print("="*50)
+        print("O que deseja fazer?")
+        print("1. 💾 Baixar arquivo")
+        print("2. ❌ Ignorar")
+        print("-"*30)
+
+    elif key == "history_cursor":
+        history_cursor = int(value)
+
+    elif key == "room_cursor":
+        room, cursor = value.rsplit("||", 1)
+        room_cursors[room] = int(cursor)
+
+    elif key == "rooms":
+        display_rooms(value)
+
+    elif key == "search":
+        display_search_results(value)
+
+    elif key == "file_begin":
+        # Formato: remetente||nome_arquivo||id||tamanho||sha256||offset
+        sender, filename, transfer_id, file_size, digest, offset = value.split("||", 5)
+        begin_incoming_file(int(transfer_id), sender, filename, int(file_size), digest, int(offset))
+
+    elif key == "file_end":
+        finish_incoming_file(int(value))
+
+    elif key == "file_abort":
+        transfer_id, reason = value.split("||", 1)
+        incoming = incoming_files.pop(int(transfer_id), None)
+        if incoming:
+            incoming["file"].close()
+            if not incoming["sha256"]:
+                os.remove(incoming["part"]) # Sem hash nao ha como retomar depois
+            print(f"\n❌ Recebimento de '{incoming['filename']}' cancelado: {reason}")
+
+    elif key == "file_accept":
+        # Formato: id_envio||id_transferencia||offset (offset > 0: envio retomado)
+        handle, _, offset = value.split("||", 2)
+        upload = uploads.get(int(handle))
+        if upload:
+            upload["accepted"] = True
+            upload["offset"] = int(offset)
+            upload["event"].set()
+
+    elif key == "file_reject":
+        # Formato: id_envio||motivo (antes ou durante o envio)
+        handle, reason = value.split("||", 1)
+        upload = uploads.get(int(handle))
+        if upload:
+            upload["accepted"] = False
+            upload["reason"] = reason
+            upload["event"].set()
+
+    elif key == "file_ack":
+        # Formato: id_envio||bytes confirmados pelo servidor
+        handle, offset = value.split("||", 1)
+        upload = uploads.get(int(handle))
+        if upload:
+            upload["acked"] = int(offset)
+
+    elif key == "file_retry":
+        # Pedaco corrompido no caminho: reenviar a partir do offset
+        handle, offset = value.split("||", 1)
+        upload = uploads.get(int(handle))
+        if upload:
+            upload["retry"] = int(offset)
+            upload["event"].set()
+
+    elif key == "file_exists":
+        # O servidor ja tem o conteudo: nada a enviar
+        upload = uploads.pop(int(value), None)
+        if upload:
+            upload["exists"] = True
+            upload["event"].set()
+
+    elif key == "file_done":
+        upload = uploads.get(int(value))
+        if upload:
+            upload["done"] = True
+            upload["event"].set()
+
+    elif key == "compression":
+        if value in CODECS:
+            compressor = Compressor(value)
+
+    elif key == "envelope":
+        use_envelope = value == ENVELOPE_VERSION
+
+def part_path_for(transfer_id, filename, digest):
+    """
+    Arquivo parcial (.part) de um recebimento em downloads
+    Com sha256 o nome depende so do conteudo: um download interrompido
+    pode ser retomado depois, mesmo em outra execucao do cliente
+    """
+    os.makedirs("downloads", exist_ok=True)
+    if digest:
+        return os.path.join("downloads", f".{digest}.part")
+    return os.path.join("downloads", f".{transfer_id}_{os.path.basename(filename)}.part")
+
+def resume_offset(digest):
+    """
+    Quantos bytes de um arquivo ja temos (pedacos inteiros e conferidos)
+    """
+    if not digest:
+        return 0
+    part_path = part_path_for(0, "", digest)
+    if not os.path.exists(part_path):
+        return 0
+    return os.path.getsize(part_path) // CHUNK_SIZE * CHUNK_SIZE
+
+def begin_incoming_file(transfer_id, sender, filename, file_size, digest="", offset=0):
+    """
+    Inicio de um arquivo recebido em pedacos: os dados vao direto para um
+    arquivo parcial (.part) em downloads, sem acumular em memoria
+    - offset > 0: download retomado, continua o .part existente
+    """
+    part_path = part_path_for(transfer_id, filename, digest)
+    if offset and os.path.exists(part_path):
+        part = open(part_path, "r+b")
+        part.truncate(offset)
+        part.seek(offset)
+    else:
+        part = open(part_path, "wb")
+        offset = 0
+    incoming_files[transfer_id] = {
+        "sender": sender,
+        "filename": filename,
+        "size": file_size,
+        "sha256": digest,
+        "received": offset,
+        "corrupt": None, # Offset do primeiro pedaco que falhou no CRC
+        "part": part_path,
+        "file": part
+    }
+    if offset:
+        print(f"\n📎 Retomando '{filename}' de {sender} em {offset/1024:.1f}KB de {file_size/1024:.1f}KB...")
+    elif (sender, filename) not in requested_files:
+        print(f"\n📎 Recebendo '{filename}' de {sender} ({file_size/1024:.1f}KB)...")
+
+def receive_file_chunk(payload):
+    """
+    Grava um pedaco binario no arquivo parcial da transferencia
+    Pedacos que falham no CRC32 (ou fora de ordem) interrompem a gravacao:
+    o .part fica apenas com a parte conferida, pronta para retomar
+    """
+    transfer_id, offset, crc, data = decode_chunk(payload)
+    incoming = incoming_files.get(transfer_id)
+    if incoming is None or incoming["corrupt"] is not None:
+        return
+    if offset != incoming["received"] or chunk_crc(data) != crc:
+        incoming["corrupt"] = incoming["received"]
+        return
+    incoming["file"].write(data)
+    incoming["received"] = offset + len(data)
+
+def finish_incoming_file(transfer_id):
+    """
+    Fim de um arquivo recebido em pedacos
+    - Pedido via file_get: salvo direto em downloads
+    - Caso contrario: pergunta ao usuario se quer manter o arquivo
+    """
+    global waiting_for_file_decision, pending_file_data
+
+    incoming = incoming_files.pop(transfer_id, None)
+    if incoming is None:
+        return
+    incoming["file"].close()
+    sender, filename = incoming["sender"], incoming["filename"]
+
+    if incoming["corrupt"] is not None:
+        file_id = requested_files.get((sender, filename))
+        if file_id is not None and incoming["sha256"]:
+            # Download do historico: pedir de novo a partir da parte conferida
+            print(f"\n⚠️  '{filename}' chegou corrompido em {incoming['corrupt']/1024:.1f}KB, retomando...")
+            send({"type": "file_get", "control": "dontcare", "message": file_id,
+                  "offset": resume_offset(incoming["sha256"])})
+        else:
+            print(f"\n❌ '{filename}' de {sender} chegou corrompido; baixe novamente pelo histórico.")
+        return
+
+    if (sender, filename) in requested_files:
+        requested_files.pop((sender, filename), None)
+        print(f"\n📎 Arquivo '{filename}' de {sender} recebido.")
+        keep_part_file(incoming["part"], filename)
+        return
+
+    pending_file_data = {
+        'sender': sender,
+        'filename': filename,
+        'part': incoming["part"],
+        'file_size': incoming["size"]
+    }
+    waiting_for_file_decision = True
+
+    print(f"\n" + "="*50)
+    print(f"📎 ARQUIVO RECEBIDO")
+    print(f"👤 De: {sender}")
+    print(f"📄 Arquivo: {filename}")
+    print(f"📊 Tamanho: {incoming['size']/1024:.1f}KB")
+    print("="*50)
+    print("O que deseja fazer?")
+    print("1. 💾 Baixar arquivo")
+    print("2. ❌ Ignorar")
+    print("-"*30)
+
+def process_server_payload(payload):
+    """
+    Despacha um quadro recebido: pedaco de arquivo, envelope binario ou mensagem de texto
+    """
+    if is_chunk(payload):
+        receive_file_chunk(payload)
+    elif is_envelope(payload):
+        process_envelope(payload)
+    else:
+        process_server_message(payload.decode(FORMAT))
+
+def process_envelope(payload):
+    """
+    Envelope binario do servidor (ver protocol.py)
+    - user: id e nome de um usuario, anunciado antes das mensagens com o id
+    - msg: mensagem de chat (ids no lugar dos nomes; sala no controle)
+    """
+    global last_seq
+    message_type, sender, destination, seq, control, body = decode_envelope(payload)
+    if message_type == "user":
+        name = body.decode(FORMAT)
+        envelope_names[sender] = name
+        envelope_ids[name] = sender
+    elif message_type == "msg":
+        if seq:
+            last_seq = max(last_seq, seq)
+        if destination == ALL_USERS:
+            destination = "todos"
+        else:
+            destination = envelope_names.get(destination, control) if destination else control
+        print(f"\n💬 [{envelope_names.get(sender, '?')} -> {destination}]: {body.decode(FORMAT)}")
+
+def handle_messages():
+    """
+    Thread dedicada para receber mensagens do servidor
+    Roda continuamente em background:
+    - No modo enquadrado, remonta os quadros (mensagens grudadas ou quebradas
+      em varios segmentos TCP) e processa cada mensagem completa
+    - No modo antigo, cada recv e tratado como uma mensagem
+    - Com sessao retomavel, uma conexao que cai e reaberta (reconnect)
+    """
+    frame_buffer = FrameBuffer()
+
     while True:
         try:
-            msg = client.recv(2048 * 10).decode(FORMAT) # Buffer grande para arquivos
-            if msg:
-                key, value = msg.split("=", 1) # Separar tipo da mensagem do conteudo
-                
-                if key == "msg":
-                    # Verificar se e mensagem do servidor sobre nome duplicado
-                    if "[Servidor]:" in value and "já está sendo usado" in value:
-                        waiting_for_name = True
-                        name_registered = False
-                        print(f"\n💬 {value}")
-                    elif "[Servidor]:" in value and "Bem-vindo ao chat" in value:
-                        name_registered = True
-                        waiting_for_name = False
-                        print(f"\n💬 {value}")
-                    elif "[Servidor]:" in value and "Digite um novo nome:" in value:
-                        print(f"\n💬 {value}")
-                        # Nao fazer nada aqui, deixar o loop principal tratar
-                    else:
-                        print(f"\n💬 {value}")
-                    
-                elif key == "online_users":
-                    # Trata a resposta da lista de usuários online
-                    display_online_users(value)
-                    
-                elif key == "file":
-                    # Formato: remetente||nome_arquivo||dados_base64
-                    parts = value.split("||", 2)
-                    if len(parts) == 3:
-                        sender, filename, b64data = parts
-                        file_size = (len(b64data) * 3) // 4  # Tamanho aproximado em bytes
-                        
-                        # Armazenar dados do arquivo pendente
-                        pending_file_data = {
-                            'sender': sender,
-                            'filename': filename,
-                            'b64data': b64data,
-                            'file_size': file_size
-                        }
-                        
-                        # Marcar que estamos aguardando decisao sobre arquivo
-                        waiting_for_file_decision = True
-                        
-                        print(f"\n" + "="*50)
-                        print(f"📎 ARQUIVO RECEBIDO")
-                        print(f"👤 De: {sender}")
-                        print(f"📄 Arquivo: {filename}")
-                        print(f"📊 Tamanho: {file_size/1024:.1f}KB")
-                        print("="*50)
-                        print("O que deseja fazer?")
-                        print("1. 💾 Baixar arquivo")
-                        print("2. ❌ Ignorar")
-                        print("-"*30)
-                        
-                        # Nao capturar input aqui - sera tratado no menu principal
-                        
+            if USE_FRAMING:
+                data = client.recv(RECV_SIZE)
+                if not data:
+                    if session_token and reconnect():
+                        frame_buffer = FrameBuffer()
+                        continue
+                    print("❌ Conexão encerrada pelo servidor.")
+                    break
+                for payload in frame_buffer.feed(data):
+                    if is_compressed(payload):
+                        for inner in decompress_payload(payload):
+                            process_server_payload(inner)
                     else:
-                        # Compatibilidade com formato antigo
-                        try:
-                            filename, b64data = value.split("||", 1)
-                            print(f"\n📎 [Arquivo recebido - formato antigo]: {filename}")
-                            with open("recebido_" + filename, "wb") as f:
-                                f.write(base64.b64decode(b64data))
-                            print(f"✅ Salvo como: recebido_{filename}")
-                        except:
-                            print("❌ Erro ao processar arquivo (formato incompatível)")
-                            
+                        process_server_payload(payload)
+            else:
+                msg = client.recv(2048 * 10).decode(FORMAT) # Buffer grande para arquivos
+                if msg:
+                    process_server_message(msg)
         except Exception as e:
+            if USE_FRAMING and session_token and isinstance(e, OSError) and reconnect():
+                frame_buffer = FrameBuffer()
+                continue
             print(f"❌ Erro ao receber mensagem: {e}")
             break
 
+def reconnect():
+    """
+    A conexao caiu: abre outra e retoma a sessao ("resume" com o ultimo seq
+    recebido); o servidor devolve o mesmo nome e as salas e reenvia so as
+    mensagens perdidas
+    Arquivos que chegavam em pedacos ficam no .part (podem ser pedidos de novo)
+    Retorna False se nenhuma tentativa conseguiu conectar
+    """
+    global client, compressor, use_envelope
+    print("\n⚠️  Conexão perdida. Tentando reconectar...")
+    for incoming in incoming_files.values():
+        incoming["file"].close()
+    incoming_files.clear()
+    for delay in RECONNECT_DELAYS:
+        time.sleep(delay)
+        try:
+            new_client = socket.create_connection(ADDR, timeout=5)
+            new_client.settimeout(None)
+            new_client.sendall(FRAMED_MAGIC)
+        except OSError:
+            continue
+        with send_lock:
+            old_client, client = client, new_client
+            compressor = None # Renegociados no resume
+            use_envelope = False
+            envelope_names.clear()
+            envelope_ids.clear()
+        try:
+            old_client.close()
+        except OSError:
+            pass
+        resume = name_message(user_name)
+        resume.update(type="resume", control=session_token, message=str(last_seq))
+        send(resume)
+        return True
+    return False
+
+def unique_download_path(filename):
+    """
+    Caminho livre em downloads para o arquivo
+    Evita sobrescrever arquivos existentes adicionando um contador ao nome
+    """
+    # Criar diretorio downloads se nao existir
+    if not os.path.exists("downloads"):
+        os.makedirs("downloads")
+        print("📁 Diretório 'downloads' criado")
+
+    filename = os.path.basename(filename)
+    base_name = os.path.splitext(filename)[0]
+    extension = os.path.splitext(filename)[1]
+    counter = 1
+    new_filename = filename
+
+    while os.path.exists(os.path.join("downloads", new_filename)):
+        new_filename = f"{base_name}_{counter}{extension}"
+        counter += 1
+
+    return os.path.join("downloads", new_filename)
+
+def keep_part_file(part_path, filename):
+    """
+    Move um arquivo recebido em pedacos (.part) para o nome definitivo
+    """
+    try:
+        filepath = unique_download_path(filename)
+        os.replace(part_path, filepath)
+        print(f"✅ Arquivo baixado com sucesso!")
+        print(f"📁 Local: {filepath}")
+        print(f"📊 Tamanho: {os.path.getsize(filepath)/1024:.1f}KB")
+    except Exception as e:
+        print(f"❌ Erro ao salvar arquivo: {e}")
+
+def save_file(filename, b64data):
+    """
+    Decodifica e salva um arquivo recebido na pasta downloads
+    Evita sobrescrever arquivos existentes adicionando um contador ao nome
+    """
+    try:
+        filepath = unique_download_path(filename)
+        
+        print("⏳ Baixando arquivo...")
+        with open(filepath, "wb") as f:
+            f.write(base64.b64decode(b64data))
+        
+        actual_size = os.path.getsize(filepath)
+        print(f"✅ Arquivo baixado com sucesso!")
+        print(f"📁 Local: {filepath}")
+        print(f"📊 Tamanho: {actual_size/1024:.1f}KB")
+        
+    except Exception as e:
+        print(f"❌ Erro ao baixar arquivo: {e}")
+
 def process_pending_file():
     """
     Processa arquivo pendente quando chamado do menu principal
@@ -199,36 +727,22 @@ def process_pending_file():
             break
     
     if choice == "1":
-        try:
-            # Criar diretorio downloads se nao existir
-            if not os.path.exists("downloads"):
-                os.makedirs("downloads")
-                print("📁 Diretório 'downloads' criado")
-            
-            # Evitar sobrescrever arquivos
-            base_name = os.path.splitext(data['filename'])[0]
-            extension = os.path.splitext(data['filename'])[1]
-            counter = 1
-            new_filename = data['filename']
-            
-            while os.path.exists(os.path.join("downloads", new_filename)):
-                new_filename = f"{base_name}_{counter}{extension}"
-                counter += 1
-            
-            filepath = os.path.join("downloads", new_filename)
-            
-            print("⏳ Baixando arquivo...")
-            with open(filepath, "wb") as f:
-                f.write(base64.b64decode(data['b64data']))
-            
-            actual_size = os.path.getsize(filepath)
-            print(f"✅ Arquivo baixado com sucesso!")
-            print(f"📁 Local: {filepath}")
-            print(f"📊 Tamanho: {actual_size/1024:.1f}KB")
-            
-        except Exception as e:
-            print(f"❌ Erro ao baixar arquivo: {e}")
+        if 'file_id' in data:
+            # Arquivo do historico: pedir o conteudo ao servidor
+            requested_files[(data['sender'], data['filename'])] = data['file_id']
+            offset = resume_offset(data.get('sha256'))
+            send({"type": "file_get", "control": "dontcare", "message": data['file_id'], "offset": offset})
+            if offset:
+                print(f"⏳ Retomando download a partir de {offset/1024:.1f}KB...")
+            else:
+                print("⏳ Download solicitado ao servidor...")
+        elif 'part' in data:
+            keep_part_file(data['part'], data['filename'])
+        else:
+            save_file(data['filename'], data['b64data'])
     else:
+        if 'part' in data:
+            os.remove(data['part'])
         print("📎 Arquivo ignorado.")
     
     print("="*50)
@@ -240,13 +754,138 @@ def process_pending_file():
 def send(message):
     """
     Envia mensagem JSON para o servidor
-    Converte dicionario Python para JSON e envia via socket
+    Converte dicionario Python para JSON (ou envelope binario, se negociado) e envia via socket
     """
     try:
-        client.send(json.dumps(message).encode(FORMAT))
+        payload = (use_envelope and encode_client_message(message, envelope_ids)) or json.dumps(message).encode(FORMAT)
+        with send_lock:
+            if USE_FRAMING and compressor is not None:
+                client.sendall(compressor.frame_payloads([payload]))
+            elif USE_FRAMING:
+                client.sendall(encode_frame(payload))
+            else:
+                client.send(payload)
     except Exception as e:
         print(f"Erro ao enviar: {e}")
 
+def send_many(messages):
+    """
+    Envia varias mensagens JSON com um unico sendall (pipelining)
+    Disponivel apenas no modo enquadrado; no modo antigo envia uma a uma
+    """
+    if not USE_FRAMING:
+        for message in messages:
+            send(message)
+        return
+    try:
+        payloads = [(use_envelope and encode_client_message(message, envelope_ids)) or json.dumps(message).encode(FORMAT)
+                    for message in messages]
+        data = compressor.frame_payloads(payloads) if compressor is not None else encode_frames(payloads)
+        with send_lock:
+            client.sendall(data)
+    except Exception as e:
+        print(f"Erro ao enviar: {e}")
+
+def scan_file(path):
+    """
+    Le o arquivo uma vez, em pedacos (memoria constante), e calcula:
+    - o sha256 do conteudo (identifica o arquivo para deduplicacao e retomada)
+    - o CRC32 de cada pedaco de CHUNK_SIZE (enviado no cabecalho do pedaco,
+      assim os dados podem sair direto do disco via sendfile)
+    """
+    hasher = hashlib.sha256()
+    crcs = []
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(CHUNK_SIZE), b""):
+            hasher.update(block)
+            crcs.append(chunk_crc(block))
+    return hasher.hexdigest(), crcs
+
+def send_file_stream(destination, path, filename):
+    """
+    Envia um arquivo em pedacos binarios (modo enquadrado)
+    - Calcula o sha256 do arquivo e anuncia o envio (file_begin); se o
+      servidor ja tem o conteudo (file_exists), nada mais precisa ser enviado
+    - Caso contrario espera o servidor aceitar; o file_accept traz o offset
+      de onde continuar (um envio interrompido do mesmo arquivo e retomado)
+    - Cada pedaco vai com seu cabecalho (offset + CRC32), e os dados saem do
+      disco direto para o socket via sendfile (sem ler o arquivo para a
+      memoria, sem base64)
+    - file_retry (pedaco corrompido): volta ao offset pedido e continua
+    - Termina com file_end; o servidor confirma com file_done
+    """
+    handle = next(upload_ids)
+    size = os.path.getsize(path)
+    upload = {"event": threading.Event(), "accepted": False, "exists": False, "done": False, "reason": "",
+              "filename": filename, "offset": 0, "acked": 0, "retry": None}
+    try:
+        print("⏳ Calculando hash do arquivo...")
+        digest, crcs = scan_file(path)
+    except OSError as e:
+        print(f"❌ Erro ao ler arquivo: {e}")
+        return
+    uploads[handle] = upload
+    try:
+        send({"type": "file_begin", "control": destination, "message": handle, "filename": filename,
+              "size": size, "sha256": digest})
+
+        if not upload["event"].wait(30):
+            print("❌ O servidor não respondeu ao pedido de envio.")
+            return
+        if upload["exists"]:
+            print(f"✅ O servidor já tinha '{filename}': envio dispensado!")
+            return
+        if not upload["accepted"]:
+            print(f"❌ Envio recusado: {upload['reason']}")
+            return
+
+        offset = upload["offset"]
+        if offset:
+            print(f"⏳ Retomando envio em {offset/1024:.1f}KB de {size/1024:.1f}KB...")
+        else:
+            print("⏳ Enviando arquivo...")
+        reported = 0 # Ultima dezena de % confirmada (file_ack) mostrada
+        with open(path, "rb") as file:
+            while True:
+                upload["event"].clear()
+                while offset < size:
+                    if upload["retry"] is not None:
+                        offset, upload["retry"] = upload["retry"], None
+                    if not upload["accepted"]:
+                        print(f"❌ Envio cancelado: {upload['reason']}")
+                        return
+                    count = min(CHUNK_SIZE, size - offset)
+                    if offset % CHUNK_SIZE == 0:
+                        crc = crcs[offset // CHUNK_SIZE]
+                    else:
+                        crc = chunk_crc(os.pread(file.fileno(), count, offset))
+                    with send_lock:
+                        client.sendall(encode_chunk_header(handle, offset, count, crc))
+                        if client.sendfile(file, offset, count) != count:
+                            raise OSError("arquivo alterado durante o envio")
+                    offset += count
+                    if size and upload["acked"] * 10 // size > reported:
+                        reported = upload["acked"] * 10 // size
+                        print(f"📤 {reported * 10}% confirmado pelo servidor")
+                send({"type": "file_end", "control": destination, "message": handle})
+
+                # Aguarda a confirmacao final (ou um pedido de reenvio)
+                while not upload["done"] and upload["retry"] is None and upload["accepted"]:
+                    if not upload["event"].wait(60):
+                        print("❌ O servidor não confirmou o envio.")
+                        return
+                    upload["event"].clear()
+                if upload["retry"] is None:
+                    break
+        if upload["done"]:
+            print(f"✅ Arquivo '{filename}' enviado!")
+        else:
+            print(f"❌ Envio cancelado: {upload['reason']}")
+    except Exception as e:
+        print(f"❌ Erro ao enviar arquivo: {e}")
+    finally:
+        uploads.pop(handle, None)
+
 def send_global_message():
     """
     Captura e envia mensagem global (para todos os usuarios)
@@ -257,6 +896,9 @@ def send_global_message():
         return
     if is_text:
         message_formatted = {"type": "msg", "control": "4all", "message": message}
+    elif USE_FRAMING:
+        send_file_stream("4all", message, filename) # message = caminho do arquivo
+        return
     else:
         message_formatted = {"type": "file", "control": "4all", "message": message, "filename": filename}
     send(message_formatted)
@@ -272,16 +914,109 @@ def send_private_message():
         return
     if is_text:
         message_formatted = {"type": "msg", "control": destination, "message": message}
+    elif USE_FRAMING:
+        send_file_stream(destination, message, filename) # message = caminho do arquivo
+        return
     else:
         message_formatted = {"type": "file", "control": destination, "message": message, "filename": filename}
     send(message_formatted)
 
+def room_menu():
+    """
+    Salas: entrar, sair, enviar mensagem, listar e ver mensagens anteriores
+    A sala padrao (4all) e a das mensagens globais
+    """
+    print("1. ➡️  Entrar numa sala")
+    print("2. ⬅️  Sair de uma sala")
+    print("3. 💬 Mensagem para uma sala")
+    print("4. 📋 Listar salas")
+    print("5. 📜 Mensagens anteriores de uma sala")
+    option = safe_input("Escolha (1-5): ").strip()
+    if option == "4":
+        send({"type": "room", "control": "list", "message": ""})
+        return
+    if option not in ("1", "2", "3", "5"):
+        print("❌ Opção inválida!")
+        return
+    room = safe_input("Nome da sala: ").strip()
+    if not room.startswith("#"):
+        room = "#" + room
+    if option == "1":
+        send({"type": "room", "control": "join", "message": room})
+    elif option == "2":
+        send({"type": "room", "control": "leave", "message": room})
+    elif option == "3":
+        message = safe_input("\n✏️  Digite sua mensagem: ")
+        if message:
+            send({"type": "msg", "control": room, "message": message})
+    elif not room_cursors.get(room):
+        print("📜 Não há mensagens mais antigas nesta sala.")
+    else:
+        send({"type": "history", "control": room, "message": str(room_cursors[room])})
+
+def search_menu():
+    """
+    Busca nas mensagens globais e nas nossas privadas (no servidor)
+    Campos opcionais em branco nao filtram
+    - "mais": proxima pagina da ultima busca
+    - "baixar <id>": baixa um arquivo dos resultados
+    """
+    global search_query
+    words = safe_input("Palavras ('mais' = próxima página, 'baixar <id>' = arquivo): ").strip()
+    if words == "mais":
+        if not search_query or not search_cursor:
+            print("🔍 Não há mais resultados.")
+            return
+        send(dict(search_query, cursor=search_cursor))
+        return
+    if words.startswith("baixar "):
+        try:
+            file_id = int(words.split()[1])
+        except (IndexError, ValueError):
+            file_id = None
+        if file_id not in search_files:
+            print("❌ Id de arquivo não está nos resultados da busca!")
+            return
+        requested_files[search_files[file_id]] = file_id
+        send({"type": "file_get", "control": "dontcare", "message": file_id})
+        print("⏳ Download solicitado ao servidor...")
+        return
+    sender = safe_input("Remetente (opcional): ").strip()
+    filename = safe_input("Nome do arquivo (opcional): ").strip()
+    hours = safe_input("Últimas N horas (opcional): ").strip()
+    query = {"type": "search", "control": "dontcare", "message": words}
+    if sender:
+        query["sender"] = sender
+    if filename:
+        query["filename"] = filename
+    if hours:
+        try:
+            query["since"] = time.time() - float(hours) * 3600
+        except ValueError:
+            print("❌ Número de horas inválido!")
+            return
+    search_query = query
+    search_files.clear()
+    send(query)
+
+def name_message(name):
+    """
+    Mensagem "name" com as opcoes do modo enquadrado
+    """
+    message_formatted = {"type": "name", "control": "dontcare", "message": name}
+    if USE_FRAMING:
+        message_formatted["compression"] = SUPPORTED_CODECS # O servidor escolhe um (ou nenhum)
+        message_formatted["heartbeat"] = True # Respondemos a ping: o servidor pode detectar conexoes mortas
+        message_formatted["resume"] = True # Sessao retomavel: reconectar sem perder mensagens
+        message_formatted["envelope"] = [ENVELOPE_VERSION] # Mensagens de chat sem JSON nem texto a separar
+    return message_formatted
+
 def send_name():
     """
     Funcao melhorada para lidar com nomes duplicados
     Continua solicitando novo nome ate que seja aceito pelo servidor
     """
-    global name_registered, waiting_for_name
+    global name_registered, waiting_for_name, user_name
     
     while not name_registered:
         if waiting_for_name:
@@ -289,8 +1024,8 @@ def send_name():
         else:
             name = safe_input("Digite seu nome: ")
         
-        message_formatted = {"type": "name", "control": "dontcare", "message": name}
-        send(message_formatted)
+        user_name = name
+        send(name_message(name))
         
         # Aguardar resposta do servidor por um tempo
         time.sleep(1)
@@ -304,17 +1039,34 @@ def receive_online_users():
     """
     Solicita a lista de usuarios online do servidor
     Envia requisicao especial que sera processada pelo servidor
+    Com a assinatura de presenca ativa, mostra a lista local na hora
     """
     if not name_registered:
         print("❌ Você precisa definir um nome primeiro!")
         return
-        
+
+    users = presence_users
+    if users is not None:
+        display_online_users(json.dumps([{"name": name, "addr": addr} for name, addr in list(users.items()) if name != user_name]))
+        return
+
     print("⏳ Buscando usuários online...")
     message_formatted = {"type": "online_usr", "control": "dontcare", "message": "dontcare"}
     send(message_formatted)
     # A resposta será tratada automaticamente pela função handle_messages()
     time.sleep(0.5)  # Pequena pausa para dar tempo da resposta chegar
 
+def request_older_history():
+    """
+    Pede ao servidor a pagina anterior do historico global
+    Usa o cursor recebido em "history_cursor" no fim da ultima pagina
+    """
+    if history_cursor == 0:
+        print("📜 Não há mensagens mais antigas no histórico.")
+        return
+    print("⏳ Buscando mensagens anteriores...")
+    send({"type": "history", "control": "dontcare", "message": str(history_cursor)})
+
 def select_file():
     """
     Selecao de arquivo usando interface grafica Tkinter
@@ -358,11 +1110,13 @@ def capture_message():
     Captura mensagem do usuario (texto ou arquivo)
     Apresenta menu para escolher tipo de mensagem
     Para texto: captura entrada do teclado
-    Para arquivo: abre seletor de arquivo e codifica em base64
+    Para arquivo: abre seletor de arquivo (modo enquadrado: o arquivo e
+    enviado em pedacos depois; modo antigo: codifica em base64)
     
     Returns:
         tuple: (conteudo, is_text, filename)
-        - conteudo: texto da mensagem ou dados base64 do arquivo
+        - conteudo: texto da mensagem, caminho do arquivo (modo enquadrado)
+          ou dados base64 do arquivo (modo antigo)
         - is_text: True para texto, False para arquivo
         - filename: nome do arquivo (None para texto)
     """
@@ -391,9 +1145,9 @@ def capture_message():
             print("❌ Arquivo não encontrado ou seleção cancelada.")
             return None, False, None
             
-        # Verificar tamanho do arquivo 
+        # Verificar tamanho do arquivo (limite apenas no modo antigo, base64 em JSON)
         size = os.path.getsize(path)
-        if size > 10 * 1024 * 1024:  # 10MB
+        if not USE_FRAMING and size > 10 * 1024 * 1024:  # 10MB
             print(f"⚠️  Arquivo muito grande ({size/1024/1024:.1f}MB). Máximo recomendado: 10MB")
             if safe_input("Continuar mesmo assim? (s/n): ").lower() != 's':
                 return None, False, None
@@ -403,6 +1157,9 @@ def capture_message():
         print(f"\n📤 Preparando envio...")
         print(f"📄 Arquivo: {filename}")
         print(f"📊 Tamanho: {size/1024:.1f}KB")
+
+        if USE_FRAMING:
+            return path, False, filename # Enviado em pedacos direto do disco
         
         try:
             # Codificar arquivo em base64
@@ -449,10 +1206,13 @@ def start_sending():
         print("1. 🌐 Mensagem global (todos)")
         print("2. 🔒 Mensagem privada")
         print("3. 👥 Listar usuários online")
-        print("4. ❌ Sair")
+        print("4. 📜 Mensagens anteriores")
+        print("5. 🏠 Salas")
+        print("6. 🔍 Buscar mensagens")
+        print("7. ❌ Sair")
         print("-"*30)
         
-        option = safe_input("Escolha (1-4): ").strip()
+        option = safe_input("Escolha (1-7): ").strip()
         
         # Processar opcao selecionada
         if option == "1":
@@ -465,10 +1225,19 @@ def start_sending():
             print("\n👥 USUÁRIOS ONLINE")
             receive_online_users()
         elif option == "4":
+            print("\n📜 HISTÓRICO")
+            request_older_history()
+        elif option == "5":
+            print("\n🏠 SALAS")
+            room_menu()
+        elif option == "6":
+            print("\n🔍 BUSCA")
+            search_menu()
+        elif option == "7":
             print("\n👋 Saindo do chat...")
             break
         else:
-            print("❌ Opção inválida! Digite apenas 1, 2, 3 ou 4.")
+            print("❌ Opção inválida! Digite apenas 1, 2, 3, 4, 5, 6 ou 7.")
 
 def start():
     """
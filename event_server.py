@@ -0,0 +1,378 @@
+#event_server.py
+
+import selectors
+import socket
+import json
+import time
+import heapq
+import itertools
+from collections import deque
+
+from asynclog import logger
+from protocol import FRAMED_MAGIC, RECV_SIZE, FrameBuffer, FrameError
+
+class EventLoopServer:
+    """
+    Servidor de chat baseado em loop de eventos (selectors)
+
+    Funcionalidades:
+        - Atende todas as conexoes numa unica thread, sem thread por cliente
+        - Sockets nao bloqueantes: cada conexao ociosa custa apenas um registro
+          no selector e alguns buffers, em vez de uma pilha de thread
+        - Reaproveita os mesmos handlers do modo thread (server.py), entao os
+          tipos de mensagem (name, msg, file, online_usr) sao identicos
+        - Escritas que nao cabem no buffer do socket ficam na fila de saida
+          limitada da conexao (OutboundQueue) e sao enviadas quando o socket
+          fica gravavel; clientes lentos sofrem a politica da fila, sem
+          atrasar os demais
+        - Downloads em pedacos (streamer) so geram o proximo pedaco quando a
+          fila da conexao esvazia, entao um arquivo grande nao ocupa memoria
+        - Limitacao: o loop nao pode esperar por espaco na fila de um
+          destinatario; ao repassar um arquivo, quem esta com a fila cheia
+          recebe file_abort e sai da transferencia (no modo thread o
+          remetente espera ate RELIABLE_SEND_TIMEOUT)
+        - Uma conexao acima do limite de bytes de arquivo para de ser lida
+          por um tempo (pause), no lugar do sleep do modo thread; o TCP
+          segura o remetente sem travar o loop
+
+    Attributes:
+        listen_socket (socket): Socket do servidor ja em modo de escuta
+        selector (selectors.BaseSelector): Multiplexador de eventos do SO
+        new_connection (callable): Cria o registro da conexao (server.new_connection)
+        process_payload (callable): Processa um payload recebido (server.process_payload)
+        remove_connection (callable): Limpa o registro ao desconectar (server.remove_connection)
+        admit (callable): admit(conn, addr) -> False se a conexao foi recusada
+            (limite de conexoes, server.admit_connection); None = aceita todas
+    """
+    def __init__(self, listen_socket, new_connection, process_payload, remove_connection, admit=None):
+        self.listen_socket = listen_socket
+        self.listen_socket.setblocking(False)
+        self.new_connection = new_connection
+        self.process_payload = process_payload
+        self.remove_connection = remove_connection
+        self.admit = admit
+        self.selector = selectors.DefaultSelector()
+        # data=None identifica o socket de escuta
+        self.selector.register(self.listen_socket, selectors.EVENT_READ, None)
+        # Chamadas vindas de outras threads (call_soon_threadsafe) acordam o loop por este par de sockets
+        self._calls = deque()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self.add_reader(self._wakeup_reader, self.run_calls)
+        # Temporizadores (call_later): heap de (prazo, sequencia, fn, args)
+        self._timers = []
+        self._timer_ids = itertools.count()
+
+    def call_soon_threadsafe(self, fn, *args):
+        """
+        Agenda fn(*args) para rodar na thread do loop
+        Usado por quem vive em outra thread (ex.: federacao entre servidores)
+        e precisa mexer nas conexoes, que so o loop pode tocar
+        """
+        self._calls.append((fn, args))
+        try:
+            self._wakeup_writer.send(b"\0")
+        except BlockingIOError:
+            pass # O loop ja tem um aviso pendente
+
+    def run_calls(self):
+        try:
+            while self._wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._calls:
+            fn, args = self._calls.popleft()
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error("Erro", f"Chamada agendada falhou. Motivo: {e}")
+        return True
+
+    def call_later(self, delay, fn, *args):
+        """
+        Agenda fn(*args) para daqui a `delay` segundos, na thread do loop
+        So pode ser chamado da propria thread do loop
+        """
+        heapq.heappush(self._timers, (time.monotonic() + delay, next(self._timer_ids), fn, args))
+
+    def run_timers(self):
+        """
+        Executa os temporizadores vencidos
+        Retorna o timeout do proximo select (None = nenhum agendado)
+        """
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, fn, args = heapq.heappop(self._timers)
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error("Erro", f"Temporizador falhou. Motivo: {e}")
+        return max(0.0, self._timers[0][0] - now) if self._timers else None
+
+    def serve_forever(self):
+        """
+        Loop principal: espera eventos do SO e despacha para accept/leitura/escrita
+        """
+        while True:
+            try:
+                events = self.selector.select(self.run_timers())
+            except KeyboardInterrupt:
+                logger.info("Servidor", "Encerrando servidor...")
+                break
+            for key, mask in events:
+                if key.data is None:
+                    self.accept()
+                    continue
+                if callable(key.data):
+                    self.run_reader(key)
+                    continue
+                state = key.data
+                if mask & selectors.EVENT_WRITE and not state["closed"]:
+                    self.flush(state)
+                if mask & selectors.EVENT_READ and not state["closed"]:
+                    self.read(state)
+
+    def add_reader(self, sock, callback):
+        """
+        Registra um socket extra no loop (ex.: barramento entre workers)
+        callback() e chamado a cada vez que o socket tem dados; retornar
+        False (fechado) tira o socket do loop
+        """
+        self.selector.register(sock, selectors.EVENT_READ, callback)
+
+    def run_reader(self, key):
+        try:
+            keep = key.data()
+        except Exception as e:
+            logger.error("Erro", f"Leitor extra encerrado. Motivo: {e}")
+            keep = False
+        if not keep:
+            self.selector.unregister(key.fileobj)
+
+    def accept(self):
+        """
+        Aceita todas as conexoes pendentes na fila do socket de escuta
+        """
+        while True:
+            try:
+                conn, addr = self.listen_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.error("Erro do Servidor", f"{e}")
+                return
+            if self.admit is not None and not self.admit(conn, addr):
+                continue
+            conn.setblocking(False)
+            state = {
+                "handshake": b"",          # Bytes do preambulo ainda incompleto (None = concluido)
+                "frames": FrameBuffer(),   # Remontagem de quadros recebidos
+                "pending": deque(),        # Restante do item sendo enviado (memoryviews)
+                "producers": deque(),      # Downloads em pedacos aguardando a fila esvaziar
+                "writing": False,          # EVENT_WRITE registrado no selector
+                "paused": False,           # Leitura suspensa (limite de bytes de arquivo)
+                "closed": False
+            }
+            # Historico no modo antigo: espacado por temporizadores (dormir travaria o loop inteiro)
+            state["client"] = self.new_connection(conn, addr,
+                                                  lambda data, is_file=False, reliable=False, st=state: self.queue(st, data, is_file, reliable),
+                                                  lambda items, st=state: self.stream(st, items),
+                                                  throttle=lambda seconds, st=state: self.pause(st, seconds),
+                                                  schedule=self.call_later)
+            self.selector.register(conn, selectors.EVENT_READ, state)
+            logger.info("Conexão", "Novo usuário conectado: {}", addr, sample=True)
+
+    def read(self, state):
+        """
+        Le o que estiver disponivel no socket e processa as mensagens completas
+        """
+        client_connection = state["client"]
+        conn = client_connection["conn"]
+        addr = client_connection["addr"]
+        try:
+            data = conn.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            logger.error("Erro", f"Conexão com {addr} encerrada. Motivo: {e}")
+            self.close(state)
+            return
+        if not data:
+            self.close(state)
+            return
+        client_connection["bytes_in"] += len(data)
+        client_connection["last_seen"] = time.monotonic()
+
+        # Handshake: detectar o preambulo do modo enquadrado nos primeiros bytes
+        if state["handshake"] is not None:
+            data = state["handshake"] + data
+            if len(data) < len(FRAMED_MAGIC) and FRAMED_MAGIC.startswith(data):
+                state["handshake"] = data # Preambulo quebrado, aguardar o resto
+                return
+            state["handshake"] = None
+            if data.startswith(FRAMED_MAGIC):
+                client_connection["framed"] = True
+                client_connection["history_delay"] = 0 # Quadros dispensam o delay
+                data = data[len(FRAMED_MAGIC):]
+                logger.info("Conexão", "{} usando protocolo enquadrado", addr, sample=True)
+
+        try:
+            if client_connection["framed"]:
+                for payload in state["frames"].feed(data):
+                    self.process_payload(client_connection, payload)
+                    if state["closed"]:
+                        return
+            elif data:
+                self.process_payload(client_connection, data)
+        except json.JSONDecodeError as e:
+            logger.error("Erro JSON", f"Conexão {addr}: {e}")
+            self.close(state)
+        except FrameError as e:
+            logger.error("Erro Protocolo", f"Conexão {addr}: {e}")
+            self.close(state)
+        except Exception as e:
+            logger.error("Erro", f"Conexão com {addr} encerrada. Motivo: {e}")
+            self.close(state)
+
+    def queue(self, state, data, is_file=False, reliable=False):
+        """
+        Writer da conexao no modo event-loop (usado por send_to_connection)
+        - Enfileira na fila de saida da conexao
+        - Se o socket nao estava aguardando escrita, tenta enviar na hora;
+          o que nao couber fica para quando o socket ficar gravavel
+        - Politica DISCONNECT acionada: encerra o cliente lento
+        - reliable=True: so entra se houver espaco (sem esperar)
+        Retorna False se o item nao foi enfileirado
+        """
+        if state["closed"]:
+            return False
+        client_connection = state["client"]
+        queue = client_connection["queue"]
+        if reliable:
+            if not queue.put_reliable(data):
+                return False
+        else:
+            dropped_before = queue.dropped
+            if not queue.put(data, is_file):
+                logger.warning("Fila", f"{client_connection['name']} ({client_connection['addr']}) não acompanha as mensagens: desconectando")
+                self.close(state)
+                return False
+            if queue.dropped and not dropped_before:
+                logger.warning("Fila", f"{client_connection['name']} ({client_connection['addr']}) lento: descartando mensagens ({queue.policy})")
+        if not state["writing"]:
+            self.flush(state)
+        return True
+
+    def stream(self, state, items):
+        """
+        Streamer da conexao no modo event-loop
+        Os itens sao puxados um a um por flush() quando a fila esvazia
+        """
+        if state["closed"]:
+            return False
+        state["producers"].append(iter(items))
+        if not state["writing"]:
+            self.flush(state)
+        return True
+
+    def pump(self, state):
+        """
+        Coloca na fila (vazia) o proximo item do download em andamento
+        Retorna False se nao ha mais nada a enviar
+        """
+        producers = state["producers"]
+        while producers:
+            item = next(producers[0], None)
+            if item is None:
+                producers.popleft()
+                continue
+            return state["client"]["queue"].put_reliable(item)
+        return False
+
+    def flush(self, state):
+        """
+        Envia quadros da fila enquanto o socket aceitar
+        Liga/desliga o interesse em EVENT_WRITE conforme sobrar dados
+        """
+        conn = state["client"]["conn"]
+        queue = state["client"]["queue"]
+        pending = state["pending"]
+        while True:
+            if not pending:
+                data = queue.pop_nowait()
+                if data is None:
+                    if self.pump(state):
+                        continue
+                    break
+                # Itens com varios buffers (cabecalho + dados) saem em sequencia
+                pending.extend(memoryview(part) for part in (data if isinstance(data, tuple) else (data,)))
+            try:
+                sent = conn.send(pending[0])
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError as e:
+                logger.error("Erro", f"Conexão com {state['client']['addr']} encerrada. Motivo: {e}")
+                self.close(state)
+                return
+            if sent < len(pending[0]):
+                pending[0] = pending[0][sent:]
+                # Socket cheio: aguardar ficar gravavel
+                if not state["writing"]:
+                    state["writing"] = True
+                    self.update_events(state)
+                return
+            pending.popleft()
+        if state["writing"]:
+            state["writing"] = False
+            self.update_events(state)
+
+    def update_events(self, state):
+        """
+        Ajusta os eventos da conexao no selector: leitura (se nao pausada) e
+        escrita (se ha dados pendentes). Sem nenhum dos dois, sai do selector
+        """
+        conn = state["client"]["conn"]
+        events = (0 if state["paused"] else selectors.EVENT_READ) | (selectors.EVENT_WRITE if state["writing"] else 0)
+        try:
+            if events:
+                self.selector.modify(conn, events, state)
+            else:
+                self.selector.unregister(conn)
+        except KeyError:
+            if events:
+                self.selector.register(conn, events, state)
+
+    def pause(self, state, seconds):
+        """
+        Para de ler a conexao por `seconds` (a escrita continua)
+        """
+        if state["closed"] or state["paused"]:
+            return
+        state["paused"] = True
+        self.update_events(state)
+        self.call_later(seconds, self.resume, state)
+
+    def resume(self, state):
+        if state["closed"] or not state["paused"]:
+            return
+        state["paused"] = False
+        self.update_events(state)
+
+    def close(self, state):
+        """
+        Encerra a conexao e remove o usuario da lista de conectados
+        """
+        if state["closed"]:
+            return
+        state["closed"] = True
+        state["pending"].clear()
+        state["producers"].clear()
+        conn = state["client"]["conn"]
+        try:
+            self.selector.unregister(conn)
+        except (KeyError, ValueError):
+            pass
+        self.remove_connection(state["client"])
+        conn.close()
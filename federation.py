@@ -0,0 +1,433 @@
+#federation.py
+
+import os
+import hmac
+import json
+import mmap
+import queue
+import socket
+import hashlib
+import secrets
+import itertools
+import threading
+from collections import OrderedDict
+
+from asynclog import logger
+from filestore import DIGEST_PATTERN
+from protocol import (RECV_SIZE, FORMAT, CHUNK_SIZE, FrameBuffer, FrameError, encode_frame,
+                      encode_chunk_header, is_chunk, decode_chunk, chunk_crc)
+
+# FEDERACAO ENTRE SERVIDORES (ver server.py --federation-port / --peer):
+#
+# Cada no (um server.py) aceita conexoes de outros nos numa porta TCP propria
+# e disca para os nos listados em --peer. Os nos formam uma malha completa:
+# cada par de nos precisa estar ligado (basta um dos lados listar o outro).
+# As mensagens sao JSON em quadros (protocol.py), como no chat:
+#
+#   {"op": "hello", "node", "nonce"}               primeira mensagem de cada lado
+#   {"op": "auth", "proof"}                        resposta ao hello do outro lado (ver abaixo)
+#   {"op": "presence", "users": [...]}             usuarios do no ao ligar
+#   {"op": "join", "name", "addr", "framed"}       usuario entrou / {"op": "leave", "name"}
+#   {"op": "global", "message"}                    mensagem global (uma por no, nao por usuario)
+#   {"op": "private", "message"}                   so para o no do destinatario
+#   {"op": "room", "message"}                      mensagem de sala (o no entrega aos membros dele)
+#   {"op": "file_offer", "message", "transfer"}    arquivo novo (referencia com sha256)
+#   {"op": "file_want", "transfer", "sha256"}      o no nao tem o conteudo: pede os dados
+#   pedacos binarios (id = transfer)               dados do arquivo, com CRC32
+#   {"op": "file_data_end", "transfer"} / {"op": "file_data_abort", "transfer"}
+#
+# Nada e repassado adiante: quem recebe entrega apenas aos seus usuarios.
+#
+# Autenticacao: os nos compartilham um segredo (--federation-secret). Cada
+# lado manda no hello um nonce aleatorio e responde ao hello do outro com
+# proof = HMAC-SHA256(segredo, "nonce_do_outro|meu_no"). So depois de conferir
+# a prova do outro lado a ligacao e registrada; qualquer outro evento antes
+# disso encerra a ligacao. Sem segredo, a porta de federacao so deve escutar
+# na propria maquina (server.py exige o segredo para outro endereco).
+
+RECONNECT_DELAY = 2.0 # Segundos entre tentativas de religar a um no
+OFFERS_KEPT = 4096    # Arquivos oferecidos cujos dados ainda podem ser pedidos (file_want)
+
+class PeerLink:
+    """
+    Conexao TCP com outro no
+    Eventos saem por uma thread escritora (quem publica nunca espera o
+    outro no); os dados de arquivo saem direto da thread da transferencia
+    """
+    def __init__(self, sock, addr, dialed):
+        self.sock = sock
+        self.addr = addr
+        self.dialed = dialed # True se este no discou
+        self.node = None     # Nome do outro no (definido no hello)
+        self.nonce = secrets.token_hex(16) # Desafio enviado no nosso hello
+        self.authenticated = False # Prova do outro no conferida (auth)
+        self._lock = threading.Lock() # Um quadro por vez no socket
+        self._outbox = queue.Queue()
+        self.closed = False
+        threading.Thread(target=self._writer, daemon=True).start()
+
+    def send(self, frame):
+        self._outbox.put(frame)
+
+    def send_now(self, *parts):
+        """
+        Envia na thread atual, sem passar pela fila (pedacos de arquivo)
+        """
+        with self._lock:
+            for part in parts:
+                self.sock.sendall(part)
+
+    def _writer(self):
+        while True:
+            frame = self._outbox.get()
+            if frame is None:
+                return
+            try:
+                self.send_now(frame)
+            except OSError:
+                self.close()
+                return
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._outbox.put(None)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+class Federation:
+    """
+    Ligacoes deste servidor com os outros nos da federacao
+
+    Funcionalidades:
+        - Aceita nos na porta de federacao e disca para os configurados,
+          religando quando a conexao cai
+        - Uma ligacao por par de nos: se os dois discarem ao mesmo tempo,
+          fica a do no de nome menor
+        - Presenca: remote_users tem os usuarios de todos os outros nos
+        - broadcast(): um quadro serializado uma vez e enviado uma vez por no
+        - send_to(): evento para um no especifico (mensagens privadas)
+        - offer_file(): arquivos vao so para quem ainda nao tem o conteudo
+          (sha256), em pedacos com CRC direto do disco
+        - handler(evento) recebe join/leave/global/private e "file" (arquivo
+          ja no armazenamento local), sempre com evento["node"] = no de origem
+
+    Attributes:
+        node (str): Nome deste no (unico na federacao)
+        local_users (callable): Retorna os usuarios deste no (para o "presence")
+        host (str): Endereco em que a porta de federacao escuta
+        secret (str): Segredo compartilhado pelos nos (autenticacao das ligacoes)
+    """
+    def __init__(self, node, port, peers, file_store, handler, local_users, host="127.0.0.1", secret=""):
+        self.node = node
+        self.port = port
+        self.host = host
+        self._secret = secret.encode(FORMAT)
+        self.peers = list(peers) # [(host, porta)] discados por este no
+        self.file_store = file_store
+        self.handler = handler
+        self.local_users = local_users
+        self.links = {}        # no -> PeerLink
+        self.remote_users = {} # nome -> {"node", "addr", "framed"}
+        self._lock = threading.Lock()
+        self._addr_nodes = {}  # (host, porta) discado -> no que respondeu
+        self._incoming = {}    # (no, transferencia) -> {"pending", "message", "ok"}
+        self._transfer_ids = itertools.count(1)
+        self._offered = OrderedDict() # transferencia oferecida -> (sha256, nos que ainda podem pedir)
+        self.forwarded = 0     # Quadros enviados a outros nos
+
+    def start(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.host, self.port))
+        listener.listen()
+        threading.Thread(target=self._accept_loop, args=(listener,), daemon=True).start()
+        for addr in self.peers:
+            threading.Thread(target=self._dial_loop, args=(addr,), daemon=True).start()
+        logger.info("Federação", f"Nó '{self.node}' em {self.host}:{self.port}, discando para {len(self.peers)} nós")
+
+    def _accept_loop(self, listener):
+        while True:
+            try:
+                sock, addr = listener.accept()
+            except OSError as e:
+                logger.warning("Federação", f"Falha ao aceitar nó: {e}")
+                continue
+            threading.Thread(target=self._run_link, args=(PeerLink(sock, addr, False),), daemon=True).start()
+
+    def _dial_loop(self, addr):
+        while True:
+            node = self._addr_nodes.get(addr)
+            if node is None or node not in self.links:
+                try:
+                    sock = socket.create_connection(addr, timeout=RECONNECT_DELAY)
+                    sock.settimeout(None)
+                except OSError:
+                    pass
+                else:
+                    self._run_link(PeerLink(sock, addr, True)) # Bloqueia enquanto a ligacao durar
+            threading.Event().wait(RECONNECT_DELAY)
+
+    def _register(self, link):
+        # Retorna False se ja existe outra ligacao com o mesmo no que deve ficar
+        with self._lock:
+            existing = self.links.get(link.node)
+            if existing is not None and not existing.closed:
+                keep_new = self._dialer(link) < self._dialer(existing)
+                if not keep_new:
+                    return False
+                existing.close()
+            self.links[link.node] = link
+            return True
+
+    def _dialer(self, link):
+        # Nome do no que discou a ligacao (criterio de desempate das ligacoes duplicadas)
+        return self.node if link.dialed else link.node
+
+    def _proof(self, nonce, node):
+        # Prova de que `node` conhece o segredo, para o desafio `nonce`
+        return hmac.new(self._secret, f"{nonce}|{node}".encode(FORMAT), hashlib.sha256).hexdigest()
+
+    def _run_link(self, link):
+        frame_buffer = FrameBuffer()
+        registered = False
+        try:
+            link.send(self._frame({"op": "hello", "node": self.node, "nonce": link.nonce}))
+            while True:
+                data = link.sock.recv(RECV_SIZE)
+                if not data:
+                    break
+                for payload in frame_buffer.feed(data):
+                    if link.node is None:
+                        hello = json.loads(payload.decode(FORMAT))
+                        if (hello.get("op") != "hello" or not isinstance(hello.get("node"), str) or not hello["node"]
+                                or hello["node"] == self.node or not isinstance(hello.get("nonce"), str)):
+                            raise FrameError("Handshake de federação inválido")
+                        link.node = hello["node"]
+                        link.send(self._frame({"op": "auth", "proof": self._proof(hello["nonce"], self.node)}))
+                    elif not link.authenticated:
+                        auth = json.loads(payload.decode(FORMAT))
+                        proof = auth.get("proof") if auth.get("op") == "auth" else None
+                        if not isinstance(proof, str) or not hmac.compare_digest(proof, self._proof(link.nonce, link.node)):
+                            raise FrameError("Autenticação de federação falhou")
+                        link.authenticated = True
+                        if link.dialed:
+                            self._addr_nodes[link.addr] = link.node
+                        if not self._register(link):
+                            return # Ligacao duplicada: a outra fica
+                        registered = True
+                        logger.info("Federação", f"Ligado ao nó '{link.node}' ({link.addr[0]}:{link.addr[1]})")
+                        link.send(self._frame({"op": "presence", "users": self.local_users()}))
+                    elif is_chunk(payload):
+                        self._receive_chunk(link, payload)
+                    else:
+                        self._handle(link, json.loads(payload.decode(FORMAT)))
+        except (OSError, FrameError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.info("Federação", f"Ligação com {link.node or link.addr} encerrada: {e}")
+        finally:
+            link.close()
+            try:
+                link.sock.close()
+            except OSError:
+                pass
+            if registered:
+                self._unlink(link)
+
+    def _unlink(self, link):
+        # Remove a ligacao e tudo o que dependia dela (usuarios e arquivos a caminho)
+        with self._lock:
+            if self.links.get(link.node) is not link:
+                return # Substituida por outra ligacao com o mesmo no
+            del self.links[link.node]
+            gone = [name for name, info in self.remote_users.items() if info["node"] == link.node]
+            for name in gone:
+                del self.remote_users[name]
+            transfers = [key for key in self._incoming if key[0] == link.node]
+            aborted = [self._incoming.pop(key)["pending"] for key in transfers]
+        for pending in aborted:
+            pending.abort()
+        logger.info("Federação", f"Nó '{link.node}' desligado ({len(gone)} usuários saíram)")
+        for name in gone:
+            self.handler({"op": "leave", "name": name, "node": link.node})
+
+    def _handle(self, link, event):
+        op = event["op"]
+        event["node"] = link.node # Origem vem da ligacao, nao do conteudo
+        if op == "presence":
+            with self._lock:
+                for user in event["users"]:
+                    self.remote_users[user["name"]] = {"node": link.node, "addr": user.get("addr", ""),
+                                                       "framed": user.get("framed", True)}
+            for user in event["users"]:
+                self.handler({"op": "join", "name": user["name"], "node": link.node})
+        elif op == "join":
+            with self._lock:
+                self.remote_users[event["name"]] = {"node": link.node, "addr": event.get("addr", ""),
+                                                    "framed": event.get("framed", True)}
+            self.handler(event)
+        elif op == "leave":
+            with self._lock:
+                if self.remote_users.get(event["name"], {}).get("node") != link.node:
+                    return
+                del self.remote_users[event["name"]]
+            self.handler(event)
+        elif op in ("global", "private", "room"):
+            self.handler(event)
+        elif op == "file_offer":
+            self._receive_offer(link, event)
+        elif op == "file_want":
+            digest = self._claim_offer(link, event["transfer"])
+            if digest is None:
+                logger.warning("Federação", f"'{link.node}' pediu um arquivo que não foi oferecido a ele")
+                link.send(self._frame({"op": "file_data_abort", "transfer": event["transfer"]}))
+                return
+            threading.Thread(target=self._send_file, args=(link, event["transfer"], digest), daemon=True).start()
+        elif op == "file_data_end":
+            self._finish_incoming(link, event["transfer"])
+        elif op == "file_data_abort":
+            with self._lock:
+                entry = self._incoming.pop((link.node, event["transfer"]), None)
+            if entry is not None:
+                entry["pending"].abort()
+
+    def _frame(self, event):
+        return encode_frame(json.dumps(event).encode(FORMAT))
+
+    def broadcast(self, event):
+        """
+        Envia um evento a todos os nos (serializado uma unica vez)
+        """
+        frame = self._frame(event)
+        for link in list(self.links.values()):
+            link.send(frame)
+            self.forwarded += 1
+
+    def send_to(self, node, event):
+        """
+        Envia um evento a um no; False se nao ha ligacao com ele
+        """
+        link = self.links.get(node)
+        if link is None:
+            return False
+        link.send(self._frame(event))
+        self.forwarded += 1
+        return True
+
+    def node_of(self, name):
+        """
+        No onde o usuario esta conectado (None se nao e usuario remoto)
+        """
+        info = self.remote_users.get(name)
+        return info["node"] if info else None
+
+    def offer_file(self, message, nodes=None):
+        """
+        Anuncia um arquivo do armazenamento local a outros nos (todos, ou
+        apenas `nodes`); quem nao tem o conteudo pede os dados (file_want)
+        """
+        transfer = next(self._transfer_ids)
+        event = {"op": "file_offer", "message": message, "transfer": transfer}
+        with self._lock:
+            self._offered[transfer] = (message["sha256"], set(self.links) if nodes is None else set(nodes))
+            while len(self._offered) > OFFERS_KEPT:
+                self._offered.popitem(last=False) # Oferta antiga: quem ainda nao pediu nao pede mais
+        if nodes is None:
+            self.broadcast(event)
+            return
+        for node in nodes:
+            self.send_to(node, event)
+
+    def _claim_offer(self, link, transfer):
+        # sha256 de um arquivo que este no ofereceu ao no da ligacao (cada no pede uma vez)
+        # O sha256 nunca vem do outro no: so o que foi oferecido e esta no armazenamento sai
+        with self._lock:
+            offer = self._offered.get(transfer) if isinstance(transfer, int) else None
+            if offer is None or link.node not in offer[1]:
+                return None
+            digest, nodes = offer
+            nodes.discard(link.node)
+            if not nodes:
+                del self._offered[transfer]
+        if not DIGEST_PATTERN.fullmatch(digest) or not self.file_store.has(digest):
+            return None
+        return digest
+
+    def _receive_offer(self, link, event):
+        message = event["message"]
+        digest = message.get("sha256")
+        if self.file_store.acquire(digest, message.get("size"), count_dedup=False):
+            message["path"] = self.file_store.path(digest)
+            self.handler({"op": "file", "message": message, "node": link.node})
+            return
+        try:
+            pending = self.file_store.begin()
+        except OSError as e:
+            logger.warning("Federação", f"Falha ao criar arquivo temporário: {e}")
+            return
+        with self._lock:
+            self._incoming[(link.node, event["transfer"])] = {"pending": pending, "message": message, "ok": True}
+        link.send(self._frame({"op": "file_want", "transfer": event["transfer"], "sha256": digest}))
+
+    def _receive_chunk(self, link, payload):
+        transfer, offset, crc, data = decode_chunk(payload)
+        entry = self._incoming.get((link.node, transfer))
+        if entry is None or not entry["ok"]:
+            return
+        if offset != entry["pending"].size or chunk_crc(data) != crc:
+            entry["ok"] = False # Ligacao TCP nao perde nem reordena: so descartar
+            return
+        entry["pending"].write(data)
+
+    def _finish_incoming(self, link, transfer):
+        with self._lock:
+            entry = self._incoming.pop((link.node, transfer), None)
+        if entry is None:
+            return
+        message = entry["message"]
+        if not entry["ok"] or entry["pending"].size != message.get("size"):
+            entry["pending"].abort()
+            logger.warning("Federação", f"Arquivo '{message.get('filename')}' de '{link.node}' chegou incompleto")
+            return
+        try:
+            digest = self.file_store.commit(entry["pending"])
+        except OSError as e:
+            logger.warning("Federação", f"Falha ao armazenar '{message.get('filename')}': {e}")
+            return
+        if digest != message.get("sha256"):
+            self.file_store.release(digest)
+            logger.warning("Federação", f"Arquivo '{message.get('filename')}' de '{link.node}' com sha256 diferente, descartado")
+            return
+        message["path"] = self.file_store.path(digest)
+        self.handler({"op": "file", "message": message, "node": link.node})
+
+    def _send_file(self, link, transfer, digest):
+        # Roda numa thread por transferencia: le do disco (mmap) e envia em pedacos
+        path = self.file_store.path(digest)
+        try:
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) if size else b""
+            for offset in range(0, size, CHUNK_SIZE):
+                chunk = view[offset:offset + CHUNK_SIZE]
+                link.send_now(encode_chunk_header(transfer, offset, len(chunk), chunk_crc(chunk)), chunk)
+        except OSError as e:
+            logger.warning("Federação", f"Falha ao enviar arquivo para '{link.node}': {e}")
+            link.send(self._frame({"op": "file_data_abort", "transfer": transfer}))
+            return
+        link.send(self._frame({"op": "file_data_end", "transfer": transfer}))
+
+    def stats(self):
+        """
+        Nos ligados, usuarios remotos e quadros repassados
+        """
+        with self._lock:
+            return {
+                "node": self.node,
+                "links": sorted(self.links),
+                "remote_users": len(self.remote_users),
+                "forwarded": self.forwarded,
+                "incoming_files": len(self._incoming)
+            }
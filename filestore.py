@@ -0,0 +1,200 @@
+#filestore.py
+
+import os
+import re
+import hashlib
+import tempfile
+import threading
+
+DIGEST_PATTERN = re.compile(r"[0-9a-f]{64}") # SHA-256 em hexadecimal minusculo
+
+class PendingFile:
+    """
+    Arquivo sendo recebido para o store
+    Os dados vao para um arquivo temporario enquanto o hash e calculado
+    pedaco a pedaco; commit() o coloca no lugar definitivo
+    """
+    def __init__(self, store, fd, temp_path):
+        self.store = store
+        self.file = os.fdopen(fd, "wb")
+        self.temp_path = temp_path
+        self.hasher = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.hasher.update(data)
+        self.size += len(data)
+
+    def abort(self):
+        """
+        Descarta o arquivo parcial
+        """
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+class FileStore:
+    """
+    Armazenamento de arquivos em disco enderecado pelo conteudo (SHA-256)
+
+    Funcionalidades:
+        - Cada conteudo e gravado uma unica vez em root/<2 primeiros>/<sha256>,
+          nao importa quantas vezes ou por quem foi enviado
+        - As mensagens guardam apenas o hash; os downloads saem do disco
+        - Contagem de referencias: acquire() para cada mensagem que aponta
+          para o arquivo, release() quando ela sai do historico; o arquivo e
+          apagado quando ninguem mais o referencia
+        - Arquivos encontrados no disco ao iniciar continuam disponiveis para
+          deduplicacao
+        - shared=True (varios processos no mesmo diretorio, ver server.py
+          --workers): conteudo gravado por outro processo e encontrado no
+          disco, e nada e apagado, ja que as referencias dos outros
+          processos nao sao conhecidas aqui
+
+    Thread-safe.
+    """
+    def __init__(self, root="file_store"):
+        self.root = root
+        self._lock = threading.Lock()
+        self._refs = {} # sha256 -> numero de mensagens que apontam para o arquivo
+        self._bytes = 0
+        self.dedup_hits = 0
+        self.dedup_bytes = 0
+        self.shared = False
+        self._scan()
+
+    def _scan(self):
+        # Indexa o que ja existe no disco (de execucoes anteriores)
+        # Arquivos temporarios de envios interrompidos nao sobrevivem ao reinicio
+        if not os.path.isdir(self.root):
+            return
+        temp_dir = os.path.join(self.root, "tmp")
+        if os.path.isdir(temp_dir):
+            for name in os.listdir(temp_dir):
+                try:
+                    os.remove(os.path.join(temp_dir, name))
+                except OSError:
+                    pass
+        for prefix in os.listdir(self.root):
+            folder = os.path.join(self.root, prefix)
+            if len(prefix) != 2 or not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                if DIGEST_PATTERN.fullmatch(name):
+                    self._refs[name] = 0
+                    self._bytes += os.path.getsize(os.path.join(folder, name))
+
+    def path(self, digest):
+        """
+        Caminho do arquivo com o conteudo `digest` no disco
+        """
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest):
+        if not isinstance(digest, str) or not DIGEST_PATTERN.fullmatch(digest):
+            return False
+        with self._lock:
+            return digest in self._refs
+
+    def acquire(self, digest, size=None, count_dedup=True):
+        """
+        Adiciona uma referencia a um conteudo ja armazenado (deduplicacao)
+        Retorna False se o conteudo nao existe (ou o tamanho nao confere),
+        caso em que o arquivo precisa ser enviado
+        - count_dedup=False: referencia que nao e um envio novo (ex.: historico
+          recarregado do log), fora das estatisticas de deduplicacao
+        """
+        if not isinstance(digest, str) or not DIGEST_PATTERN.fullmatch(digest):
+            return False
+        with self._lock:
+            if digest not in self._refs:
+                if not (self.shared and os.path.isfile(self.path(digest))):
+                    return False
+                self._refs[digest] = 0 # Gravado por outro processo
+                self._bytes += os.path.getsize(self.path(digest))
+            if size is not None and os.path.getsize(self.path(digest)) != size:
+                return False
+            self._refs[digest] += 1
+            if count_dedup:
+                self.dedup_hits += 1
+                self.dedup_bytes += os.path.getsize(self.path(digest))
+            return True
+
+    def release(self, digest):
+        """
+        Remove uma referencia; sem referencias, o arquivo e apagado do disco
+        """
+        with self._lock:
+            if digest not in self._refs:
+                return
+            self._refs[digest] -= 1
+            if self._refs[digest] > 0 or self.shared:
+                return
+            del self._refs[digest]
+            try:
+                self._bytes -= os.path.getsize(self.path(digest))
+                os.remove(self.path(digest))
+            except OSError:
+                pass
+
+    def begin(self):
+        """
+        Inicia o recebimento de um arquivo (PendingFile)
+        """
+        temp_dir = os.path.join(self.root, "tmp")
+        os.makedirs(temp_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=temp_dir, suffix=".part")
+        return PendingFile(self, fd, temp_path)
+
+    def commit(self, pending):
+        """
+        Move um arquivo recebido para o endereco do seu conteudo
+        Se o conteudo ja existia (envio simultaneo), a copia nova e descartada
+        Retorna o sha256, ja com uma referencia adquirida
+        """
+        pending.file.close()
+        digest = pending.hasher.hexdigest()
+        target = self.path(digest)
+        with self._lock:
+            if digest in self._refs:
+                os.remove(pending.temp_path)
+                self.dedup_hits += 1
+                self.dedup_bytes += pending.size
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(pending.temp_path, target)
+                self._refs[digest] = 0
+                self._bytes += pending.size
+            self._refs[digest] += 1
+        return digest
+
+    def put_bytes(self, data):
+        """
+        Armazena um conteudo ja em memoria (ex.: arquivo base64 do modo antigo)
+        Retorna o sha256, ja com uma referencia adquirida
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        if self.acquire(digest, len(data)):
+            return digest
+        pending = self.begin()
+        try:
+            pending.write(data)
+        except OSError:
+            pending.abort()
+            raise
+        return self.commit(pending)
+
+    def stats(self):
+        """
+        Arquivos e bytes no disco e quanto a deduplicacao economizou
+        """
+        with self._lock:
+            return {
+                "files": len(self._refs),
+                "bytes": self._bytes,
+                "dedup_hits": self.dedup_hits,
+                "dedup_bytes": self.dedup_bytes
+            }
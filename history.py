@@ -0,0 +1,426 @@
+#history.py
+
+import os
+import time
+import base64
+import threading
+from collections import deque, OrderedDict
+from itertools import islice
+
+from asynclog import logger
+
+RECORD_OVERHEAD = 256 # Estimativa (bytes) do custo fixo de cada registro em memoria
+TRANSIENT_FIELDS = ("id", "spilled", "path") # Campos que nao vao para o log (o id vai no cabecalho do registro)
+INDEX_BATCH = 10000 # Mensagens lidas do log por vez ao montar o indice de busca
+
+def log_record(message):
+    """
+    Forma persistida de uma mensagem no log (messagelog.py)
+    """
+    return {key: value for key, value in message.items() if key not in TRANSIENT_FIELDS}
+
+def message_size(message):
+    """
+    Estimativa do espaco ocupado por um registro de mensagem em memoria
+    """
+    size = RECORD_OVERHEAD + len(message.get("sender", "")) + len(message.get("filename") or "")
+    content = message.get("content")
+    if content is not None:
+        size += len(content)
+    return size
+
+class GlobalHistory:
+    """
+    Historico de mensagens publicas com limite de quantidade e de memoria
+
+    Funcionalidades:
+        - max_messages: numero maximo de mensagens guardadas
+        - max_bytes: orcamento de memoria (estimado) do historico
+        - Ao estourar o orcamento, os payloads de arquivo mais antigos saem
+          primeiro: sao gravados em spill_dir (se configurado) ou descartados,
+          mantendo a mensagem no historico com "content" = None
+        - Se ainda faltar espaco, as mensagens mais antigas sao removidas
+        - memory_usage(): numeros atuais para dimensionar o servidor
+        - Arquivos no armazenamento em disco (file_store, ver filestore.py)
+          ficam so como referencia ("sha256"/"path"); a referencia e liberada
+          quando a mensagem sai do historico
+        - Com um log (MessageLog), toda mensagem e gravada em disco: ao
+          reiniciar, as mais recentes voltam para a memoria, e paginas mais
+          antigas que a memoria sao lidas do log sob demanda
+        - Com um indice (SearchIndex, ver search.py), toda mensagem e
+          indexada ao entrar; no reinicio, o log inteiro e indexado
+
+    Cada mensagem recebe um "id" crescente e um horario ("ts") ao entrar no historico.
+    """
+    def __init__(self, max_messages=1000, max_bytes=64 * 1024 * 1024, spill_dir=None, file_store=None, log=None,
+                 index=None):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.file_store = file_store
+        self._lock = threading.Lock()
+        self._messages = deque()     # Mensagens da mais antiga para a mais nova
+        self._files_in_memory = deque() # Mensagens de arquivo com payload ainda em RAM
+        self._bytes = 0
+        self._next_id = 1
+        self._spilled = 0
+        self._dropped_payloads = 0
+        self._dropped_messages = 0
+        self.log = log
+        self.index = index
+        if log is not None:
+            self._restore()
+
+    def _restore(self):
+        # Recarrega as mensagens mais recentes do log (reinicio do servidor)
+        with self._lock:
+            self._next_id = self.log.next_id
+            for message_id, record in self.log.tail(self.max_messages):
+                message = self._from_log(message_id, record, acquire=True)
+                self._messages.append(message)
+                self._bytes += message_size(message)
+                if message["type"] == "file" and message.get("content") is not None:
+                    self._files_in_memory.append(message)
+            self._enforce_limits()
+            self._dropped_messages = 0
+        if self.index is not None:
+            # Busca: tambem as mensagens que ficaram so no log
+            for first_id in range(self.log.first_id, self.log.next_id, INDEX_BATCH):
+                for message_id, record in self.log.read(first_id, first_id + INDEX_BATCH - 1):
+                    self.index.add(dict(record, id=message_id))
+
+    def _from_log(self, message_id, record, acquire=False):
+        # Mensagem lida do log; arquivos voltam a apontar para o armazenamento
+        # acquire=True: a mensagem fica no historico e segura uma referencia ao conteudo
+        message = dict(record, id=message_id)
+        digest = message.get("sha256")
+        if digest and self.file_store is not None:
+            if acquire and not self.file_store.acquire(digest, count_dedup=False):
+                del message["sha256"] # Conteudo ja apagado: sem referencia para liberar depois
+            elif acquire or self.file_store.has(digest):
+                message["path"] = self.file_store.path(digest)
+        elif digest and acquire:
+            del message["sha256"]
+        return message
+
+    def append(self, message):
+        """
+        Adiciona a mensagem ao historico e aplica os limites
+        Retorna a propria mensagem (com "id" preenchido)
+        """
+        with self._lock:
+            message["id"] = self._next_id
+            message.setdefault("ts", round(time.time(), 3)) # Mensagens de outro no chegam com o horario de la
+            self._next_id += 1
+            if self.log is not None:
+                self.log.append(message["id"], log_record(message))
+            self._messages.append(message)
+            self._bytes += message_size(message)
+            if message["type"] == "file" and message.get("content") is not None:
+                self._files_in_memory.append(message)
+            self._enforce_limits()
+        if self.index is not None:
+            self.index.add(message)
+        return message
+
+    def _enforce_limits(self):
+        # Limite de quantidade: remover as mais antigas
+        while len(self._messages) > self.max_messages:
+            self._pop_oldest()
+        # Limite de memoria: primeiro os payloads de arquivo mais antigos
+        while self._bytes > self.max_bytes and self._files_in_memory:
+            self._evict_payload(self._files_in_memory.popleft())
+        # Sem arquivos em RAM e ainda acima do limite: remover mensagens
+        while self._bytes > self.max_bytes and len(self._messages) > 1:
+            self._pop_oldest()
+
+    def _evict_payload(self, message):
+        content = message["content"]
+        if self.spill_dir:
+            path = os.path.join(self.spill_dir, f"{message['id']}.b64")
+            try:
+                os.makedirs(self.spill_dir, exist_ok=True)
+                with open(path, "w") as f:
+                    f.write(content)
+                message["spilled"] = path
+                self._spilled += 1
+            except OSError as e:
+                logger.warning("Histórico", "Falha ao gravar payload em disco ({}), descartando", e)
+                self._dropped_payloads += 1
+        else:
+            self._dropped_payloads += 1
+        message["content"] = None
+        self._bytes -= len(content)
+
+    def _pop_oldest(self):
+        message = self._messages.popleft()
+        if self._files_in_memory and self._files_in_memory[0] is message:
+            self._files_in_memory.popleft()
+        self._bytes -= message_size(message)
+        if message.get("spilled"):
+            try:
+                os.remove(message["spilled"])
+            except OSError:
+                pass
+            self._spilled -= 1
+        if message.get("sha256") and self.file_store is not None:
+            self.file_store.release(message["sha256"])
+        self._dropped_messages += 1
+
+    def load_payload(self, message):
+        """
+        Retorna o payload (base64) de um arquivo do historico (da RAM ou do disco)
+        None se o payload foi descartado
+        """
+        if message.get("content") is not None:
+            return message["content"]
+        if message.get("path"):
+            try:
+                with open(message["path"], "rb") as f:
+                    return base64.b64encode(f.read()).decode("ascii")
+            except OSError:
+                return None
+        if message.get("spilled"):
+            try:
+                with open(message["spilled"]) as f:
+                    return f.read()
+            except OSError:
+                return None
+        return None
+
+    def page(self, before_id=None, limit=50):
+        """
+        Pagina do historico: as ultimas `limit` mensagens com id < before_id
+        (before_id=None: as mais recentes)
+        Paginas anteriores a memoria vem do log, se houver
+        Retorna (mensagens, tem_mais_antigas)
+        """
+        with self._lock:
+            first_id = self._messages[0]["id"] if self._messages else self._next_id
+            if self.log is None or before_id is None or before_id > first_id:
+                if not self._messages:
+                    return [], False
+                # Ids sao consecutivos no deque: a posicao sai direto do id
+                end = len(self._messages) if before_id is None else max(0, min(before_id - first_id, len(self._messages)))
+                start = max(0, end - limit)
+                has_older = start > 0 or (self.log is not None and first_id > self.log.first_id)
+                return list(islice(self._messages, start, end)), has_older
+        # Fora da memoria: leitura no log, sem trazer nada de volta para a RAM
+        records = self.log.read_before(before_id, limit)
+        messages = [self._from_log(message_id, record) for message_id, record in records]
+        return messages, bool(messages) and messages[0]["id"] > self.log.first_id
+
+    def get(self, message_id):
+        """
+        Busca uma mensagem do historico pelo id (None se ja saiu do historico)
+        Mensagens mais antigas que a memoria sao buscadas no log, se houver
+        """
+        with self._lock:
+            if self._messages:
+                index = message_id - self._messages[0]["id"]
+                if 0 <= index < len(self._messages):
+                    return self._messages[index]
+                if index >= 0:
+                    return None
+            if self.log is None or message_id < 1 or message_id >= self._next_id:
+                return None
+        record = self.log.get(message_id)
+        return self._from_log(message_id, record) if record is not None else None
+
+    def memory_usage(self):
+        """
+        Estado atual do historico:
+        - messages/bytes: mensagens guardadas e memoria estimada
+        - files_in_memory/files_spilled: payloads de arquivo em RAM e em disco
+        - dropped_payloads/dropped_messages: descartes feitos pelos limites
+        """
+        with self._lock:
+            return {
+                "messages": len(self._messages),
+                "bytes": self._bytes,
+                "max_messages": self.max_messages,
+                "max_bytes": self.max_bytes,
+                "files_in_memory": len(self._files_in_memory),
+                "files_spilled": self._spilled,
+                "dropped_payloads": self._dropped_payloads,
+                "dropped_messages": self._dropped_messages
+            }
+
+    def __iter__(self):
+        # Copia estavel para percorrer sem segurar o lock
+        with self._lock:
+            return iter(list(self._messages))
+
+    def __len__(self):
+        return len(self._messages)
+
+class PrivateHistory:
+    """
+    Historico de mensagens privadas indexado por conversa, com limites de memoria
+
+    Funcionalidades:
+        - Cada par de usuarios tem sua propria lista de mensagens
+        - append() e consulta de uma conversa custam O(1)/O(k), independente
+          do total de mensagens privadas ja trocadas no servidor
+        - A chave da conversa nao depende de quem enviou: (A, B) == (B, A)
+        - Limites: max_per_conversation mensagens por conversa e, no total,
+          max_messages mensagens e max_bytes de memoria (estimada); sai sempre
+          a mais antiga (da conversa ou de todas)
+        - Cada mensagem recebe um "id" crescente (o do log, se houver) e um
+          horario ("ts")
+        - Com um log (MessageLog), as mensagens sao gravadas em disco: as
+          ultimas `restore` voltam para a memoria ao reiniciar, e page()
+          busca no log as mensagens que ja sairam da memoria
+        - Com um indice (SearchIndex), as mensagens podem ser buscadas pelos
+          dois lados da conversa; o indice guarda so o id (get() le da
+          memoria ou do log). No reinicio, o log inteiro e indexado
+    """
+    def __init__(self, log=None, restore=1000, index=None, max_messages=100000, max_bytes=64 * 1024 * 1024,
+                 max_per_conversation=1000):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_per_conversation = max_per_conversation
+        self._lock = threading.Lock()
+        self._conversations = {} # (usuario_a, usuario_b) ordenados -> deque das mensagens em memoria
+        self._messages = OrderedDict() # id -> mensagem, da mais antiga para a mais nova (todas as conversas)
+        self._bytes = 0
+        self._next_id = 1
+        self._dropped_messages = 0
+        self._count = 0 # Mensagens ja guardadas (memoria e log)
+        self.log = log
+        self.index = index
+        if log is not None:
+            self._restore(restore)
+
+    def _restore(self, restore):
+        # Recarrega as mensagens mais recentes do log e indexa o log inteiro (reinicio do servidor)
+        with self._lock:
+            self._next_id = self.log.next_id
+            self._count = self.log.next_id - self.log.first_id
+            for message_id, record in self.log.tail(min(restore, self.max_messages)):
+                self._store(dict(record, id=message_id))
+        if self.index is not None:
+            for first_id in range(self.log.first_id, self.log.next_id, INDEX_BATCH):
+                for message_id, record in self.log.read(first_id, first_id + INDEX_BATCH - 1):
+                    self.index.add(dict(record, id=message_id), private=True)
+
+    @staticmethod
+    def conversation_key(user_a, user_b):
+        """
+        Chave canonica da conversa entre dois usuarios
+        """
+        return (user_a, user_b) if user_a <= user_b else (user_b, user_a)
+
+    def append(self, message):
+        """
+        Guarda a mensagem na conversa entre remetente e destinatario e aplica os limites
+        Retorna a propria mensagem (com "id" preenchido), pronta para ser entregue
+        """
+        message.setdefault("ts", round(time.time(), 3))
+        with self._lock:
+            if self.log is not None:
+                # Sequencia propria do log privado (no worker que grava, o log e aberto depois)
+                self._next_id = max(self._next_id, self.log.next_id)
+                self.log.append(self._next_id, log_record(message))
+            message["id"] = self._next_id
+            self._next_id += 1
+            self._count += 1
+            self._store(message)
+        if self.index is not None:
+            self.index.add(message, private=True)
+        return message
+
+    def _store(self, message):
+        conversation = self._conversations.setdefault(self.conversation_key(message["sender"], message["destination"]), deque())
+        conversation.append(message)
+        self._messages[message["id"]] = message
+        self._bytes += message_size(message)
+        if len(conversation) > self.max_per_conversation:
+            self._forget(conversation.popleft())
+        # Em memoria fica sempre o trecho mais recente de cada conversa: a mais
+        # antiga de todas e tambem a primeira da conversa dela
+        while self._messages and (len(self._messages) > self.max_messages or self._bytes > self.max_bytes):
+            oldest = next(iter(self._messages.values()))
+            self._conversations[self.conversation_key(oldest["sender"], oldest["destination"])].popleft()
+            self._forget(oldest)
+
+    def _forget(self, message):
+        del self._messages[message["id"]]
+        self._bytes -= message_size(message)
+        self._dropped_messages += 1
+        key = self.conversation_key(message["sender"], message["destination"])
+        if not self._conversations.get(key):
+            self._conversations.pop(key, None)
+
+    def conversation(self, user_a, user_b, limit=None):
+        """
+        Mensagens em memoria trocadas entre dois usuarios, da mais antiga para a mais nova
+        - limit: se informado, retorna apenas as ultimas `limit` mensagens
+        """
+        with self._lock:
+            messages = self._conversations.get(self.conversation_key(user_a, user_b), ())
+            if limit is not None:
+                return list(islice(messages, max(0, len(messages) - limit), None)) if limit > 0 else []
+            return list(messages)
+
+    def page(self, user_a, user_b, before_id=None, limit=50):
+        """
+        Pagina da conversa: as ultimas `limit` mensagens com id < before_id
+        (before_id=None: as mais recentes)
+        O que ja saiu da memoria vem do log, se houver: o log mistura todas as
+        conversas, entao a leitura volta em blocos ate completar a pagina
+        Retorna (mensagens, tem_mais_antigas)
+        """
+        key = self.conversation_key(user_a, user_b)
+        with self._lock:
+            in_memory = self._conversations.get(key, ())
+            found = [message for message in in_memory if before_id is None or message["id"] < before_id]
+            cursor = in_memory[0]["id"] if in_memory else self._next_id
+        if before_id is not None:
+            cursor = min(cursor, before_id)
+        older = []
+        while self.log is not None and len(found) + len(older) <= limit and cursor > self.log.first_id:
+            records = self.log.read_before(cursor, INDEX_BATCH)
+            if not records:
+                break
+            cursor = records[0][0]
+            older[:0] = [dict(record, id=message_id) for message_id, record in records
+                         if self.conversation_key(record["sender"], record["destination"]) == key]
+        found = older + found
+        return found[-limit:] if limit > 0 else [], len(found) > limit
+
+    def get(self, message_id):
+        """
+        Mensagem pelo id: da memoria ou, se ja saiu dela, do log (None se nao existe mais)
+        """
+        with self._lock:
+            message = self._messages.get(message_id)
+            if message is not None or self.log is None or not 0 < message_id < self._next_id:
+                return message
+        record = self.log.get(message_id)
+        return dict(record, id=message_id) if record is not None else None
+
+    def conversations_of(self, user):
+        """
+        Lista os usuarios com quem `user` tem conversas em memoria
+        """
+        with self._lock:
+            return [b if a == user else a for (a, b) in self._conversations if user in (a, b)]
+
+    def memory_usage(self):
+        """
+        Estado atual do historico privado (mesmos campos do global, mais conversas)
+        """
+        with self._lock:
+            return {
+                "messages": len(self._messages),
+                "bytes": self._bytes,
+                "conversations": len(self._conversations),
+                "max_messages": self.max_messages,
+                "max_bytes": self.max_bytes,
+                "max_per_conversation": self.max_per_conversation,
+                "dropped_messages": self._dropped_messages
+            }
+
+    def __len__(self):
+        return self._count
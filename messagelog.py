@@ -0,0 +1,363 @@
+#messagelog.py
+
+import os
+import json
+import zlib
+import struct
+import bisect
+import threading
+
+from asynclog import logger
+
+# Politicas de fsync (durabilidade x vazao, ver benchmarks/bench_message_log.py)
+FSYNC_ALWAYS = "always"     # fsync a cada mensagem: nada se perde, mas cada append espera o disco
+FSYNC_BATCH = "batch"       # fsync a cada `batch_size` mensagens (e no maximo a cada `interval` segundos)
+FSYNC_INTERVAL = "interval" # fsync periodico numa thread propria, a cada `interval` segundos
+FSYNC_NEVER = "never"       # O sistema operacional decide quando gravar
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_BATCH, FSYNC_INTERVAL, FSYNC_NEVER)
+
+# FORMATO EM DISCO:
+#
+# O log e uma sequencia de segmentos <id_base>.log (id da primeira mensagem,
+# 20 digitos), cada um com registros:
+#
+#   +--------------+--------------+------------+---------------------+
+#   | tamanho (4B) | crc32 (4B)   | id (8B)    | mensagem em JSON    |
+#   +--------------+--------------+------------+---------------------+
+#
+# Ao lado de cada segmento, <id_base>.idx e um indice esparso: pares
+# (id, offset) de 16 bytes, um a cada ~`index_interval` bytes do segmento.
+# Para achar uma mensagem basta uma busca binaria no indice e uma leitura
+# curta a partir do offset encontrado.
+#
+# Recuperacao no reinicio: so o fim do ultimo segmento e relido (a partir da
+# ultima entrada do indice); um registro incompleto ou com CRC errado (queda
+# no meio da gravacao) e cortado.
+RECORD_HEADER = struct.Struct("!IIQ")
+INDEX_ENTRY = struct.Struct("!QQ")
+MAX_RECORD_SIZE = 64 * 1024 * 1024
+
+class Segment:
+    """
+    Um arquivo do log e o seu indice esparso em memoria
+    """
+    def __init__(self, directory, base_id):
+        self.base_id = base_id
+        self.path = os.path.join(directory, f"{base_id:020d}.log")
+        self.index_path = os.path.join(directory, f"{base_id:020d}.idx")
+        self.index_ids = []     # ids das entradas do indice (crescentes)
+        self.index_offsets = [] # offsets correspondentes
+        self.size = 0
+
+    def load_index(self):
+        # Entradas incompletas ou fora de ordem (gravacao interrompida) sao ignoradas
+        self.size = os.path.getsize(self.path)
+        try:
+            with open(self.index_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            data = b""
+        for message_id, offset in INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]):
+            if offset >= self.size or (self.index_ids and (message_id <= self.index_ids[-1] or offset <= self.index_offsets[-1])):
+                break
+            self.index_ids.append(message_id)
+            self.index_offsets.append(offset)
+
+    def offset_for(self, message_id):
+        """
+        Offset de onde comecar a ler para achar `message_id`
+        """
+        position = bisect.bisect_right(self.index_ids, message_id) - 1
+        return self.index_offsets[position] if position >= 0 else 0
+
+def read_records(f, offset, limit):
+    """
+    Le registros de um segmento a partir de `offset`, ate `limit` bytes
+    Gera (id, offset_do_registro, offset_seguinte, corpo) e para no primeiro
+    registro incompleto ou corrompido
+    """
+    f.seek(offset)
+    while offset + RECORD_HEADER.size <= limit:
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        length, crc, message_id = RECORD_HEADER.unpack(header)
+        if length > MAX_RECORD_SIZE or offset + RECORD_HEADER.size + length > limit:
+            return
+        body = f.read(length)
+        if len(body) < length or zlib.crc32(body) & 0xFFFFFFFF != crc:
+            return
+        next_offset = offset + RECORD_HEADER.size + length
+        yield message_id, offset, next_offset, body
+        offset = next_offset
+
+class MessageLog:
+    """
+    Log de mensagens persistente, somente-acrescimo, em segmentos
+
+    Funcionalidades:
+        - append(): grava a mensagem no fim do segmento ativo (um write por
+          mensagem); o fsync segue a politica configurada (FSYNC_*)
+        - Segmentos novos a cada `segment_bytes`; os mais antigos podem ser
+          apagados inteiros (max_segments)
+        - Indice esparso por segmento: get()/read() acham qualquer mensagem
+          com busca binaria + leitura curta, sem manter o log em memoria
+        - tail(): as ultimas N mensagens, para recarregar o historico ao
+          reiniciar sem reler o log inteiro
+        - stats(): tamanho, segmentos, appends e fsyncs
+
+    Os ids sao escolhidos por quem grava (ex.: GlobalHistory) e precisam ser
+    crescentes e consecutivos (tail/read_before contam ids para achar o inicio).
+    Thread-safe.
+    """
+    def __init__(self, directory, fsync=FSYNC_BATCH, batch_size=64, interval=1.0,
+                 segment_bytes=16 * 1024 * 1024, index_interval=4096, max_segments=None):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Política de fsync inválida: {fsync}")
+        self.directory = directory
+        self.fsync_policy = fsync
+        self.batch_size = batch_size
+        self.interval = interval
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        self._segments = [] # Do mais antigo para o ativo
+        self._fd = None
+        self._index_fd = None
+        self._last_indexed = 0 # Offset da ultima entrada do indice no segmento ativo
+        self._unsynced = 0
+        self.last_id = 0
+        self.appends = 0
+        self.fsyncs = 0
+        self.truncated_bytes = 0 # Bytes cortados na recuperacao (registro incompleto)
+        self.closed = False
+
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+        self._flusher = None
+        if fsync in (FSYNC_BATCH, FSYNC_INTERVAL):
+            self._wakeup = threading.Event()
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+
+    def _recover(self):
+        # Carrega os indices e valida apenas o fim do ultimo segmento
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(".log") and name[:-4].isdigit():
+                segment = Segment(self.directory, int(name[:-4]))
+                segment.load_index()
+                self._segments.append(segment)
+        if not self._segments:
+            self._open_segment(1)
+            return
+        active = self._segments[-1]
+        # A entrada do indice e gravada antes do registro: a ultima pode apontar
+        # para um registro que nao chegou ao disco, entao a releitura comeca na penultima
+        if active.index_ids:
+            active.index_ids.pop()
+            active.index_offsets.pop()
+        offset = active.index_offsets[-1] if active.index_offsets else 0
+        end = offset
+        with open(active.path, "rb") as f:
+            for message_id, record_offset, next_offset, _ in read_records(f, offset, active.size):
+                if record_offset - self._index_base(active) >= self.index_interval or not active.index_ids:
+                    active.index_ids.append(message_id)
+                    active.index_offsets.append(record_offset)
+                self.last_id = message_id
+                end = next_offset
+        if end < active.size:
+            self.truncated_bytes = active.size - end
+            logger.warning("Log", "Registro incompleto no fim de {}: {} bytes descartados", active.path, self.truncated_bytes)
+            with open(active.path, "r+b") as f:
+                f.truncate(end)
+            active.size = end
+        if not self.last_id:
+            self.last_id = active.base_id - 1 # Segmento ativo vazio: o anterior terminou no id anterior a base
+        # O indice do segmento ativo e regravado (pode ter ficado para tras na queda)
+        with open(active.index_path, "wb") as f:
+            f.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in zip(active.index_ids, active.index_offsets)))
+        self._open_active(active)
+
+    def _index_base(self, segment):
+        return segment.index_offsets[-1] if segment.index_offsets else 0
+
+    def _open_active(self, segment):
+        self._fd = os.open(segment.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._index_fd = os.open(segment.index_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._last_indexed = self._index_base(segment)
+
+    def _open_segment(self, base_id):
+        segment = Segment(self.directory, base_id)
+        self._segments.append(segment)
+        self._open_active(segment)
+        if self.fsync_policy != FSYNC_NEVER:
+            self._sync_directory() # O arquivo novo tambem precisa sobreviver a uma queda
+        # Politica de retencao: apaga segmentos inteiros, os mais antigos primeiro
+        while self.max_segments and len(self._segments) > self.max_segments:
+            oldest = self._segments.pop(0)
+            for path in (oldest.path, oldest.index_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _sync_directory(self):
+        if not hasattr(os, "O_DIRECTORY"):
+            return # Windows: nao ha fsync de diretorio
+        fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _roll(self, base_id):
+        # Fecha o segmento ativo (ja sincronizado) e abre um novo
+        if self.fsync_policy != FSYNC_NEVER:
+            self._sync_locked()
+        os.close(self._fd)
+        os.close(self._index_fd)
+        self._open_segment(base_id)
+
+    def append(self, message_id, record):
+        """
+        Grava uma mensagem (dicionario serializavel em JSON) com o id informado
+        """
+        body = json.dumps(record, separators=(",", ":")).encode("utf-8")
+        data = RECORD_HEADER.pack(len(body), zlib.crc32(body) & 0xFFFFFFFF, message_id) + body
+        with self._lock:
+            if self.closed:
+                return
+            if message_id <= self.last_id:
+                raise ValueError(f"Id fora de ordem no log: {message_id} <= {self.last_id}")
+            active = self._segments[-1]
+            if active.size and active.size + len(data) > self.segment_bytes:
+                self._roll(message_id)
+                active = self._segments[-1]
+            if not active.index_ids or active.size - self._last_indexed >= self.index_interval:
+                os.write(self._index_fd, INDEX_ENTRY.pack(message_id, active.size))
+                active.index_ids.append(message_id)
+                active.index_offsets.append(active.size)
+                self._last_indexed = active.size
+            os.write(self._fd, data)
+            active.size += len(data)
+            self.last_id = message_id
+            self.appends += 1
+            self._unsynced += 1
+            if self.fsync_policy == FSYNC_ALWAYS or (self.fsync_policy == FSYNC_BATCH and self._unsynced >= self.batch_size):
+                self._sync_locked()
+
+    def _sync_locked(self):
+        if self._unsynced:
+            os.fsync(self._fd)
+            self._unsynced = 0
+            self.fsyncs += 1
+
+    def sync(self):
+        """
+        Forca a gravacao em disco do que foi acrescentado
+        """
+        with self._lock:
+            if not self.closed:
+                self._sync_locked()
+
+    def _flush_loop(self):
+        # Garante que nada fica mais que `interval` segundos sem fsync
+        while not self._wakeup.wait(self.interval):
+            try:
+                self.sync()
+            except OSError as e:
+                logger.error("Log", "Falha no fsync: {}", e)
+
+    def _segment_for(self, message_id):
+        position = bisect.bisect_right([segment.base_id for segment in self._segments], message_id) - 1
+        return max(position, 0)
+
+    def read(self, first_id, last_id=None):
+        """
+        Mensagens com first_id <= id <= last_id (last_id=None: ate o fim)
+        Retorna lista de (id, mensagem)
+        """
+        with self._lock:
+            if last_id is None or last_id > self.last_id:
+                last_id = self.last_id
+            segments = [(segment, segment.size, segment.offset_for(first_id)) for segment in self._segments[self._segment_for(first_id):]]
+        result = []
+        for segment, size, offset in segments:
+            if segment.base_id > last_id:
+                break
+            try:
+                with open(segment.path, "rb") as f:
+                    for message_id, _, _, body in read_records(f, offset if segment.base_id <= first_id else 0, size):
+                        if message_id > last_id:
+                            return result
+                        if message_id >= first_id:
+                            result.append((message_id, json.loads(body)))
+            except OSError:
+                continue # Segmento apagado pela retencao durante a leitura
+        return result
+
+    def read_before(self, before_id, limit):
+        """
+        As ultimas `limit` mensagens com id < before_id
+        """
+        if limit <= 0 or before_id <= self.first_id:
+            return []
+        return self.read(max(self.first_id, before_id - limit), before_id - 1)[-limit:]
+
+    def tail(self, count):
+        """
+        As ultimas `count` mensagens do log (recarga do historico no reinicio)
+        """
+        if count <= 0 or not self.last_id:
+            return []
+        return self.read(max(self.first_id, self.last_id - count + 1))[-count:]
+
+    def get(self, message_id):
+        """
+        Uma mensagem pelo id (None se nao esta no log)
+        """
+        records = self.read(message_id, message_id)
+        return records[0][1] if records else None
+
+    @property
+    def first_id(self):
+        """
+        Menor id que ainda pode estar no log
+        """
+        with self._lock:
+            return self._segments[0].base_id
+
+    @property
+    def next_id(self):
+        return self.last_id + 1
+
+    def close(self):
+        """
+        Grava o que falta e fecha o log
+        """
+        with self._lock:
+            if self.closed:
+                return
+            self._sync_locked()
+            self.closed = True
+            os.close(self._fd)
+            os.close(self._index_fd)
+        if self._flusher is not None:
+            self._wakeup.set()
+
+    def stats(self):
+        """
+        Segmentos, bytes em disco, appends e fsyncs do log
+        """
+        with self._lock:
+            return {
+                "segments": len(self._segments),
+                "bytes": sum(segment.size for segment in self._segments),
+                "first_id": self._segments[0].base_id,
+                "last_id": self.last_id,
+                "appends": self.appends,
+                "fsyncs": self.fsyncs,
+                "unsynced": self._unsynced,
+                "policy": self.fsync_policy
+            }
@@ -0,0 +1,166 @@
+#metrics.py
+
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from asynclog import logger
+
+# Baldes do histograma de latencia: potencias de 2 em microssegundos
+# (balde i = ate 2^i us). O ultimo acumula tudo acima de ~67 s.
+LATENCY_BUCKETS = 27
+
+class LatencyHistogram:
+    """
+    Histograma de latencias com baldes fixos (potencias de 2)
+    Registrar custa um bit_length e um incremento; percentis sao estimados
+    pelo limite superior do balde (erro maximo de 2x, suficiente para p99)
+    """
+    def __init__(self):
+        self.buckets = [0] * LATENCY_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[min(int(seconds * 1e6).bit_length(), LATENCY_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """
+        Limite superior (segundos) do balde onde cai o percentil `fraction`
+        """
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for index, amount in enumerate(self.buckets):
+            seen += amount
+            if seen >= target:
+                return min((1 << index) / 1e6, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum_s": self.total,
+            "avg_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "p50_ms": self.percentile(0.50) * 1000,
+            "p99_ms": self.percentile(0.99) * 1000,
+            "p999_ms": self.percentile(0.999) * 1000,
+            "max_ms": self.max * 1000,
+            "buckets": list(self.buckets)
+        }
+
+class Metrics:
+    """
+    Contadores e histogramas de latencia do servidor
+
+    Funcionalidades:
+        - observe(tipo, segundos, bytes): uma mensagem processada (contagem,
+          bytes recebidos e latencia por tipo) com uma unica aquisicao de lock
+        - count(nome, n): contadores livres (conexoes abertas/fechadas, bytes
+          de conexoes ja encerradas...)
+        - snapshot(): copia consistente de tudo, para o tipo "metrics" e o
+          endpoint HTTP
+
+    Os valores instantaneos (conexoes ativas, filas, memoria do historico)
+    nao ficam aqui: quem monta o relatorio le na hora (ver server.py).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.messages = {} # tipo -> {"count", "bytes_in", "latency"}
+        self.started = time.time()
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, message_type, seconds, size=0):
+        with self._lock:
+            entry = self.messages.get(message_type)
+            if entry is None:
+                entry = self.messages[message_type] = {"count": 0, "bytes_in": 0, "latency": LatencyHistogram()}
+            entry["count"] += 1
+            entry["bytes_in"] += size
+            entry["latency"].observe(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "uptime_s": time.time() - self.started,
+                "counters": dict(self.counters),
+                "messages": {message_type: {"count": entry["count"], "bytes_in": entry["bytes_in"],
+                                            "latency": entry["latency"].snapshot()}
+                             for message_type, entry in self.messages.items()}
+            }
+
+def format_text(report, prefix="chat"):
+    """
+    Relatorio (dicionario) no formato texto do Prometheus
+    - "messages": uma serie por tipo (rotulo type), com o histograma de latencia
+    - demais chaves: valores numericos achatados (ex.: queues.depth -> chat_queues_depth)
+    """
+    lines = []
+
+    def flatten(name, value):
+        if isinstance(value, bool):
+            value = int(value)
+        if isinstance(value, dict):
+            for key, inner in value.items():
+                flatten(f"{name}_{key}", inner)
+        elif isinstance(value, (int, float)):
+            lines.append(f"{name} {value}")
+
+    for key, value in report.items():
+        if key != "messages":
+            flatten(f"{prefix}_{key}", value)
+    for message_type, entry in sorted(report.get("messages", {}).items()):
+        label = f'type="{message_type}"'
+        lines.append(f"{prefix}_messages_total{{{label}}} {entry['count']}")
+        lines.append(f"{prefix}_message_bytes_in_total{{{label}}} {entry['bytes_in']}")
+        latency = entry["latency"]
+        cumulative = 0
+        for index, amount in enumerate(latency["buckets"]):
+            cumulative += amount
+            bound = "+Inf" if index == LATENCY_BUCKETS - 1 else f"{(1 << index) / 1e6:g}"
+            lines.append(f'{prefix}_message_latency_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+        lines.append(f"{prefix}_message_latency_seconds_sum{{{label}}} {latency['sum_s']}")
+        lines.append(f"{prefix}_message_latency_seconds_count{{{label}}} {latency['count']}")
+    return "\n".join(lines) + "\n"
+
+def start_http(port, report, host="127.0.0.1"):
+    """
+    Endpoint HTTP local com as metricas, numa thread propria
+    - GET /metrics: texto (Prometheus)
+    - GET /metrics.json: JSON
+    - report: funcao sem argumentos que monta o relatorio na hora
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body, content_type = format_text(report()).encode("utf-8"), "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body, content_type = json.dumps(report()).encode("utf-8"), "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # Sem uma linha de log por coleta
+
+    http_server = ThreadingHTTPServer((host, port), MetricsHandler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    logger.info("Métricas", "http://{}:{}/metrics", host, port)
+    return http_server
@@ -0,0 +1,192 @@
+#outbound.py
+
+import time
+import threading
+from collections import deque
+
+# Politicas quando a fila de saida de um cliente enche
+DROP_OLDEST = "drop_oldest" # Descarta as mensagens mais antigas da fila
+DROP_FILES = "drop_files"   # Descarta primeiro os arquivos na fila, depois as mais antigas
+DISCONNECT = "disconnect"   # Desconecta o cliente lento
+POLICIES = (DROP_OLDEST, DROP_FILES, DISCONNECT)
+
+def item_size(data):
+    """
+    Tamanho de um item da fila: bytes/memoryview, ou tupla de buffers que
+    devem sair juntos e em ordem (ex.: cabecalho do pedaco + dados do arquivo)
+    """
+    if isinstance(data, tuple):
+        return sum(len(part) for part in data)
+    return len(data)
+
+class OutboundQueue:
+    """
+    Fila de saida limitada de uma conexao
+
+    Funcionalidades:
+        - Quem envia (broadcast, respostas) apenas enfileira e segue em frente;
+          um escritor proprio da conexao esvazia a fila no socket
+        - Limites por quantidade de itens e por bytes
+        - Ao estourar, aplica a politica configurada (DROP_OLDEST, DROP_FILES
+          ou DISCONNECT); cada item e um quadro inteiro, entao descartar nunca
+          corrompe o enquadramento
+        - Itens confiaveis (put_reliable, usados pelos pedacos de arquivo) nunca
+          sao descartados: quem envia espera por espaco ou desiste da transferencia
+        - Profundidade atual, maxima, descartes e bytes enviados ficam
+          disponiveis em stats()
+
+    Thread-safe: put() pode ser chamado de qualquer thread; get() bloqueia o
+    escritor ate haver dados (modo thread) e pop_nowait() atende o modo
+    event-loop.
+    """
+    def __init__(self, max_items=1000, max_bytes=16 * 1024 * 1024, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f"Política de fila inválida: {policy}")
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._items = deque() # (dados, is_file, confiavel, tamanho)
+        self._bytes = 0
+        self._cond = threading.Condition()
+        self.closed = False
+        self.max_depth = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self.sent_bytes = 0 # Bytes entregues ao escritor (saem para o socket)
+
+    def put(self, data, is_file=False):
+        """
+        Enfileira um quadro pronto para envio (ou tupla de buffers, ver item_size)
+        Retorna False se a politica DISCONNECT foi acionada (o cliente deve
+        ser desconectado); True caso contrario, mesmo que algo tenha sido descartado
+        """
+        with self._cond:
+            if self.closed:
+                return True
+            size = item_size(data)
+            self._items.append((data, is_file, False, size))
+            self._bytes += size
+            if self._over_limits():
+                if self.policy == DISCONNECT:
+                    self.closed = True
+                    self._cond.notify_all()
+                    return False
+                if self.policy == DROP_FILES:
+                    self._drop_matching(lambda item: item[1])
+                self._drop_matching(lambda item: True)
+            if len(self._items) > self.max_depth:
+                self.max_depth = len(self._items)
+            self._cond.notify_all()
+            return True
+
+    def put_reliable(self, data, timeout=0):
+        """
+        Enfileira um item que nao pode ser descartado (ex.: pedaco de arquivo)
+        - Espera ate `timeout` segundos por espaco na fila (0 = nao espera)
+        - Retorna False se nao coube a tempo ou se a fila foi fechada
+        """
+        size = item_size(data)
+        with self._cond:
+            deadline = time.monotonic() + timeout
+            while not self.closed and self._items and not self._has_room(size):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            if self.closed:
+                return False
+            self._items.append((data, False, True, size))
+            self._bytes += size
+            if len(self._items) > self.max_depth:
+                self.max_depth = len(self._items)
+            self._cond.notify_all()
+            return True
+
+    def has_room(self, size=0):
+        """
+        True se um item de `size` bytes cabe na fila sem estourar os limites
+        """
+        with self._cond:
+            return self._has_room(size)
+
+    def _has_room(self, size):
+        return len(self._items) < self.max_items and self._bytes + size <= self.max_bytes
+
+    def _over_limits(self):
+        return len(self._items) > self.max_items or self._bytes > self.max_bytes
+
+    def _drop_matching(self, predicate):
+        # Remove itens descartaveis (mais antigos primeiro) ate caber nos limites
+        # O item mais novo e os itens confiaveis sempre ficam
+        kept = deque()
+        while len(self._items) > 1 and self._over_limits():
+            item = self._items.popleft()
+            if not item[2] and predicate(item):
+                self._drop(item)
+            else:
+                kept.append(item)
+        kept.extend(self._items)
+        self._items = kept
+
+    def _drop(self, item):
+        self._bytes -= item[3]
+        self.dropped += 1
+        self.dropped_bytes += item[3]
+
+    def get(self, timeout=None):
+        """
+        Retira o proximo quadro, bloqueando ate haver dados
+        Retorna None quando a fila e fechada (ou no timeout)
+        """
+        with self._cond:
+            while not self._items and not self.closed:
+                if not self._cond.wait(timeout):
+                    return None
+            if self.closed:
+                return None
+            data, _, _, size = self._items.popleft()
+            self._bytes -= size
+            self.sent_bytes += size
+            self._cond.notify_all() # Acorda quem espera espaco em put_reliable
+            return data
+
+    def pop_nowait(self):
+        """
+        Retira o proximo quadro sem bloquear (None se a fila estiver vazia)
+        """
+        with self._cond:
+            if not self._items:
+                return None
+            data, _, _, size = self._items.popleft()
+            self._bytes -= size
+            self.sent_bytes += size
+            self._cond.notify_all()
+            return data
+
+    def close(self):
+        """
+        Fecha a fila: descarta o que restou e libera o escritor bloqueado em get()
+        """
+        with self._cond:
+            self.closed = True
+            self._items.clear()
+            self._bytes = 0
+            self._cond.notify_all()
+
+    def stats(self):
+        """
+        Profundidade e descartes da fila
+        """
+        with self._cond:
+            return {
+                "depth": len(self._items),
+                "bytes": self._bytes,
+                "max_depth": self.max_depth,
+                "dropped": self.dropped,
+                "dropped_bytes": self.dropped_bytes,
+                "sent_bytes": self.sent_bytes,
+                "policy": self.policy
+            }
+
+    def __len__(self):
+        return len(self._items)
@@ -0,0 +1,119 @@
+#presence.py
+
+import json
+import threading
+
+from protocol import EncodedMessage
+
+class Presence:
+    """
+    Lista de usuarios online (deste servidor, dos outros workers e dos
+    outros nos da federacao) com a versao serializada em cache
+
+    Funcionalidades:
+        - Cada entrada e serializada uma vez, na entrada do usuario; o array
+          JSON completo so e remontado no primeiro pedido depois de uma
+          entrada/saida (pedidos seguidos reutilizam o mesmo texto)
+        - users_text(exclude): lista sem o proprio usuario (resposta do
+          online_usr) recortada do texto em cache, sem novo json.dumps
+        - Assinantes (subscribe) recebem um snapshot com versao e depois
+          apenas as mudancas: presence_delta={"op", "name", "addr", "version"}.
+          Snapshot e deltas sao codificados uma vez para todos os assinantes
+        - Cada usuario tem uma origem (None = conexao local, ou o worker/no
+          remoto): uma saida so remove a entrada se vier da mesma origem
+
+    send(conexao, EncodedMessage) entrega a um assinante; e chamado com o
+    lock tomado, para que os deltas saiam na ordem das versoes (o cliente que
+    perder uma versao pede um snapshot novo).
+    """
+    def __init__(self, send):
+        self.send = send
+        self._lock = threading.RLock() # send pode encerrar uma conexao, que sai da lista (reentrada)
+        self._users = {}         # nome -> (entrada JSON, origem)
+        self._subscribers = {}   # socket -> registro da conexao
+        self._text = None        # Array JSON com todos (None = invalidado)
+        self._offsets = {}       # nome -> (inicio, fim) da entrada em _text, com a virgula
+        self._snapshot = None    # EncodedMessage do "presence=" da versao atual
+        self.version = 0
+        self.rebuilds = 0
+
+    def join(self, name, addr, origin=None):
+        with self._lock:
+            self._users[name] = (json.dumps({"name": name, "addr": addr}), origin)
+            self._changed({"op": "join", "name": name, "addr": addr})
+
+    def leave(self, name, origin=None):
+        with self._lock:
+            entry = self._users.get(name)
+            if entry is None or entry[1] != origin:
+                return # Nome ja assumido por outra conexao / outro no
+            del self._users[name]
+            self._changed({"op": "leave", "name": name})
+
+    def _changed(self, delta):
+        self.version += 1
+        self._text = self._snapshot = None
+        if not self._subscribers:
+            return
+        delta["version"] = self.version
+        encoded = EncodedMessage(f"presence_delta={json.dumps(delta)}")
+        for conn in list(self._subscribers.values()):
+            self.send(conn, encoded)
+
+    def _build(self):
+        # Remonta o array JSON (uma vez por versao) e a posicao de cada entrada
+        if self._text is not None:
+            return self._text
+        parts = []
+        offsets = {}
+        position = 1 # Depois do "["
+        for name, (entry, _) in self._users.items():
+            if parts:
+                entry = ", " + entry
+            parts.append(entry)
+            offsets[name] = (position, position + len(entry))
+            position += len(entry)
+        self._text = "[" + "".join(parts) + "]"
+        self._offsets = offsets
+        self.rebuilds += 1
+        return self._text
+
+    def users_text(self, exclude=None):
+        """
+        Array JSON com os usuarios online, sem `exclude`
+        """
+        with self._lock:
+            text = self._build()
+            span = self._offsets.get(exclude)
+        if span is None:
+            return text
+        start, end = span
+        if start == 1 and end < len(text) - 1:
+            end += 2 # Primeira entrada: remove a virgula que vem depois dela
+        return text[:start] + text[end:]
+
+    def subscribe(self, client_connection):
+        """
+        Passa a enviar as mudancas a esta conexao, comecando por um snapshot
+        """
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = EncodedMessage(f'presence={{"version": {self.version}, "users": {self._build()}}}')
+            self._subscribers[client_connection["conn"]] = client_connection
+            self.send(client_connection, self._snapshot)
+
+    def unsubscribe(self, client_connection):
+        with self._lock:
+            self._subscribers.pop(client_connection["conn"], None)
+
+    def __len__(self):
+        return len(self._users)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "users": len(self._users),
+                "subscribers": len(self._subscribers),
+                "version": self.version,
+                "rebuilds": self.rebuilds
+            }
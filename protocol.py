@@ -0,0 +1,510 @@
+#protocol.py
+
+import struct
+import threading
+import time
+import zlib
+
+try:
+    from compression import zstd # Python 3.14+
+except ImportError:
+    zstd = None
+
+try:
+    import lz4.frame as lz4_frame # Opcional: pip install lz4
+except ImportError:
+    lz4_frame = None
+
+# PROTOCOLO ENQUADRADO (framed):
+#
+# Logo apos o connect() o cliente envia o preambulo FRAMED_MAGIC.
+# A partir dai, nos dois sentidos, cada mensagem vai num quadro:
+#
+#   +----------------------+---------------------+
+#   | tamanho (4 bytes BE) | payload (N bytes)   |
+#   +----------------------+---------------------+
+#
+# O payload e exatamente o que seria enviado no modo antigo
+# (JSON do cliente ou string "tipo=conteudo" do servidor).
+# Clientes que nao enviam o preambulo continuam no modo antigo (sem quadros).
+#
+# TRANSFERENCIA DE ARQUIVOS EM PEDACOS (apenas no modo enquadrado):
+#
+# Quadros cujo payload comeca com o byte TAG_CHUNK (0x00) sao pedacos binarios
+# de um arquivo, sem base64 e sem JSON:
+#
+#   +-----------+-------------------+----------------+------------+------------+
+#   | 0x00 (1B) | transferencia (4B)| offset (8B BE) | CRC32 (4B) | dados crus |
+#   +-----------+-------------------+----------------+------------+------------+
+#
+# O CRC32 de cada pedaco detecta corrupcao sem refazer o hash do arquivo
+# inteiro; o offset permite retomar uma transferencia interrompida.
+# O inicio e o fim de cada transferencia sao mensagens normais
+# (file_begin / file_end / file_abort), ver server.py.
+#
+# COMPRESSAO (negociada no "name", apenas no modo enquadrado):
+#
+# Quadros cujo payload comeca com TAG_COMPRESSED (0x01) carregam, comprimidos,
+# um ou mais quadros normais em sequencia (ex.: uma pagina inteira do
+# historico num unico bloco):
+#
+#   +-----------+-------------+--------------------------------------+
+#   | 0x01 (1B) | codec (1B)  | quadros normais comprimidos          |
+#   +-----------+-------------+--------------------------------------+
+#
+# Mensagens pequenas (< COMPRESS_MIN_BYTES) e conteudo que ja vem comprimido
+# vao sem compressao; pedacos de arquivo nunca sao comprimidos (seguem por
+# sendfile/mmap sem copia).
+#
+# ENVELOPE BINARIO (negociado no "name", apenas no modo enquadrado):
+#
+# Quadros cujo payload comeca com TAG_ENVELOPE (0x02) trazem uma mensagem em
+# formato compacto, no lugar do JSON (cliente) ou da string "tipo=..." (servidor):
+#
+#   +-----------+-----------+----------------+--------------+----------+---------------+----------+-------+
+#   | 0x02 (1B) | tipo (1B) | remetente (4B) | destino (4B) | seq (4B) | controle (2B) | controle | corpo |
+#   +-----------+-----------+----------------+--------------+----------+---------------+----------+-------+
+#
+# - tipo: codigo do tipo da mensagem (ENVELOPE_TYPES)
+# - remetente/destino: ids de usuario atribuidos pelo servidor (0 = nenhum,
+#   ALL_USERS = todos). Antes da primeira mensagem com um id que a conexao
+#   ainda nao conhece, o servidor manda um envelope "user" (id + nome)
+# - seq: numero da mensagem no diario de reconexao (0 = sem numero)
+# - controle: texto com o tamanho indicado (sala "#nome", acao do room,
+#   destinatario cujo id o cliente nao conhece...)
+# - corpo: o restante do payload, conteudo cru em utf-8 (sem escapes)
+# Do cliente vao no envelope as mensagens so com type/control/message; as que
+# tem outros campos (filename, offset...) continuam em JSON. Do servidor vao
+# no envelope as mensagens de chat (globais, privadas e de salas); as demais
+# continuam em texto.
+
+FORMAT = 'utf-8'
+FRAMED_MAGIC = b"CHF1"          # Preambulo do handshake do modo enquadrado
+HEADER = struct.Struct("!I")    # Cabecalho: tamanho do payload (uint32 big-endian)
+HEADER_SIZE = HEADER.size
+MAX_FRAME_SIZE = 64 * 1024 * 1024  # Limite de seguranca por quadro
+RECV_SIZE = 256 * 1024          # Quantidade lida por recv (esvazia o buffer do socket)
+TAG_CHUNK = b"\x00"             # Primeiro byte de um quadro com pedaco de arquivo
+CHUNK_HEADER = struct.Struct("!cIQI") # tag, id da transferencia, offset, crc32 dos dados
+CHUNK_SIZE = 64 * 1024          # Tamanho dos pedacos de arquivo
+TAG_COMPRESSED = b"\x01"        # Primeiro byte de um quadro comprimido
+TAG_ENVELOPE = b"\x02"          # Primeiro byte de um quadro com envelope binario
+ENVELOPE_VERSION = "bin1"       # Nome do formato no handshake
+ENVELOPE_HEADER = struct.Struct("!cBIIIH") # tag, tipo, remetente, destino, seq, tamanho do controle
+ENVELOPE_TYPES = ("user", "name", "resume", "msg", "file", "online_usr", "presence", "room", "history", "search",
+                  "file_get", "file_begin", "file_end", "metrics", "ping", "pong") # Codigo = posicao + 1
+ENVELOPE_CODES = {message_type: code for code, message_type in enumerate(ENVELOPE_TYPES, 1)}
+ENVELOPE_FIELDS = {"type", "control", "message"} # Mensagens do cliente com outros campos vao em JSON
+ALL_USERS = 0xFFFFFFFF          # Destino "todos" (4all)
+COMPRESS_MIN_BYTES = 512        # Abaixo disso nao vale a pena comprimir
+COMPRESS_SAMPLE_BYTES = 4096    # Amostra usada para detectar conteudo ja comprimido
+INCOMPRESSIBLE_RATIO = 0.7      # Amostra que nao cai abaixo disso nao e comprimida
+                                # (base64 de dados ja comprimidos fica em ~0.76)
+
+class FrameError(Exception):
+    """
+    Erro de protocolo: quadro invalido ou maior que o permitido
+    """
+    pass
+
+def encode_frame(payload):
+    """
+    Monta um quadro: cabecalho com o tamanho + payload
+    Aceita str (codificada em utf-8) ou bytes
+    """
+    if isinstance(payload, str):
+        payload = payload.encode(FORMAT)
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError(f"Quadro de {len(payload)} bytes excede o limite de {MAX_FRAME_SIZE}")
+    return HEADER.pack(len(payload)) + payload
+
+def encode_frames(payloads):
+    """
+    Junta varios quadros num unico buffer
+    Permite enviar muitas mensagens com um so sendall (pipelining)
+    """
+    return b"".join(encode_frame(payload) for payload in payloads)
+
+def chunk_crc(data):
+    """
+    CRC32 (sem sinal) dos dados de um pedaco
+    """
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+def encode_chunk_header(transfer_id, offset, length, crc):
+    """
+    Cabecalho do quadro + cabecalho do pedaco para `length` bytes de dados
+    Os dados seguem em um buffer separado (sendfile, memoryview de mmap...),
+    evitando copiar o conteudo do arquivo para montar o quadro
+    """
+    return HEADER.pack(CHUNK_HEADER.size + length) + CHUNK_HEADER.pack(TAG_CHUNK, transfer_id, offset, crc)
+
+def is_chunk(payload):
+    """
+    True se o payload de um quadro e um pedaco binario de arquivo
+    """
+    return payload[:1] == TAG_CHUNK
+
+def decode_chunk(payload):
+    """
+    Separa um pedaco recebido em (id_transferencia, offset, crc, dados)
+    Os dados sao uma memoryview do payload (sem copia); quem recebe confere
+    o crc com chunk_crc(dados)
+    """
+    if len(payload) < CHUNK_HEADER.size:
+        raise FrameError("Pedaço de arquivo truncado")
+    _, transfer_id, offset, crc = CHUNK_HEADER.unpack_from(payload)
+    return transfer_id, offset, crc, memoryview(payload)[CHUNK_HEADER.size:]
+
+def is_envelope(payload):
+    """
+    True se o payload de um quadro e um envelope binario
+    """
+    return payload[:1] == TAG_ENVELOPE
+
+def encode_envelope(message_type, body=b"", control="", sender=0, destination=0, seq=0):
+    """
+    Payload de um envelope binario (ver o formato no inicio do arquivo)
+    """
+    control = control.encode(FORMAT)
+    return ENVELOPE_HEADER.pack(TAG_ENVELOPE, ENVELOPE_CODES[message_type], sender, destination, seq,
+                                len(control)) + control + body
+
+def decode_envelope(payload):
+    """
+    Separa um envelope em (tipo, remetente, destino, seq, controle, corpo)
+    O corpo volta em bytes (quem recebe decide se decodifica)
+    """
+    if len(payload) < ENVELOPE_HEADER.size:
+        raise FrameError("Envelope truncado")
+    _, code, sender, destination, seq, control_size = ENVELOPE_HEADER.unpack_from(payload)
+    start = ENVELOPE_HEADER.size
+    end = start + control_size
+    if not 0 < code <= len(ENVELOPE_TYPES) or end > len(payload):
+        raise FrameError("Envelope inválido")
+    return ENVELOPE_TYPES[code - 1], sender, destination, seq, payload[start:end].decode(FORMAT), payload[end:]
+
+def encode_client_message(message, user_ids):
+    """
+    Envelope de uma mensagem do cliente (dicionario type/control/message)
+    - user_ids: nome -> id dos usuarios ja anunciados pelo servidor; o
+      destinatario vai como id quando conhecido
+    Retorna None se a mensagem tem outros campos (vai em JSON)
+    """
+    body = message.get("message", "")
+    if not message.keys() <= ENVELOPE_FIELDS or message.get("type") not in ENVELOPE_CODES or not isinstance(body, str):
+        return None
+    control = message.get("control") or ""
+    destination = ALL_USERS if control == "4all" else user_ids.get(control, 0)
+    return encode_envelope(message["type"], body.encode(FORMAT), "" if destination else control,
+                           destination=destination)
+
+def decode_client_message(payload, name_of):
+    """
+    Dicionario type/control/message de um envelope do cliente, igual ao do JSON
+    - name_of(id): nome do usuario com esse id (None se nao existe)
+    """
+    message_type, _, destination, _, control, body = decode_envelope(payload)
+    if destination == ALL_USERS:
+        control = "4all"
+    elif destination:
+        control = name_of(destination)
+        if control is None:
+            raise FrameError("Envelope com id de usuário desconhecido")
+    return {"type": message_type, "control": control, "message": body.decode(FORMAT)}
+
+class FrameBuffer:
+    """
+    Buffer de remontagem de quadros
+    - feed() recebe bytes na ordem em que chegaram do socket
+    - Devolve a lista de payloads completos (pode ser vazia)
+    - Bytes de quadros incompletos ficam guardados ate a proxima chamada
+
+    Resolve mensagens que chegam grudadas ou quebradas em varios segmentos TCP.
+    """
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        start = 0
+        available = len(self.buffer)
+        view = memoryview(self.buffer)
+        try:
+            while available - start >= HEADER_SIZE:
+                (size,) = HEADER.unpack_from(self.buffer, start)
+                if size > self.max_frame_size:
+                    raise FrameError(f"Quadro de {size} bytes excede o limite de {self.max_frame_size}")
+                end = start + HEADER_SIZE + size
+                if end > available:
+                    break # Quadro incompleto, aguardar mais dados
+                frames.append(bytes(view[start + HEADER_SIZE:end]))
+                start = end
+        finally:
+            view.release()
+        if start:
+            del self.buffer[:start]
+        return frames
+
+    def pending(self):
+        """
+        Quantidade de bytes aguardando completar um quadro
+        """
+        return len(self.buffer)
+
+class EncodedMessage:
+    """
+    Mensagem do servidor serializada uma unica vez para varios destinatarios
+
+    - payload: bytes utf-8 do texto (modo antigo)
+    - frame(): quadro do modo enquadrado, montado na primeira chamada e
+      reaproveitado por todos os destinatarios seguintes
+    - seq: numero da mensagem no diario de reconexao (None = sem numero);
+      sequenced() e a versao "seq=N||texto" enviada a conexoes com sessao
+    - chat: (remetente, destino, conteudo) das mensagens de chat; enveloped()
+      e a versao em envelope binario
+    Os bytes sao imutaveis: a mesma instancia vai para a fila de saida de
+    cada destinatario sem copia.
+    """
+    __slots__ = ("payload", "is_file", "seq", "chat", "_frame", "_compressed", "_sequenced", "_enveloped")
+
+    def __init__(self, text, seq=None, chat=None):
+        self.payload = text.encode(FORMAT)
+        self.is_file = text.startswith("file=")
+        self.seq = seq
+        self.chat = chat
+        self._frame = None
+        self._compressed = None # id do codec -> quadro comprimido (ou None: nao compensa), ver Compressor
+        self._sequenced = None
+        self._enveloped = None
+
+    @classmethod
+    def from_payload(cls, payload, is_file=False):
+        """
+        Mensagem a partir de bytes ja prontos (variantes numerada, envelope...)
+        """
+        encoded = cls("")
+        encoded.payload = payload
+        encoded.is_file = is_file
+        return encoded
+
+    def bare(self):
+        """
+        Copia so com o texto, seq e chat, sem as versoes ja montadas (quadro,
+        numerada, comprimidas, envelope); os bytes do texto sao compartilhados
+        """
+        encoded = EncodedMessage.from_payload(self.payload, self.is_file)
+        encoded.seq = self.seq
+        encoded.chat = self.chat
+        return encoded
+
+    def sequenced(self):
+        """
+        Versao numerada ("seq=N||texto"), montada uma vez para todos os destinatarios com sessao
+        """
+        if self._sequenced is None:
+            self._sequenced = EncodedMessage.from_payload(f"seq={self.seq}||".encode(FORMAT) + self.payload, self.is_file)
+        return self._sequenced
+
+    def enveloped(self, sender_id, destination_id):
+        """
+        Versao em envelope binario de uma mensagem de chat, montada uma vez
+        (os ids de um nome nao mudam, entao servem a todos os destinatarios)
+        Salas vao no controle (destino 0)
+        """
+        if self._enveloped is None:
+            sender, destination, content = self.chat
+            control = destination if not destination_id else ""
+            self._enveloped = EncodedMessage.from_payload(
+                encode_envelope("msg", content.encode(FORMAT), control, sender_id, destination_id, self.seq or 0))
+        return self._enveloped
+
+    def frame(self):
+        if self._frame is None:
+            self._frame = encode_frame(self.payload)
+        return self._frame
+
+    def for_connection(self, framed):
+        """
+        Bytes prontos para o modo negociado pela conexao
+        """
+        return self.frame() if framed else self.payload
+
+class Codec:
+    """
+    Algoritmo de compressao disponivel para negociacao
+    - name: nome usado no handshake ("zlib", "zstd", "lz4")
+    - id: byte gravado no quadro comprimido
+    """
+    def __init__(self, name, codec_id, compress, decompress):
+        self.name = name
+        self.id = codec_id
+        self.compress = compress
+        self.decompress = decompress # decompress(dados, tamanho_maximo)
+
+def _zlib_decompress(data, max_size):
+    decompressor = zlib.decompressobj()
+    result = decompressor.decompress(data, max_size)
+    if decompressor.unconsumed_tail:
+        raise FrameError(f"Quadro comprimido excede {max_size} bytes")
+    return result
+
+def _stream_decompress(decompressor_class):
+    # zstd e lz4: decompress(dados, max_length) nos objetos de descompressao
+    def decompress(data, max_size):
+        result = decompressor_class().decompress(data, max_size + 1)
+        if len(result) > max_size:
+            raise FrameError(f"Quadro comprimido excede {max_size} bytes")
+        return result
+    return decompress
+
+# Ordem de preferencia: os mais rapidos primeiro
+CODECS = {}
+if zstd is not None:
+    CODECS["zstd"] = Codec("zstd", 2, lambda data: zstd.compress(data, 3), _stream_decompress(zstd.ZstdDecompressor))
+if lz4_frame is not None:
+    CODECS["lz4"] = Codec("lz4", 3, lz4_frame.compress, _stream_decompress(lz4_frame.LZ4FrameDecompressor))
+CODECS["zlib"] = Codec("zlib", 1, lambda data: zlib.compress(data, 6), _zlib_decompress)
+CODEC_IDS = {codec.id: codec for codec in CODECS.values()}
+SUPPORTED_CODECS = list(CODECS) # Oferecidos no handshake, do preferido ao menos preferido
+
+def negotiate_codec(offered):
+    """
+    Escolhe o codec: o primeiro da lista do cliente que tambem suportamos
+    Retorna None se nao ha codec em comum (ou o cliente nao ofereceu nenhum)
+    """
+    if not isinstance(offered, list):
+        return None
+    for name in offered:
+        if name in CODECS:
+            return name
+    return None
+
+def looks_compressible(data):
+    """
+    Comprime uma amostra do meio dos dados com zlib rapido; conteudo ja
+    comprimido (arquivos zip/jpg em base64, por exemplo) nao diminui e e pulado
+    """
+    middle = len(data) // 2
+    sample = bytes(data[max(0, middle - COMPRESS_SAMPLE_BYTES // 2):middle + COMPRESS_SAMPLE_BYTES // 2])
+    return len(zlib.compress(sample, 1)) < len(sample) * INCOMPRESSIBLE_RATIO
+
+def is_compressed(payload):
+    """
+    True se o payload de um quadro e um bloco comprimido de quadros
+    """
+    return payload[:1] == TAG_COMPRESSED
+
+def decompress_payload(payload, max_size=MAX_FRAME_SIZE):
+    """
+    Abre um quadro comprimido e devolve a lista de payloads que ele carrega
+    """
+    codec = CODEC_IDS.get(payload[1]) if len(payload) > 1 else None
+    if codec is None:
+        raise FrameError("Quadro comprimido com codec desconhecido")
+    try:
+        data = codec.decompress(bytes(payload[2:]), max_size)
+    except FrameError:
+        raise
+    except Exception as e:
+        raise FrameError(f"Quadro comprimido inválido: {e}")
+    frame_buffer = FrameBuffer(max_size)
+    payloads = frame_buffer.feed(data)
+    if frame_buffer.pending() or any(is_compressed(inner) for inner in payloads):
+        raise FrameError("Quadro comprimido mal formado")
+    return payloads
+
+class Compressor:
+    """
+    Compressao de saida de uma conexao, com o codec negociado
+
+    Funcionalidades:
+        - frame_payloads(): monta varios payloads num unico envio, comprimidos
+          juntos (historico, rajadas de mensagens)
+        - frame_encoded(): quadro de uma EncodedMessage; o resultado comprimido
+          fica guardado na mensagem, entao um broadcast comprime uma vez por
+          codec, nao uma vez por destinatario
+        - Pula mensagens pequenas e conteudo que ja vem comprimido
+        - stats(): bytes antes/depois, taxa e tempo de CPU gasto comprimindo
+    """
+    def __init__(self, codec_name, min_bytes=COMPRESS_MIN_BYTES):
+        self.codec = CODECS[codec_name]
+        self.min_bytes = min_bytes
+        self._lock = threading.Lock()
+        self.raw_bytes = 0      # Bytes que seriam enviados sem compressao
+        self.wire_bytes = 0     # Bytes efetivamente enviados
+        self.compressed = 0     # Envios comprimidos
+        self.skipped = 0        # Envios grandes que nao compensavam (ja comprimidos)
+        self.cpu_time = 0.0     # Segundos de CPU comprimindo
+        self.raw_in = 0         # Recebidos: bytes depois de descomprimir
+        self.wire_in = 0        # Recebidos: bytes comprimidos
+
+    def _compress(self, plain):
+        # Retorna o quadro comprimido, ou None se nao compensa
+        if len(plain) < self.min_bytes:
+            return None
+        started = time.thread_time()
+        frame = None
+        if looks_compressible(plain):
+            body = self.codec.compress(plain)
+            if len(body) + HEADER_SIZE + 2 < len(plain):
+                frame = encode_frame(TAG_COMPRESSED + bytes((self.codec.id,)) + body)
+        elapsed = time.thread_time() - started
+        with self._lock:
+            self.cpu_time += elapsed
+            if frame is None:
+                self.skipped += 1
+        return frame
+
+    def _account(self, plain, frame):
+        with self._lock:
+            self.raw_bytes += len(plain)
+            if frame is None:
+                self.wire_bytes += len(plain)
+                return plain
+            self.compressed += 1
+            self.wire_bytes += len(frame)
+            return frame
+
+    def frame_payloads(self, payloads):
+        """
+        Quadros prontos para uma lista de payloads (bytes), comprimidos juntos
+        """
+        plain = encode_frames(payloads)
+        return self._account(plain, self._compress(plain))
+
+    def frame_encoded(self, encoded):
+        """
+        Quadro de uma EncodedMessage, reaproveitando a compressao ja feita
+        para outro destinatario com o mesmo codec
+        """
+        plain = encoded.frame()
+        if encoded._compressed is None:
+            encoded._compressed = {}
+        if self.codec.id not in encoded._compressed:
+            encoded._compressed[self.codec.id] = self._compress(plain)
+        return self._account(plain, encoded._compressed[self.codec.id])
+
+    def count_inbound(self, wire_size, payloads):
+        """
+        Contabiliza um quadro comprimido recebido
+        """
+        with self._lock:
+            self.wire_in += wire_size
+            self.raw_in += sum(len(payload) + HEADER_SIZE for payload in payloads)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "codec": self.codec.name,
+                "raw_bytes": self.raw_bytes,
+                "wire_bytes": self.wire_bytes,
+                "ratio": self.wire_bytes / self.raw_bytes if self.raw_bytes else 1.0,
+                "compressed": self.compressed,
+                "skipped": self.skipped,
+                "cpu_ms": self.cpu_time * 1000,
+                "raw_in": self.raw_in,
+                "wire_in": self.wire_in
+            }
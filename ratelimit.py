@@ -0,0 +1,128 @@
+#ratelimit.py
+
+import time
+import threading
+
+class TokenBucket:
+    """
+    Balde de fichas: `rate` fichas por segundo, acumulando ate `burst`
+    Permite rajadas curtas (ate burst) e limita a media em `rate`
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount=1):
+        """
+        Tira `amount` fichas se houver
+        Retorna 0.0 se tirou, ou os segundos ate haver fichas (nada e tirado)
+        """
+        self._refill(time.monotonic())
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount):
+        """
+        Tira `amount` fichas mesmo sem saldo (o balde fica devendo)
+        Retorna os segundos que quem consumiu deve esperar para zerar a divida
+        (usado para bytes de arquivo: o envio desacelera em vez de falhar)
+        """
+        self._refill(time.monotonic())
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+class ConnectionLimits:
+    """
+    Limites de uma conexao (um registro por conexao, so a thread/loop que le
+    a conexao mexe nele, entao nao ha lock)
+
+    Funcionalidades:
+        - check(tipo): uma mensagem passa pelo balde geral ("*") e pelo balde
+          do seu tipo, se houver. Mensagem recusada nao gasta fichas
+        - file_bytes(n): bytes de arquivo recebidos; retorna quanto tempo
+          parar de ler a conexao para ficar dentro do limite
+        - strikes: recusas seguidas (zera quando uma mensagem passa), para
+          derrubar quem insiste
+        - should_notify(): no maximo um aviso por segundo ao cliente
+
+    Attributes:
+        message_limits (dict): tipo -> (mensagens/s, rajada); "*" vale para
+            todas as mensagens. Vazio = sem limite de mensagens
+        file_limit (tuple): (bytes/s, rajada) ou None = sem limite
+    """
+    def __init__(self, message_limits, file_limit=None):
+        self.buckets = {message_type: TokenBucket(rate, burst) for message_type, (rate, burst) in message_limits.items()}
+        self.all = self.buckets.pop("*", None)
+        self.files = TokenBucket(*file_limit) if file_limit else None
+        self.strikes = 0
+        self.rejected = 0
+        self.throttled_s = 0.0
+        self.notified = 0.0
+
+    def check(self, message_type):
+        """
+        Retorna 0.0 se a mensagem pode ser processada, ou os segundos ate poder
+        """
+        bucket = self.buckets.get(message_type)
+        wait = bucket.take() if bucket is not None else 0.0
+        if not wait and self.all is not None:
+            wait = self.all.take()
+            if wait and bucket is not None:
+                bucket.tokens += 1 # Devolve a ficha do tipo: a mensagem nao passou
+        if wait:
+            self.strikes += 1
+            self.rejected += 1
+        else:
+            self.strikes = 0
+        return wait
+
+    def file_bytes(self, amount):
+        if self.files is None:
+            return 0.0
+        wait = self.files.consume(amount)
+        self.throttled_s += wait
+        return wait
+
+    def should_notify(self):
+        now = time.monotonic()
+        if now - self.notified < 1.0:
+            return False
+        self.notified = now
+        return True
+
+class AdmissionControl:
+    """
+    Limite de conexoes simultaneas do processo
+    admit() ao aceitar, release() quando a conexao admitida termina
+    """
+    def __init__(self, max_connections):
+        self.max_connections = max_connections # 0 = sem limite
+        self.active = 0
+        self.refused = 0
+        self._lock = threading.Lock()
+
+    def admit(self):
+        with self._lock:
+            if self.max_connections and self.active >= self.max_connections:
+                self.refused += 1
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+
+    def stats(self):
+        with self._lock:
+            return {"active": self.active, "max": self.max_connections, "refused": self.refused}
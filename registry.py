@@ -0,0 +1,110 @@
+#registry.py
+
+import threading
+
+class ConnectionRegistry:
+    """
+    Registro dos usuarios conectados, indexado por nome e por socket
+
+    Funcionalidades:
+        - Busca por nome ou por socket em O(1) (dicionarios)
+        - Entrada e saida de usuarios em O(1), protegidas por lock
+        - Verificacao de nome duplicado e registro numa unica operacao atomica
+          (duas threads nao conseguem registrar o mesmo nome)
+        - snapshot(): tupla imutavel com os usuarios conectados, para iterar
+          durante broadcasts sem lock enquanto outros entram e saem
+
+    O snapshot e copy-on-write preguicoso: entradas/saidas apenas invalidam a
+    tupla, que e reconstruida uma vez no proximo snapshot().
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_name = {}    # nome -> registro da conexao
+        self._by_socket = {}  # socket -> registro da conexao
+        self._snapshot = ()   # None = invalidado por entrada/saida
+
+    def register(self, client_connection):
+        """
+        Registra a conexao com o nome em client_connection["name"]
+        Retorna False (sem registrar) se o nome ja estiver em uso
+        """
+        name = client_connection["name"]
+        with self._lock:
+            if name in self._by_name:
+                return False
+            self._by_name[name] = client_connection
+            self._by_socket[client_connection["conn"]] = client_connection
+            self._snapshot = None
+            return True
+
+    def unregister(self, client_connection):
+        """
+        Remove a conexao do registro
+        Retorna False se ela nao estava registrada
+        """
+        with self._lock:
+            if self._by_name.get(client_connection["name"]) is not client_connection:
+                return False
+            del self._by_name[client_connection["name"]]
+            self._by_socket.pop(client_connection["conn"], None)
+            self._snapshot = None
+            return True
+
+    def get(self, name):
+        """
+        Retorna o registro do usuario com este nome ou None
+        """
+        return self._by_name.get(name)
+
+    def get_by_socket(self, conn):
+        """
+        Retorna o registro associado ao socket ou None
+        """
+        return self._by_socket.get(conn)
+
+    def snapshot(self):
+        """
+        Tupla estavel com todos os registros conectados
+        Pode ser percorrida sem lock mesmo com usuarios entrando e saindo
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = tuple(self._by_name.values())
+                snapshot = self._snapshot
+        return snapshot
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def __len__(self):
+        return len(self._by_name)
+
+class UserIds:
+    """
+    Ids numericos dos nomes de usuario, usados no envelope binario (protocol.py)
+    - id(nome): o mesmo id para o mesmo nome enquanto o servidor rodar (1, 2, ...)
+    - name(id): nome de um id ja atribuido (None se nao existe)
+    Ids nao sao reaproveitados: um nome que volta recebe o id de antes.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = {}        # nome -> id
+        self._names = [None]  # id -> nome (o id 0 e "nenhum")
+
+    def id(self, name):
+        user_id = self._ids.get(name)
+        if user_id is None:
+            with self._lock:
+                user_id = self._ids.get(name)
+                if user_id is None:
+                    user_id = self._ids[name] = len(self._names)
+                    self._names.append(name)
+        return user_id
+
+    def name(self, user_id):
+        return self._names[user_id] if 0 < user_id < len(self._names) else None
+
+    def __len__(self):
+        return len(self._names) - 1
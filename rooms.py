@@ -0,0 +1,118 @@
+#rooms.py
+
+import re
+import threading
+from collections import OrderedDict
+
+from registry import ConnectionRegistry
+from history import GlobalHistory
+
+DEFAULT_ROOM = "4all" # Sala padrao: todos os usuarios, historico global (server.py)
+ROOM_NAME = re.compile(r"#[A-Za-z0-9_-]{1,32}")
+
+def normalize_room(name):
+    """
+    "sala" ou "#sala" -> "#sala"; None se o nome nao e valido
+    """
+    if not isinstance(name, str):
+        return None
+    name = name.strip()
+    if not name.startswith("#"):
+        name = "#" + name
+    return name if ROOM_NAME.fullmatch(name) else None
+
+class Room:
+    """
+    Uma sala: os membros (fan-out apenas para eles) e o seu proprio historico
+    - members: ConnectionRegistry, entrada/saida em O(1) e snapshot() estavel
+      para o envio sem lock
+    - history: GlobalHistory so em memoria, com limites proprios
+    """
+    def __init__(self, name, history):
+        self.name = name
+        self.members = ConnectionRegistry()
+        self.history = history
+
+class RoomRegistry:
+    """
+    Salas nomeadas ("#nome") criadas sob demanda
+
+    Funcionalidades:
+        - join/leave de uma conexao; client_connection["rooms"] guarda as
+          salas da conexao, para sair de todas ao desconectar (leave_all)
+        - Uma mensagem numa sala de 10 pessoas custa 10 envios, nao um por
+          usuario conectado
+        - Sala vazia mantem o historico; passando de max_rooms, sai a sala
+          vazia usada ha mais tempo (sem sala vazia, open() recusa)
+    """
+    def __init__(self, max_rooms=1000, history_messages=200, history_bytes=4 * 1024 * 1024):
+        self.max_rooms = max_rooms
+        self.history_messages = history_messages
+        self.history_bytes = history_bytes
+        self._lock = threading.Lock()
+        self._rooms = OrderedDict() # nome -> Room, da usada ha mais tempo para a mais recente
+
+    def get(self, name):
+        return self._rooms.get(name)
+
+    def open(self, name):
+        """
+        Retorna a sala (criando se preciso); None se o limite de salas foi atingido
+        """
+        with self._lock:
+            room = self._rooms.get(name)
+            if room is None:
+                if len(self._rooms) >= self.max_rooms and not self._evict_empty():
+                    return None
+                room = self._rooms[name] = Room(name, GlobalHistory(self.history_messages, self.history_bytes))
+            self._rooms.move_to_end(name)
+            return room
+
+    def _evict_empty(self):
+        for name, room in self._rooms.items():
+            if not len(room.members):
+                del self._rooms[name]
+                return True
+        return False
+
+    def join(self, name, client_connection):
+        """
+        Coloca a conexao na sala
+        Retorna (sala, True se entrou agora); (None, False) sem espaco para salas novas
+        """
+        room = self.open(name)
+        if room is None:
+            return None, False
+        joined = room.members.register(client_connection)
+        if joined:
+            client_connection["rooms"].add(name)
+        return room, joined
+
+    def leave(self, name, client_connection):
+        """
+        Tira a conexao da sala; False se ela nao estava na sala
+        """
+        room = self._rooms.get(name)
+        if room is None or not room.members.unregister(client_connection):
+            return False
+        client_connection["rooms"].discard(name)
+        return True
+
+    def leave_all(self, client_connection):
+        for name in list(client_connection["rooms"]):
+            self.leave(name, client_connection)
+
+    def listing(self):
+        """
+        [(nome, membros)] das salas existentes
+        """
+        with self._lock:
+            return [(name, len(room.members)) for name, room in self._rooms.items()]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rooms": len(self._rooms),
+                "members": sum(len(room.members) for room in self._rooms.values()),
+                "history_messages": sum(len(room.history) for room in self._rooms.values())
+            }
@@ -0,0 +1,162 @@
+#search.py
+
+import re
+import time
+import bisect
+import threading
+from array import array
+
+WORD_PATTERN = re.compile(r"[^\W_]+") # Letras e digitos (acentos incluidos); "_" separa, como nos nomes de arquivo
+MAX_WORD_LENGTH = 32 # Palavras maiores sao cortadas (indice e consulta cortam igual)
+FIRST_WINDOW = 1024  # Mensagens na primeira janela da busca (as seguintes dobram)
+
+def tokenize(text):
+    """
+    Palavras de um texto, em minusculas e sem repeticao
+    """
+    if not text:
+        return set()
+    return {word[:MAX_WORD_LENGTH] for word in WORD_PATTERN.findall(text.lower())}
+
+def contains(posting, number):
+    position = bisect.bisect_left(posting, number)
+    return position < len(posting) and posting[position] == number
+
+class SearchIndex:
+    """
+    Indice invertido das mensagens (termo -> numeros das mensagens que o contem)
+
+    Funcionalidades:
+        - add(): indexa uma mensagem nova; chamado pelos historicos a cada
+          append, sem reconstruir nada
+        - Termos: palavras do conteudo (mensagens de texto) e do nome do
+          arquivo, "file:palavra" (so nomes de arquivo) e "@remetente"
+        - Mensagens globais ficam visiveis para todos; privadas, so para o
+          remetente e o destinatario (os termos delas sao indexados por usuario)
+        - search(): mensagens com todas as palavras e filtros, da mais nova
+          para a mais antiga, em paginas (cursor = numero da ultima mensagem)
+        - Acima de max_messages, o quarto mais antigo do indice e descartado
+
+    Cada lista de termo e um array crescente de numeros: a busca corta as
+    listas por busca binaria e intersecta so o trecho da janela atual, da
+    mais nova para a mais antiga, parando ao encher a pagina. Os horarios
+    ficam num array crescente pela posicao, entao o filtro de periodo vira
+    um intervalo de numeros. De cada mensagem guarda so o id no seu
+    historico (global ou privado), lida de la ou do log ao mostrar o resultado.
+    """
+    def __init__(self, max_messages=5000000):
+        self.max_messages = max_messages
+        self._postings = {}   # termo -> array("I") de numeros de mensagem, crescente
+        self._ts = array("d") # Horario de cada mensagem, pela posicao (nunca decresce)
+        self._refs = array("q") # Id da mensagem: positivo = historico global, negativo = historico privado
+        self._base = 0        # Numero da primeira mensagem ainda no indice
+        self._lock = threading.Lock()
+        self.searches = 0
+        self.dropped = 0
+
+    @staticmethod
+    def terms_of(message):
+        words = tokenize(message.get("content")) if message["type"] == "msg" else set()
+        file_words = tokenize(message.get("filename")) if message["type"] == "file" else set()
+        terms = words | file_words | {"file:" + word for word in file_words}
+        terms.add("@" + message["sender"].lower())
+        terms.add("") # Todas as mensagens (busca so com periodo)
+        return terms
+
+    def add(self, message, private=False):
+        """
+        Indexa uma mensagem do historico global ou privado (private=True), com o "id" de la
+        """
+        terms = self.terms_of(message)
+        if private:
+            # Visivel so para os dois lados da conversa: "usuario\0termo"
+            terms = {f"{user}\0{term}" for user in {message["sender"], message["destination"]} for term in terms}
+        with self._lock:
+            number = self._base + len(self._ts)
+            last = self._ts[-1] if self._ts else 0.0
+            self._ts.append(max(message.get("ts") or time.time(), last))
+            self._refs.append(-message["id"] if private else message["id"])
+            for term in terms:
+                posting = self._postings.get(term)
+                if posting is None:
+                    posting = self._postings[term] = array("I")
+                posting.append(number)
+            if len(self._ts) > self.max_messages:
+                self._drop_oldest(len(self._ts) // 4)
+
+    def _drop_oldest(self, count):
+        cut = self._base + count
+        del self._ts[:count]
+        del self._refs[:count]
+        self._base = cut
+        self.dropped += count
+        for term, posting in list(self._postings.items()):
+            position = bisect.bisect_left(posting, cut)
+            if position == len(posting):
+                del self._postings[term]
+            elif position:
+                del posting[:position]
+
+    def _match(self, terms, low, high, limit):
+        # Numeros em [low, high) presentes em todas as listas, do maior para o menor
+        # Janelas dobrando a partir do fim: termo comum para logo, termo raro
+        # cobre o intervalo em poucas janelas; a interseccao de cada janela e
+        # feita em C (set), ou por busca binaria se uma lista e bem maior
+        postings = [self._postings.get(term) for term in terms]
+        if not postings or None in postings:
+            return []
+        postings.sort(key=len)
+        found = []
+        window = FIRST_WINDOW
+        while high > low and len(found) < limit:
+            window_low = max(low, high - window)
+            matches = None
+            for posting in postings:
+                part = posting[bisect.bisect_left(posting, window_low):bisect.bisect_left(posting, high)]
+                if matches is None:
+                    matches = set(part)
+                elif len(part) > 8 * len(matches):
+                    matches = {number for number in matches if contains(part, number)}
+                else:
+                    matches.intersection_update(part)
+                if not matches:
+                    break
+            found += sorted(matches, reverse=True)
+            high = window_low
+            window *= 2
+        return found[:limit]
+
+    def search(self, name, words="", sender=None, filename=None, since=None, until=None, before=None, limit=20):
+        """
+        Busca para o usuario `name`: mensagens globais e as privadas dele
+        - words: todas as palavras precisam estar na mensagem (ou no nome do arquivo)
+        - sender: so mensagens desse remetente
+        - filename: so arquivos com todas essas palavras no nome
+        - since/until: periodo (horario unix)
+        - before: cursor da pagina anterior (so mensagens mais antigas que ele)
+        Retorna ([(id, privada, horario)], cursor da proxima pagina ou 0)
+        """
+        terms = tokenize(words) | {"file:" + word for word in tokenize(filename)}
+        if sender:
+            terms.add("@" + sender.lower())
+        if not terms:
+            terms.add("")
+        with self._lock:
+            self.searches += 1
+            low = self._base + (bisect.bisect_left(self._ts, since) if since is not None else 0)
+            high = self._base + (bisect.bisect_right(self._ts, until) if until is not None else len(self._ts))
+            if before is not None:
+                high = min(high, before)
+            found = self._match(terms, low, high, limit + 1)
+            found += self._match({f"{name}\0{term}" for term in terms}, low, high, limit + 1)
+            found.sort(reverse=True)
+            page = found[:limit]
+            results = [(abs(self._refs[number - self._base]), self._refs[number - self._base] < 0, self._ts[number - self._base])
+                       for number in page]
+        return results, page[-1] if len(found) > limit else 0
+
+    def stats(self):
+        with self._lock:
+            return {"messages": len(self._ts), "terms": len(self._postings),
+                    "postings": sum(len(posting) for posting in self._postings.values()),
+                    "searches": self.searches, "dropped": self.dropped}
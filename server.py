@@ -4,21 +4,160 @@ import socket
 import threading
 import time
 import json
+import argparse
+import itertools
+import mmap
+import os
+import base64
+import signal
+
+from collections import OrderedDict
+
+from protocol import (FRAMED_MAGIC, RECV_SIZE, CHUNK_SIZE, FrameBuffer, FrameError, EncodedMessage, Compressor,
+                      encode_frame, encode_chunk_header, is_chunk, decode_chunk, chunk_crc,
+                      is_compressed, decompress_payload, negotiate_codec,
+                      ENVELOPE_VERSION, ALL_USERS, is_envelope, encode_envelope, decode_client_message)
+from registry import ConnectionRegistry, UserIds
+from history import GlobalHistory, PrivateHistory, log_record, TRANSIENT_FIELDS
+from filestore import FileStore
+from messagelog import MessageLog, FSYNC_POLICIES, FSYNC_BATCH
+from outbound import OutboundQueue, POLICIES, DROP_OLDEST
+from bus import BusHub, WorkerBus, PERSIST_WORKER
+from federation import Federation
+from metrics import Metrics, start_http as start_metrics_http
+from presence import Presence
+from rooms import RoomRegistry, DEFAULT_ROOM, normalize_room
+from ratelimit import ConnectionLimits, AdmissionControl
+from timerwheel import TimerWheel
+from sessions import ReplayJournal, SessionRegistry
+from search import SearchIndex
+from asynclog import logger, LEVELS, INFO
 
 # FORMATO DAS MENSAGENS:
 # 
 # Cliente -> Servidor (JSON):
 # {
-#   "type": "name|msg|file|online_usr",
-#   "control": "destinatario|4all|dontcare", 
-#   "message": "conteudo",
-#   "filename": "nome_arquivo" (apenas para files)
+#   "type": "name|resume|msg|file|online_usr|presence|room|history|search|file_get|file_begin|file_end|metrics|ping|pong",
+#   "control": "destinatario|4all|#sala|dontcare" (room: "join|leave|list" | resume: token da sessao), 
+#   "message": "conteudo" (history: cursor | file_get: id do arquivo |
+#              file_begin/file_end: id da transferencia escolhido pelo cliente |
+#              presence: "subscribe" ou "unsubscribe" | room: nome da sala |
+#              resume: ultimo seq recebido | search: palavras buscadas),
+#   "offset": bytes ja recebidos (opcional, file_get: retomar o download),
+#   "filename": "nome_arquivo" (apenas para files),
+#   "size": tamanho_em_bytes (apenas para file_begin),
+#   "sha256": hash_do_conteudo (opcional, file_begin: permite pular o envio),
+#   "compression": ["zstd", "zlib", ...] (opcional, name: codecs aceitos, do preferido ao menos),
+#   "heartbeat": true (opcional, name: o cliente responde "ping=" com o tipo "pong"),
+#   "resume": true (opcional, name: o cliente quer uma sessao retomavel),
+#   "envelope": ["bin1"] (opcional, name: formatos de envelope binario aceitos),
+#   "sender", "filename", "since", "until", "cursor" (opcionais, search: remetente,
+#              palavras do nome do arquivo, periodo em horario unix, pagina anterior)
 # }
 #
 # Servidor -> Cliente (string):
 # "msg=conteudo_da_mensagem"
 # "file=remetente||nome_arquivo||dados_base64"
+# "file_ref=remetente||nome_arquivo||id||tamanho||sha256" (arquivo grande no historico)
+# "history_cursor=id" (fim de uma pagina de historico, so no modo enquadrado; 0 = sem mais paginas)
+# "room_cursor=#sala||id" (o mesmo, para o historico de uma sala)
+# "rooms=json_array_salas" (resposta ao room/list: [{"name", "members", "joined"}])
 # "online_users=json_array_usuarios"
+# "presence={"version": n, "users": [...]}" (assinatura: todos os usuarios, inclusive o proprio)
+# "presence_delta={"op": "join|leave", "name", "addr", "version": n}" (versao pulada = pedir snapshot de novo)
+# "file_accept=id_cliente||id_transferencia||offset" (offset > 0: envio retomado)
+# "file_reject=id_cliente||motivo"
+# "file_ack=id_cliente||offset" (bytes confirmados) / "file_retry=id_cliente||offset"
+# "file_exists=id_cliente" (o servidor ja tem o conteudo: envio dispensado)
+# "file_done=id_cliente" (envio concluido)
+# "file_begin=remetente||nome_arquivo||id_transferencia||tamanho||sha256||offset"
+# "file_end=id_transferencia" / "file_abort=id_transferencia||motivo"
+# "compression=codec" (resposta ao name: dai em diante quadros podem vir comprimidos)
+# "envelope=bin1" (resposta ao name: dai em diante os dois lados podem usar o envelope binario)
+# "ping=valor" (heartbeat: responder {"type": "pong", "message": valor}) / "pong=valor" (resposta ao tipo "ping")
+# "session=token||seq" (resposta ao name com resume: token da sessao e ultimo seq ja enviado)
+# "seq=N||mensagem" (mensagem de chat numerada, so para conexoes com sessao)
+# "resumed=N" (sessao retomada: seguem as N mensagens perdidas) / "resumed=history" (perdeu demais: historico)
+# "resume_failed=motivo" (sessao expirada ou invalida: registrar o nome de novo)
+# "search={"results": [{"id", "ts", "sender", "destination", "type", "content", "filename"}], "cursor": n}"
+#   (resposta ao search, da mais nova para a mais antiga; cursor 0 = sem mais paginas)
+#
+# Modo enquadrado (opcional): se o cliente enviar o preambulo FRAMED_MAGIC
+# logo apos conectar, todas as mensagens acima viajam dentro de quadros
+# com cabecalho de tamanho (ver protocol.py). Sem o preambulo, modo antigo.
+#
+# Arquivos no modo enquadrado (sem base64): o cliente envia file_begin, espera
+# file_accept, manda os dados em quadros de pedaco binario (protocol.py) com o
+# seu id e termina com file_end. O servidor repassa cada pedaco aos
+# destinatarios assim que chega (file_begin, pedacos, file_end), com o seu
+# proprio id de transferencia; nada e acumulado em memoria. O tipo "file"
+# (base64 em JSON) continua valendo para clientes no modo antigo.
+# Todo arquivo recebido vai para o armazenamento por conteudo (filestore.py):
+# se o sha256 informado no file_begin ja existe, o envio e dispensado
+# (file_exists) e os destinatarios recebem a copia do disco.
+# Retomada: se o remetente cai no meio do envio, o que ja chegou fica guardado
+# (por remetente + sha256); o proximo file_begin do mesmo arquivo recebe o
+# offset de onde continuar. Cada pedaco leva um CRC32: pedaco corrompido gera
+# file_retry e o cliente reenvia a partir dali. Downloads retomam com o
+# "offset" do file_get.
+#
+# Compressao (modo enquadrado): o cliente oferece codecs no "name"; o servidor
+# escolhe o primeiro que tambem suporta e responde "compression=codec". A partir
+# dai os dois lados podem mandar quadros comprimidos (protocol.py), usados so
+# para mensagens grandes o bastante e que ainda nao vem comprimidas. Pedacos de
+# arquivo nunca sao comprimidos.
+#
+# Envelope binario (modo enquadrado): o cliente oferece "envelope" no "name" e,
+# aceito, pode mandar mensagens simples (type/control/message) num envelope
+# com cabecalho fixo em vez de JSON; o servidor manda as mensagens de chat no
+# envelope, com ids numericos no lugar dos nomes (anunciados uma vez por
+# conexao). O formato esta em protocol.py; o JSON e o texto continuam valendo.
+#
+# Modo multiprocesso (--workers N): N processos aceitam conexoes na mesma porta
+# (SO_REUSEPORT) e trocam mensagens globais, privadas e presenca por um
+# barramento local (bus.py). Para os clientes continua sendo um unico chat.
+#
+# Federacao (--federation-port, --peer): varios servidores, em maquinas
+# diferentes, formam um unico chat (federation.py). Cada no conhece os usuarios
+# dos outros; mensagens privadas vao direto ao no do destinatario e cada
+# mensagem global ou arquivo atravessa cada ligacao uma unica vez. Cada no
+# mantem o seu proprio historico (os ids nao coincidem entre nos). As ligacoes
+# entre nos sao autenticadas por um segredo compartilhado (--federation-secret).
+#
+# Metricas (metrics.py): contagem, bytes e latencia por tipo de mensagem, mais
+# conexoes, filas de saida e memoria do historico. Pedidas com o tipo
+# administrativo "metrics" (so da propria maquina, resposta "metrics=json") ou
+# no endpoint HTTP local (--metrics-port): /metrics (texto) e /metrics.json.
+#
+# Limites (ratelimit.py): cada conexao tem baldes de fichas por tipo de
+# mensagem (RATE_LIMITS); mensagem acima do limite e descartada com um aviso
+# "msg=[Servidor]: ..." (no maximo um por segundo) e quem insiste e desconectado.
+# Bytes de arquivo acima de FILE_RATE_BYTES nao sao recusados: a conexao para
+# de ser lida por um tempo e o envio desacelera. Acima de MAX_CONNECTIONS, a
+# conexao recebe um aviso de servidor cheio e e encerrada.
+#
+# Heartbeats: quem pede "heartbeat" no name recebe "ping=" depois de
+# HEARTBEAT_INTERVAL segundos sem mandar nada; sem nenhum dado por
+# HEARTBEAT_TIMEOUT, a conexao e dada como morta e encerrada (sai da lista de
+# usuarios e dos envios). Conexao que nao registra um nome em NAME_TIMEOUT
+# tambem e encerrada. Os prazos ficam numa roda de temporizadores (timerwheel.py).
+#
+# Log (asynclog.py): as linhas vao para uma fila limitada esvaziada por uma
+# thread propria; nenhum envio espera pela saida padrao. Linhas por mensagem
+# podem ser amostradas (--log-sample) e, com a fila cheia, sao descartadas e contadas.
+#
+# Reconexao (sessions.py): quem pede "resume" no name recebe um token de sessao
+# e as mensagens de chat (globais, privadas e de salas) chegam como "seq=N||...".
+# Se a conexao cair, a sessao espera SESSION_GRACE segundos: o cliente reconecta
+# com o tipo "resume" (token + ultimo seq recebido), volta com o mesmo nome e as
+# mesmas salas e recebe so as mensagens depois desse seq, guardadas num diario
+# limitado em memoria. Mensagens privadas enviadas nesse intervalo tambem ficam
+# no diario. Desligado no modo --workers (a reconexao pode cair em outro processo).
+#
+# Busca (search.py): o tipo "search" procura no historico global e nas
+# mensagens privadas do proprio usuario por palavras, remetente, nome de
+# arquivo e periodo. Um indice invertido e atualizado a cada mensagem que
+# entra no historico (e montado a partir do log no reinicio).
 
 def handle_discovery():
     """
@@ -37,10 +176,10 @@ def handle_discovery():
             try:
                 data, addr = discover_socket.recvfrom(1024)
                 if data == b"CHAT_DISCOVER":
-                    print(f"[Descoberta] Requisição de {addr[0]}")
+                    logger.info("Descoberta", "Requisição de {}", addr[0], sample=True)
                     discover_socket.sendto(b"CHAT_SERVER", addr)
             except Exception as e:
-                print(f"[Erro Descoberta] {e}")
+                logger.error("Erro Descoberta", f"{e}")
                 break
     
     # Inicia thread separada para descoberta em background
@@ -51,325 +190,1994 @@ SERVER_IP = "0.0.0.0" # Aceita conexoes de qualquer IP
 PORT = 5050 # Porta principal do chat
 ADDR = (SERVER_IP, PORT)
 FORMAT = 'utf-8'          # Codificação de caracteres
+HISTORY_MAX_MESSAGES = 1000            # Limite de mensagens no historico global
+HISTORY_MAX_BYTES = 64 * 1024 * 1024   # Orcamento de memoria do historico global
+HISTORY_SPILL_DIR = "history_spill"    # Onde payloads antigos de arquivos sao gravados (None = descartar)
+HISTORY_PAGE_SIZE = 50                 # Mensagens por pagina de historico (replay ao entrar e pedidos "history")
+HISTORY_INLINE_FILE_BYTES = 64 * 1024  # Arquivos maiores (base64) vao no replay apenas como referencia
+PRIVATE_HISTORY_MESSAGES = 100000      # Mensagens privadas em memoria (todas as conversas; as demais ficam no log)
+PRIVATE_HISTORY_BYTES = 64 * 1024 * 1024 # Orcamento de memoria do historico privado
+PRIVATE_CONVERSATION_MESSAGES = 1000   # Mensagens em memoria por conversa
+OUTBOUND_MAX_ITEMS = 1000              # Mensagens pendentes por cliente antes de aplicar a politica
+OUTBOUND_MAX_BYTES = 16 * 1024 * 1024  # Bytes pendentes por cliente antes de aplicar a politica
+OUTBOUND_POLICY = DROP_OLDEST          # drop_oldest | drop_files | disconnect (ver outbound.py)
+FILE_STORE_DIR = "file_store"          # Armazenamento de arquivos por conteudo (sha256)
+RELIABLE_SEND_TIMEOUT = 30             # Segundos esperando espaco na fila de um destinatario (pedacos)
+FILE_ACK_BYTES = 1024 * 1024           # Confirma ao remetente (file_ack) a cada tantos bytes recebidos
+PARTIAL_UPLOADS_MAX = 32               # Envios interrompidos guardados para retomada
+WORKERS = 1                            # Processos aceitando conexoes (modo multiprocesso se > 1)
+MESSAGE_LOG_DIR = "message_log"        # Log persistente das mensagens (None = historico so em memoria)
+MESSAGE_LOG_FSYNC = FSYNC_BATCH        # always | batch | interval | never (ver messagelog.py)
+FEDERATION_PORT = None                 # Porta de ligacao com outros servidores (None = sem federacao)
+FEDERATION_HOST = "127.0.0.1"          # Endereco da porta de federacao (outro endereco exige o segredo)
+FEDERATION_SECRET = os.environ.get("CHAT_FEDERATION_SECRET", "") # Segredo compartilhado pelos nos
+METRICS_PORT = None                    # Endpoint HTTP local de metricas (None = desligado)
+ROOMS_MAX = 1000                       # Salas existentes ao mesmo tempo (vazias saem primeiro)
+ROOM_HISTORY_MESSAGES = 200            # Historico (em memoria) de cada sala
+ROOM_HISTORY_BYTES = 4 * 1024 * 1024
+MAX_CONNECTIONS = 10000                # Conexoes simultaneas por processo (0 = sem limite)
+LISTEN_BACKLOG = 1024                  # Fila de conexoes ainda nao aceitas (o kernel limita a somaxconn)
+RATE_LIMITS = {                        # Tipo -> (mensagens/s, rajada) por conexao; "*" = todas as mensagens
+    "*": (50, 100),
+    "msg": (20, 40),                   # Cada mensagem global vira um envio por usuario
+    "file": (2, 4),
+    "file_begin": (5, 10),
+    "online_usr": (5, 10),
+    "history": (10, 20),
+    "search": (5, 10),
+    "file_get": (10, 20),
+    "room": (10, 20)
+}
+FILE_RATE_BYTES = 32 * 1024 * 1024     # Bytes de arquivo/s por conexao (None = sem limite); rajada de 2 s
+RATE_LIMIT_DISCONNECT = 200            # Mensagens recusadas seguidas antes de desconectar
+REFUSE_THREADS = 16                    # Conexoes recusadas recebendo o aviso ao mesmo tempo (demais sao so fechadas)
+REFUSE_TIMEOUT = 2                     # Segundos esperando o handshake de uma conexao recusada
+HEARTBEAT_INTERVAL = 30                # Segundos sem receber nada antes de mandar ping (0 = sem heartbeat)
+HEARTBEAT_TIMEOUT = 90                 # Segundos sem receber nada ate encerrar a conexao
+NAME_TIMEOUT = 60                      # Segundos para uma conexao registrar o nome (0 = sem limite)
+HEARTBEAT_TICK = 1                     # Resolucao da roda de temporizadores (segundos)
+KEEPALIVE_IDLE = 60                    # TCP keepalive (conexoes sem heartbeat): segundos ociosa ate a primeira sonda
+KEEPALIVE_INTERVAL = 15                # Segundos entre sondas sem resposta
+KEEPALIVE_COUNT = 4                    # Sondas sem resposta ate o SO derrubar a conexao
+LOG_QUEUE_LINES = 10000                # Linhas aguardando a escritora do log (asynclog.py); alem disso, descartadas
+SEARCH_PAGE_SIZE = 20                  # Resultados por pagina de busca
+SEARCH_MAX_MESSAGES = 2000000          # Mensagens no indice de busca (alem disso, as mais antigas saem)
+SESSION_GRACE = 120                    # Segundos que uma sessao desconectada espera a reconexao (0 = sem sessoes)
+JOURNAL_MESSAGES = 10000               # Mensagens guardadas para reenviar a quem reconecta
+JOURNAL_BYTES = 16 * 1024 * 1024
+METRIC_MESSAGE_TYPES = {"name", "msg", "file", "online_usr", "history", "file_get",
+                        "file_begin", "file_end", "metrics", "presence", "room", "search"} # Demais tipos contam como "other"
 
 server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.bind(ADDR)
+server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
 # Estruturas de dados globais
-connections = []     # Lista de usuarios conectados: [{"conn": socket, "addr": tuple, "name": str}]
-global_messages = []  # Historico de mensagens publicas
-private_messages = [] # Historico de mensagens privadas
+connections = ConnectionRegistry() # Usuarios conectados, indexados por nome e socket (registros de new_connection)
+user_ids = UserIds() # Ids numericos dos nomes (envelope binario)
+file_store = FileStore(FILE_STORE_DIR) # Conteudo dos arquivos, em disco e sem duplicatas
+search_index = SearchIndex(SEARCH_MAX_MESSAGES) # Indice de busca dos historicos global e privado
+global_messages = GlobalHistory(HISTORY_MAX_MESSAGES, HISTORY_MAX_BYTES, HISTORY_SPILL_DIR, file_store,
+                                index=search_index) # Historico publico limitado
+private_messages = PrivateHistory(index=search_index, max_messages=PRIVATE_HISTORY_MESSAGES, max_bytes=PRIVATE_HISTORY_BYTES,
+                                  max_per_conversation=PRIVATE_CONVERSATION_MESSAGES) # Historico privado, por conversa
+transfer_ids = itertools.count(1) # Ids das transferencias de arquivo repassadas pelo servidor
+bus = None # Barramento entre workers (WorkerBus); None = processo unico
+federation = None # Ligacoes com outros servidores (Federation); None = servidor isolado
+metrics = Metrics() # Contadores e latencias por tipo de mensagem (ver metrics_report)
+presence = Presence(lambda conn, encoded: send_encoded(conn, encoded)) # Usuarios online (locais e remotos), serializados em cache
+rooms = RoomRegistry(ROOMS_MAX, ROOM_HISTORY_MESSAGES, ROOM_HISTORY_BYTES) # Salas "#nome"; a sala padrao (4all) e global_messages
+admission = AdmissionControl(MAX_CONNECTIONS) # Conexoes abertas neste processo
+refusal_slots = threading.BoundedSemaphore(REFUSE_THREADS) # Threads avisando conexoes recusadas
+heartbeats = TimerWheel(HEARTBEAT_TICK) # Proxima verificacao de cada conexao (ver check_heartbeats)
+sessions = SessionRegistry(SESSION_GRACE) # Sessoes retomaveis, pelo token
+journal = ReplayJournal(JOURNAL_MESSAGES, JOURNAL_BYTES) # Mensagens de chat numeradas, para a reconexao
+partial_uploads = OrderedDict() # (remetente, sha256) -> envio interrompido, aguardando retomada
+partial_uploads_lock = threading.Lock()
 
 def search_name_in_connections(name):
     """
-    Busca um usuario conectado pelo nome
+    Busca um usuario conectado pelo nome (O(1), indice do registro)
     Retorna o dicionario da conexao ou None se nao encontrado
     """
-    for conn in connections:
-        if conn["name"] == name:
-            return conn
-    return None
+    return connections.get(name)
 
 def name_already_exists(name):
     """
     Verifica se o nome ja esta sendo usado por outro usuario
     Usado para evitar nomes duplicados no chat
     """
-    for conn in connections:
-        if conn["name"] == name:
-            return True
-    return False
+    return name in connections
+
+def new_connection(conn, addr, writer=None, streamer=None, history_delay=0.2, throttle=None, schedule=None):
+    """
+    Cria o registro de uma conexao, compartilhado pelos modos thread e event-loop
+    - conn/addr: socket e endereco do cliente
+    - writer: funcao writer(dados, is_file, reliable) que enfileira bytes
+      prontos na fila de saida ("queue") da conexao; reliable=True para itens
+      que nao podem ser descartados (retorna False se nao couberem).
+      None = modo thread: enfileira e inicia uma thread escritora propria
+      para esvaziar a fila
+    - streamer: funcao streamer(itens) que envia uma sequencia longa de itens
+      confiaveis (download em pedacos) sem carregar tudo na fila de uma vez
+    - history_delay: pausa entre mensagens do historico para clientes no modo antigo
+    - throttle: funcao throttle(segundos) que para de ler a conexao por um
+      tempo (limite de bytes de arquivo); None = modo thread: time.sleep na
+      propria thread leitora
+    - schedule: funcao schedule(segundos, fn, *args) que chama fn mais tarde
+      sem travar quem agenda (envio espacado do historico no modo antigo);
+      None = modo thread: time.sleep antes de cada envio
+    O campo "name" fica None ate o usuario se registrar
+    """
+    client_connection = {
+        "conn": conn,
+        "addr": addr,
+        "name": None,
+        "framed": False,
+        "queue": OutboundQueue(OUTBOUND_MAX_ITEMS, OUTBOUND_MAX_BYTES, OUTBOUND_POLICY),
+        "send": writer,
+        "stream": streamer,
+        "uploads": {}, # Envios de arquivo em andamento, pelo id escolhido pelo cliente
+        "rooms": set(), # Salas em que a conexao entrou (alem da sala padrao)
+        "compressor": None, # Compressor do codec negociado no "name" (None = sem compressao)
+        "bytes_in": 0, # Bytes recebidos (os enviados ficam nas estatisticas da fila)
+        "limits": ConnectionLimits(RATE_LIMITS, (FILE_RATE_BYTES, 2 * FILE_RATE_BYTES) if FILE_RATE_BYTES else None),
+        "throttle": throttle or time.sleep,
+        "last_seen": time.monotonic(), # Ultimo recv com dados (heartbeat)
+        "heartbeat": False, # Cliente responde a ping (pedido no name)
+        "session": None, # Sessao retomavel (pedida no name), ver sessions.py
+        "envelope": None, # Envelope binario negociado no name: {"known": ids ja anunciados, "lock"}
+        "history_delay": history_delay,
+        "schedule": schedule
+    }
+    metrics.count("connections_opened")
+    if NAME_TIMEOUT:
+        heartbeats.schedule(conn, client_connection["last_seen"] + NAME_TIMEOUT, client_connection)
+    if writer is None:
+        client_connection["send"] = lambda data, is_file=False, reliable=False: enqueue_threaded(client_connection, data, is_file, reliable)
+        client_connection["stream"] = lambda items: threading.Thread(target=stream_threaded, args=(client_connection, items), daemon=True).start()
+        writer_thread = threading.Thread(target=connection_writer, args=(client_connection,), daemon=True)
+        writer_thread.start()
+    return client_connection
+
+def enqueue_threaded(client_connection, data, is_file=False, reliable=False):
+    """
+    Writer do modo thread: apenas enfileira, nunca bloqueia quem envia
+    Se a politica DISCONNECT for acionada, derruba o cliente lento
+    Itens confiaveis (pedacos de arquivo) esperam ate RELIABLE_SEND_TIMEOUT
+    por espaco na fila: o envio acompanha o ritmo do destinatario
+    Retorna False se o item nao foi enfileirado
+    """
+    queue = client_connection["queue"]
+    if reliable:
+        return queue.put_reliable(data, RELIABLE_SEND_TIMEOUT)
+    dropped_before = queue.dropped
+    if not queue.put(data, is_file):
+        logger.warning("Fila", f"{client_connection['name']} ({client_connection['addr']}) não acompanha as mensagens: desconectando")
+        try:
+            client_connection["conn"].shutdown(socket.SHUT_RDWR) # Libera a thread leitora para a limpeza
+        except OSError:
+            pass
+        return False
+    if queue.dropped and not dropped_before:
+        logger.warning("Fila", f"{client_connection['name']} ({client_connection['addr']}) lento: descartando mensagens ({queue.policy})")
+    return True
+
+def stream_threaded(client_connection, items):
+    """
+    Streamer do modo thread (roda numa thread propria por download):
+    enfileira os itens um a um como confiaveis, esperando enquanto a fila
+    do cliente estiver cheia, sem travar quem pediu nem os demais destinatarios
+    Se o cliente parar de ler, a conexao e derrubada (o fluxo ficaria incompleto)
+    """
+    for item in items:
+        if not enqueue_threaded(client_connection, item, reliable=True):
+            logger.warning("Fila", f"{client_connection['name']} ({client_connection['addr']}) parou de receber o arquivo: desconectando")
+            try:
+                client_connection["conn"].shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            return False
+    return True
 
-def view_global_history(client_connection):
+def connection_writer(client_connection):
     """
-    Envia todo o historico de mensagens globais para um cliente que acabou de se conectar
-    - Percorre a lista global_messages
-    - Envia cada mensagem formatada para o cliente
-    - Inclui delay entre mensagens para evitar spam
+    Thread escritora de uma conexao (modo thread)
+    Esvazia a fila de saida no socket; um destinatario travado bloqueia
+    apenas esta thread, nunca quem fez o broadcast
     """
+    queue = client_connection["queue"]
     conn = client_connection["conn"]
-    for msg in global_messages:
+    while True:
+        data = queue.get()
+        if data is None:
+            break # Fila fechada: conexao encerrada
         try:
-            if msg["type"] == "msg":
-                message = f"[{msg['sender']} -> todos]: {msg['content']}"
-                conn.send(f"msg={message}".encode(FORMAT))
-            elif msg["type"] == "file":
-                filename = msg.get("filename", "arquivo_recebido")
-                data = msg["content"]
-                sender = msg["sender"]
-                # Formato: remetente||nome_arquivo||dados_base64
-                conn.send(f"file={sender}||{filename}||{data}".encode(FORMAT))
-            time.sleep(0.2) # Delay para nao sobrecarregar o cliente
-        except Exception as e:
-            print(f"Erro ao enviar histórico para {client_connection['name']}: {e}")
+            if isinstance(data, tuple):
+                for part in data: # Cabecalho do pedaco + dados do arquivo, sem juntar
+                    conn.sendall(part)
+            else:
+                conn.sendall(data)
+        except OSError as e:
+            logger.error("Erro", f"Envio para {client_connection['addr']} falhou. Motivo: {e}")
+            queue.close()
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            break
+
+def send_to_connection(client_connection, text):
+    """
+    Envia uma string para um cliente respeitando o modo negociado no handshake
+    - framed=True: envia dentro de um quadro (cabecalho de tamanho + payload)
+    - framed=False: modo antigo, bytes crus
+    """
+    send_encoded(client_connection, EncodedMessage(text))
+
+def send_encoded(client_connection, encoded):
+    """
+    Enfileira uma mensagem ja serializada (EncodedMessage) para um cliente
+    Broadcasts reaproveitam a mesma instancia para todos os destinatarios
+    (inclusive a versao comprimida, uma por codec)
+    Mensagens do diario vao numeradas ("seq=N||...") para quem tem sessao
+    Mensagens de chat vao no envelope binario para quem o negociou
+    """
+    if encoded.chat is not None and client_connection["envelope"] is not None:
+        send_enveloped(client_connection, encoded)
+        return
+    if encoded.seq is not None and client_connection["session"] is not None:
+        encoded = encoded.sequenced()
+    enqueue_encoded(client_connection, encoded)
+
+def send_enveloped(client_connection, encoded):
+    """
+    Mensagem de chat no envelope binario: ids no lugar dos nomes; um id que a
+    conexao ainda nao conhece vai antes num envelope "user" (id + nome)
+    O lock garante que o anuncio chega antes de qualquer mensagem com o id
+    (no modo thread, varias threads enviam para a mesma conexao)
+    """
+    sender, destination, _ = encoded.chat
+    sender_id = user_ids.id(sender)
+    if destination in ("all", "4all"):
+        destination_id = ALL_USERS
+    elif destination.startswith("#"):
+        destination_id = 0 # Sala: vai no controle
+    else:
+        destination_id = user_ids.id(destination)
+    state = client_connection["envelope"]
+    with state["lock"]:
+        for user_id, name in ((sender_id, sender), (destination_id, destination)):
+            if user_id and user_id != ALL_USERS and user_id not in state["known"]:
+                state["known"].add(user_id)
+                enqueue_encoded(client_connection, EncodedMessage.from_payload(
+                    encode_envelope("user", name.encode(FORMAT), sender=user_id)))
+        enqueue_encoded(client_connection, encoded.enveloped(sender_id, destination_id))
+
+def enqueue_encoded(client_connection, encoded):
+    """
+    Poe na fila de saida os bytes de uma EncodedMessage no modo da conexao
+    """
+    compressor = client_connection["compressor"]
+    if compressor is not None:
+        client_connection["send"](compressor.frame_encoded(encoded), encoded.is_file)
+        return
+    client_connection["send"](encoded.for_connection(client_connection["framed"]), encoded.is_file)
+
+def send_reliable(client_connection, data):
+    """
+    Enfileira um item que nao pode ser descartado (partes de uma transferencia)
+    Retorna False se o destinatario nao acompanhou e o item ficou de fora
+    """
+    return client_connection["send"](data, False, True)
+
+def remove_connection(client_connection):
+    """
+    Remove o registro de uma conexao encerrada (usuario registrado ou nao)
+    """
+    addr = client_connection["addr"]
+    client_connection["queue"].close() # Libera a escritora e o que estava pendente
+    heartbeats.cancel(client_connection["conn"])
+    presence.unsubscribe(client_connection)
+    if client_connection["session"] is not None:
+        sessions.detach(client_connection["session"], client_connection["rooms"]) # Antes de sair das salas
+    metrics.count("connections_closed")
+    metrics.count("bytes_in", client_connection["bytes_in"])
+    metrics.count("bytes_out", client_connection["queue"].sent_bytes)
+    metrics.count("rate_limited", client_connection["limits"].rejected)
+    metrics.count("throttled_s", client_connection["limits"].throttled_s)
+    admission.release()
+    for handle in list(client_connection["uploads"]):
+        abort_file_upload(client_connection, handle, "Remetente desconectou", keep_partial=True)
+    rooms.leave_all(client_connection)
+    if client_connection["name"] is not None and connections.unregister(client_connection):
+        logger.info("Desconexão", "{} ({}) desconectado", client_connection["name"], addr, sample=True)
+        announce_presence("leave", client_connection)
+    else:
+        logger.info("Desconexão", "Usuário não identificado ({}) desconectado", addr, sample=True)
+    if client_connection["compressor"] is not None:
+        stats = client_connection["compressor"].stats()
+        logger.info("Compressão", f"{addr} ({stats['codec']}): enviados {stats['raw_bytes']} -> {stats['wire_bytes']} bytes "
+                    f"(taxa {stats['ratio']:.2f}, {stats['compressed']} comprimidos, {stats['skipped']} pulados, "
+                    f"{stats['cpu_ms']:.1f} ms de CPU); recebidos {stats['wire_in']} -> {stats['raw_in']} bytes", sample=True)
+    logger.info("Conexões ativas", "{}", len(connections), sample=True)
+
+def send_batch_to_connection(client_connection, texts):
+    """
+    Envia varias strings do protocolo para um cliente
+    - Modo enquadrado: todos os quadros juntos num unico sendall (e, com
+      compressao negociada, comprimidos juntos num unico quadro)
+    - Modo antigo: uma por vez, com delay antes de cada uma, inclusive a
+      primeira (o cliente trata cada recv como uma mensagem: sem a pausa,
+      a primeira gruda na anterior, ex.: as boas-vindas)
+    """
+    if client_connection["compressor"] is not None:
+        client_connection["send"](client_connection["compressor"].frame_payloads([text.encode(FORMAT) for text in texts]))
+        return
+    if client_connection["framed"]:
+        client_connection["send"](b"".join(encode_frame(text.encode(FORMAT)) for text in texts))
+        return
+    delay = client_connection["history_delay"]
+    schedule = client_connection["schedule"]
+    for position, text in enumerate(texts, 1):
+        if not delay:
+            send_to_connection(client_connection, text)
+        elif schedule is None:
+            time.sleep(delay) # Delay para nao sobrecarregar (nem grudar) as mensagens
+            send_to_connection(client_connection, text)
+        else:
+            schedule(delay * position, send_to_connection, client_connection, text) # Event-loop: sem travar o loop
+
+def format_history_entry(message):
+    """
+    Formata uma mensagem do historico global para replay
+    - Arquivos pequenos vao inline ("file=...")
+    - Arquivos grandes ou fora da memoria vao como referencia:
+      "file_ref=remetente||nome_arquivo||id||tamanho_bytes||sha256"
+      (o cliente baixa depois com {"type": "file_get", "message": id})
+    """
+    if message["type"] == "file":
+        content = message["content"]
+        if content is None or len(content) > HISTORY_INLINE_FILE_BYTES:
+            size = message.get("size", 0)
+            return (f"file_ref={message['sender']}||{message['filename']}||{message['id']}||{size}"
+                    f"||{message.get('sha256', '')}")
+    return format_message(message)
+
+def view_global_history(client_connection, before_id=None, room=None):
+    """
+    Envia uma pagina do historico de mensagens globais para o cliente
+    - before_id=None: ultimas HISTORY_PAGE_SIZE mensagens (usado ao entrar no chat)
+    - before_id=N: pagina anterior a mensagem N (pedido "history" do cliente)
+    - Toda a pagina vai num unico envio; ao final segue "history_cursor=id",
+      o cursor para pedir a pagina anterior (0 = nao ha mensagens mais antigas).
+      Clientes no modo antigo nao recebem o cursor (nao paginam)
+    - room: historico de uma sala (Room) em vez do global; o cursor vai
+      como "room_cursor=#sala||id"
+    """
+    history = global_messages if room is None else room.history
+    page, has_older = history.page(before_id, HISTORY_PAGE_SIZE)
+    texts = [format_history_entry(msg) for msg in page]
+    cursor = page[0]['id'] if has_older else 0
+    if client_connection["framed"]:
+        texts.append(f"history_cursor={cursor}" if room is None else f"room_cursor={room.name}||{cursor}")
+    try:
+        send_batch_to_connection(client_connection, texts)
+    except Exception as e:
+        logger.error("Erro", f"Falha ao enviar histórico para {client_connection['name']}: {e}")
+
+def search_messages(client_connection, message):
+    """
+    Pedido "search": message = palavras; sender, filename, since, until e
+    cursor opcionais (ver SearchIndex.search)
+    Responde "search=json" com uma pagina de resultados (mensagens globais e
+    privadas do proprio usuario); arquivos globais trazem o id para o file_get
+    """
+    try:
+        since = float(message["since"]) if message.get("since") is not None else None
+        until = float(message["until"]) if message.get("until") is not None else None
+        cursor = int(message.get("cursor") or 0) or None
+    except (TypeError, ValueError):
+        send_to_connection(client_connection, "msg=[Servidor]: ❌ Período ou cursor de busca inválido.")
+        return
+    words, sender, filename = (message.get(field) if isinstance(message.get(field), str) else None
+                               for field in ("message", "sender", "filename"))
+    found, next_cursor = search_index.search(client_connection["name"], words, sender, filename, since, until,
+                                             cursor, SEARCH_PAGE_SIZE)
+    results = []
+    for message_id, private, ts in found:
+        record = (private_messages if private else global_messages).get(message_id)
+        if record is None:
+            continue # Saiu do historico (sem log)
+        results.append({
+            "id": None if private else message_id,
+            "ts": record.get("ts", ts),
+            "sender": record["sender"],
+            "destination": record["destination"],
+            "type": record["type"],
+            "content": record["content"] if record["type"] == "msg" else None,
+            "filename": record.get("filename")
+        })
+    send_to_connection(client_connection, f"search={json.dumps({'results': results, 'cursor': next_cursor})}")
+
+def open_file_stream(message, start=0):
+    """
+    Abre um arquivo do armazenamento para download em pedacos
+    - start: offset de onde continuar (download retomado)
+    Retorna o gerador de itens da transferencia: file_begin, pedacos e file_end
+    Os pedacos sao fatias (memoryview) de um mmap do arquivo: nada e copiado
+    nem codificado, e so os pedacos ainda na fila ocupam memoria
+    """
+    tid = next(transfer_ids)
+    size = os.path.getsize(message["path"])
+    start = max(0, min(start, size))
+    view = None
+    if size:
+        with open(message["path"], "rb") as f:
+            view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def items():
+        yield encode_frame(f"file_begin={message['sender']}||{message['filename']}||{tid}||{size}"
+                           f"||{message.get('sha256', '')}||{start}")
+        for offset in range(start, size, CHUNK_SIZE):
+            chunk = view[offset:offset + CHUNK_SIZE]
+            yield (encode_chunk_header(tid, offset, len(chunk), chunk_crc(chunk)), chunk)
+        yield encode_frame(f"file_end={tid}")
+    return items()
+
+def send_history_file(client_connection, message_id, offset=0):
+    """
+    Atende um pedido "file_get": envia o payload de um arquivo do historico global
+    - Arquivos do armazenamento vao do disco em pedacos (modo enquadrado),
+      a partir de `offset` se o cliente ja tem o comeco do arquivo
+    - Demais casos: "file=..." com o payload em base64
+    """
+    msg = global_messages.get(message_id)
+    if msg and msg.get("path") and client_connection["framed"] and client_connection["stream"]:
+        try:
+            items = open_file_stream(msg, offset)
+        except OSError as e:
+            logger.warning("Arquivo", f"Falha ao abrir {msg['path']}: {e}")
+        else:
+            client_connection["stream"](items)
+            return
+    data = global_messages.load_payload(msg) if msg and msg["type"] == "file" else None
+    if data is None:
+        error_msg = f"❌ Arquivo #{message_id} não está mais disponível no histórico."
+        send_to_connection(client_connection, f"msg=[Servidor]: {error_msg}")
+        return
+    send_to_connection(client_connection, format_message(dict(msg, content=data)))
 
 def send_online_users_list(client_connection):
     """
     Envia a lista de usuarios online para o cliente solicitante
-    - Coleta informacoes de todos os usuarios conectados (exceto o proprio)
-    - Formata como JSON e envia via "online_users=dados"
+    - Inclui os usuarios dos outros workers / nos da federacao (exceto o proprio)
+    - A lista vem pronta do cache de presenca (presence.py): sem montar nem
+      serializar tudo de novo a cada pedido
+    - Envia via "online_users=dados"
     """
-    conn = client_connection["conn"]
     try:
-        online_users = []
-        # Para não incluir o próprio usuário na contagem:
-        for connection in connections:
-            if connection["name"] != client_connection["name"]:  # Excluir o próprio usuário
-                user_info = {
-                    "name": connection["name"],
-                    "addr": f"{connection['addr'][0]}:{connection['addr'][1]}"
-                }
-                online_users.append(user_info)
-        
-        # Envia a lista como JSON
-        users_data = json.dumps(online_users)
-        conn.send(f"online_users={users_data}".encode(FORMAT))
-        print(f"[Lista de Usuários] Enviada para {client_connection['name']} - {len(online_users)} outros usuários online")
-        
+        send_to_connection(client_connection, f"online_users={presence.users_text(client_connection['name'])}")
+        logger.info("Lista de Usuários", "Enviada para {} - {} outros usuários online", client_connection["name"], len(presence) - 1, sample=True)
     except Exception as e:
-        print(f"Erro ao enviar lista de usuários para {client_connection['name']}: {e}")
+        logger.error("Erro", f"Falha ao enviar lista de usuários para {client_connection['name']}: {e}")
+
+def format_message(message):
+    """
+    Converte um registro de mensagem no texto enviado ao cliente
+    - msg:  "msg=[remetente -> destinatario|todos]: conteudo"
+    - file: "file=remetente||nome_arquivo||dados_base64"
+    """
+    if message["type"] == "file":
+        filename = message.get("filename", "arquivo_recebido")
+        # Formato: remetente||nome_arquivo||dados_base64
+        return f"file={message['sender']}||{filename}||{message['content']}"
+    destination = "todos" if message["destination"] in ("all", "4all") else message["destination"]
+    return f"msg=[{message['sender']} -> {destination}]: {message['content']}"
 
-def send_message_to_user(sending_conn, client_connection, is_private):
+def encode_chat_message(message):
     """
-    Envia a ultima mensagem de um usuario para outro usuario especifico
+    Codifica uma mensagem para entrega; mensagens de texto (globais, privadas
+    e de salas) recebem um seq e entram no diario de reconexao, e levam os
+    campos para o envelope binario (chat)
+    Arquivos nao entram: quem perde um arquivo o encontra no historico
+    """
+    text = format_message(message)
+    if message["type"] != "msg":
+        return EncodedMessage(text)
+    destination = message["destination"]
+    audience = None if destination in ("all", "4all") else destination
+    chat = (message["sender"], destination, str(message["content"]))
+    if not SESSION_GRACE:
+        return EncodedMessage(text, chat=chat)
+    return journal.add(lambda seq: EncodedMessage(text, seq, chat), message["sender"], audience)
+
+def send_message_to_user(sending_conn, client_connection, message):
+    """
+    Entrega uma mensagem a um usuario especifico
     - sending_conn: quem enviou a mensagem
     - client_connection: quem vai receber
-    - is_private: True para mensagem privada, False para global
+    - message: registro recem-criado da mensagem (enviado diretamente,
+      sem reprocurar no historico)
     """
-    conn = client_connection["conn"]
-    dest_name = client_connection["name"]
-    from_name = sending_conn["name"] if sending_conn != 0 else "Servidor"
+    try:
+        send_encoded(client_connection, encode_chat_message(message))
+    except Exception as e:
+        logger.error("Erro", f"Falha ao enviar mensagem para {client_connection['name']}: {e}")
 
-    messages_source = private_messages if is_private else global_messages
-    
-    if is_private:
-        # Para mensagens privadas, filtrar apenas mensagens para este usuario
-        messages_for_client = [
-            msg for msg in messages_source
-            if (msg["sender"] == from_name and msg["destination"] == dest_name)
-        ]
-    else:
-        # Para mensagens globais, pegar todas
-        messages_for_client = messages_source
+def send_message_to_all(user_conn, message):
+    """
+    Envia uma mensagem global para todos os usuarios conectados
+    Exclui o remetente da lista de destinatarios
+    A mensagem e formatada e codificada uma unica vez; todos os destinatarios
+    recebem os mesmos bytes (o custo por destinatario nao depende do tamanho)
+    """
+    encoded = encode_chat_message(message)
+    for conn in connections.snapshot(): # Copia estavel: outros podem entrar/sair durante o envio
+        if conn["conn"] != user_conn["conn"]:
+            try:
+                send_encoded(conn, encoded)
+            except Exception as e:
+                logger.error("Erro", f"Falha ao enviar mensagem para {conn['name']}: {e}")
+
+def read_handshake(conn):
+    """
+    Le os primeiros bytes da conexao e detecta o modo do protocolo
+    Retorna (framed, dados_restantes):
+    - framed=True se o cliente enviou o preambulo FRAMED_MAGIC
+    - dados_restantes: bytes ja lidos que pertencem as mensagens seguintes
+      (None se o cliente fechou a conexao antes do handshake)
+    """
+    data = conn.recv(RECV_SIZE)
+    if not data:
+        return False, None
+    # O preambulo pode chegar quebrado em mais de um segmento
+    while len(data) < len(FRAMED_MAGIC) and FRAMED_MAGIC.startswith(data):
+        more = conn.recv(RECV_SIZE)
+        if not more:
+            return False, None
+        data += more
+    if data.startswith(FRAMED_MAGIC):
+        return True, data[len(FRAMED_MAGIC):]
+    return False, data
+
+def process_message(client_connection, message):
+    """
+    Processa uma mensagem JSON ja decodificada de um cliente
+    - client_connection: registro da conexao (name=None ate o usuario se registrar)
+    - message: dicionario com type/control/message/filename
+    """
+    addr = client_connection["addr"]
+
+    if message["type"] == "pong":
+        return # Resposta ao heartbeat: basta ter chegado (last_seen)
+
+    if message["type"] == "ping":
+        send_to_connection(client_connection, f"pong={message.get('message', '')}")
+        return
+
+    if message["type"] == "metrics":
+        # Tipo administrativo: so de conexoes da propria maquina, nao exige nome
+        if addr[0] in ("127.0.0.1", "::1"):
+            send_to_connection(client_connection, f"metrics={json.dumps(metrics_report())}")
+        else:
+            send_to_connection(client_connection, "msg=[Servidor]: ❌ Métricas só podem ser pedidas localmente.")
+        return
+
+    if message["type"] == "resume":
+        resume_session(client_connection, message)
+        return
+
+    if message["type"] == "name":
+        name = message["message"]
+
+        if client_connection["name"] is not None:
+            error_msg = f"❌ Você já está registrado como '{client_connection['name']}'."
+            send_to_connection(client_connection, f"msg=[Servidor]: {error_msg}")
+            return
 
-    if messages_for_client:
-        last_msg = messages_for_client[-1]
+        if not isinstance(name, str) or name.startswith("#"):
+            # "#nome" identifica uma sala nos destinos das mensagens
+            send_to_connection(client_connection, "msg=[Servidor]: ❌ Nome inválido: não pode começar com '#'.")
+            send_to_connection(client_connection, f"msg=[Servidor]: Digite um novo nome:")
+            return
+
+        # Registrar o usuario; falha se o nome ja existe (verificacao atomica)
+        # Com workers ou federacao, o nome tambem nao pode estar em uso em outro processo/no
+        client_connection["name"] = name
+        if is_remote_user(name) or not connections.register(client_connection):
+            client_connection["name"] = None
+            error_msg = f"❌ Nome '{name}' já está sendo usado! Escolha outro nome."
+            send_to_connection(client_connection, f"msg=[Servidor]: {error_msg}")
+            # Solicitar novo nome
+            send_to_connection(client_connection, f"msg=[Servidor]: Digite um novo nome:")
+            return
+        logger.info("Nome definido", "{} conectado de {}", name, addr, sample=True)
+        announce_presence("join", client_connection)
+        negotiate_options(client_connection, message)
+
+        # Sessao retomavel: o token vai antes de qualquer mensagem numerada
+        if message.get("resume") and client_connection["framed"] and SESSION_GRACE:
+            client_connection["session"] = sessions.create(name)
+            send_to_connection(client_connection, f"session={client_connection['session']['token']}||{journal.last_seq}")
+
+        # Enviar mensagem de boas-vindas
+        welcome_msg = f"✅ Bem-vindo ao chat, {name}!"
+        send_to_connection(client_connection, f"msg=[Servidor]: {welcome_msg}")
+
+        # Enviar historico de mensagens globais
+        view_global_history(client_connection)
+        return
+
+    # Demais tipos exigem que o usuario ja tenha se registrado
+    if client_connection["name"] is None:
+        error_msg = "❌ Você precisa definir um nome primeiro!"
+        send_to_connection(client_connection, f"msg=[Servidor]: {error_msg}")
+        return
+
+    user_conn = client_connection
+
+    if message["type"] == "online_usr":
+        # Envia a lista de usuários online
+        send_online_users_list(user_conn)
+
+    elif message["type"] == "presence":
+        # Assinatura da presenca: snapshot agora, depois so as entradas/saidas
+        if message.get("message") == "unsubscribe":
+            presence.unsubscribe(user_conn)
+        else:
+            presence.subscribe(user_conn)
+
+    elif message["type"] == "history":
+        # Pagina anterior do historico global (ou de uma sala), a partir do cursor informado
         try:
-            if last_msg["type"] == "msg":
-                if is_private:
-                    message = f"[{last_msg['sender']} -> {last_msg['destination']}]: {last_msg['content']}"
+            cursor = int(message["message"])
+        except (TypeError, ValueError):
+            cursor = None
+        room = None
+        if (message.get("control") or "").startswith("#"):
+            room = rooms.get(normalize_room(message["control"]))
+            if room is None or user_conn["name"] not in room.members:
+                send_to_connection(user_conn, f"msg=[Servidor]: ❌ Você não está na sala {message['control']}.")
+                return
+        view_global_history(user_conn, cursor if cursor else None, room)
+
+    elif message["type"] == "search":
+        search_messages(user_conn, message)
+
+    elif message["type"] == "room":
+        handle_room_request(user_conn, message)
+
+    elif message["type"] == "file_get":
+        # Download de um arquivo do historico enviado como referencia
+        try:
+            send_history_file(user_conn, int(message["message"]), int(message.get("offset") or 0))
+        except (TypeError, ValueError):
+            send_to_connection(user_conn, "msg=[Servidor]: ❌ Id de arquivo inválido.")
+
+    elif message["type"] == "file_begin":
+        start_file_upload(user_conn, message)
+
+    elif message["type"] == "file_end":
+        finish_file_upload(user_conn, message)
+
+    elif message["type"] == "msg":
+        if not isinstance(message.get("control"), str):
+            send_to_connection(user_conn, "msg=[Servidor]: ❌ Destinatário inválido.")
+        elif message["control"].startswith("#"):
+            # Mensagem para uma sala: so os membros recebem
+            send_room_message(user_conn, message["control"], message["message"])
+        elif message["control"] == DEFAULT_ROOM:
+            # Mensagem global para todos
+            new_message = {
+                "sender": user_conn["name"],
+                "destination": "all",
+                "type": "msg",
+                "content": message["message"]
+            }
+            logger.info("Mensagem Global", "{}: {:.50}...", user_conn["name"], message["message"], sample=True)
+            if bus is not None:
+                publish_global_message(new_message) # Historico e entrega na ordem do barramento
+            else:
+                global_messages.append(new_message)
+                send_message_to_all(user_conn, new_message)
+                forward_to_peers(new_message)
+        else:
+            # Mensagem privada para usuario especifico
+            destination = message["control"]
+            dest_conn = search_name_in_connections(destination)
+            if dest_conn or is_remote_user(destination) or sessions.waiting(destination):
+                new_message = {
+                    "sender": user_conn["name"],
+                    "destination": destination,
+                    "type": "msg",
+                    "content": message["message"]
+                }
+                record_private_message(new_message)
+                logger.info("Mensagem Privada", "{} -> {}: {:.50}...", user_conn["name"], destination, message["message"], sample=True)
+                if dest_conn:
+                    send_message_to_user(user_conn, dest_conn, new_message)
+                elif is_remote_user(destination):
+                    route_private_message(new_message) # Destinatario em outro worker / no
                 else:
-                    message = f"[{last_msg['sender']} -> todos]: {last_msg['content']}"
-                conn.send(f"msg={message}".encode(FORMAT))
-            elif last_msg["type"] == "file":
-                filename = last_msg.get("filename", "arquivo_recebido")
-                data = last_msg["content"]
-                sender = last_msg["sender"]
-                # Formato: remetente||nome_arquivo||dados_base64
-                conn.send(f"file={sender}||{filename}||{data}".encode(FORMAT))
+                    encode_chat_message(new_message) # Destinatario reconectando: fica no diario
+            else:
+                # Enviar mensagem de erro para o remetente
+                error_msg = f"❌ Usuário '{destination}' não encontrado ou offline."
+                send_to_connection(user_conn, f"msg=[Servidor]: {error_msg}")
+
+    elif message["type"] == "file":
+        destination = message["control"]
+        filename = message.get("filename", "arquivo_recebido")
+        file_data = message["message"] # Dados em base64
+
+        # Verificar tamanho do arquivo (em Base64)
+        file_size_b64 = len(file_data)
+        file_size_bytes = (file_size_b64 * 3) // 4  # Aproximação do tamanho real
+
+        logger.info("Arquivo", "{} enviando '{}' ({:.1f}KB)", user_conn["name"], filename, file_size_bytes / 1024, sample=True)
+
+        new_message = {
+            "sender": user_conn["name"],
+            "destination": destination,
+            "type": "file",
+            "content": file_data,
+            "filename": filename,
+            "size": file_size_bytes
+        }
+
+        if destination == "4all":
+            # Arquivo global para todos
+            record_file_message(store_legacy_file(new_message), delivered="all")
+            send_message_to_all(user_conn, new_message)
+        else:
+            # Arquivo privado para usuario especifico
+            dest_conn = search_name_in_connections(destination)
+            if dest_conn:
+                record_file_message(store_legacy_file(new_message))
+                send_message_to_user(user_conn, dest_conn, new_message)
+            elif is_remote_user(destination):
+                # Outro worker / no: vai com o payload, o destinatario pode estar no modo antigo
+                record_private_message(store_legacy_file(new_message))
+                route_private_message(new_message)
+            else:
+                # Enviar mensagem de erro para o remetente
+                error_msg = f"❌ Usuário '{destination}' não encontrado. Arquivo '{filename}' não foi entregue."
+                send_to_connection(user_conn, f"msg=[Servidor]: {error_msg}")
+
+def negotiate_options(client_connection, message):
+    """
+    Opcoes pedidas no name (ou no resume) por clientes no modo enquadrado
+    """
+    # Negociar compressao: a resposta sai sem comprimir, as mensagens seguintes ja podem vir comprimidas
+    codec = negotiate_codec(message.get("compression")) if client_connection["framed"] else None
+    if codec is not None:
+        send_to_connection(client_connection, f"compression={codec}")
+        client_connection["compressor"] = Compressor(codec)
+        logger.info("Compressão", "{} usando {}", client_connection["name"], codec, sample=True)
+
+    # Heartbeat: so no modo enquadrado, e so para clientes que respondem ping
+    if message.get("heartbeat") and client_connection["framed"] and HEARTBEAT_INTERVAL:
+        client_connection["heartbeat"] = True
+        set_keepalive(client_connection["conn"], False) # O ping ja detecta conexoes mortas
+        heartbeats.schedule(client_connection["conn"], client_connection["last_seen"] + HEARTBEAT_INTERVAL, client_connection)
+
+    # Envelope binario: a resposta sai em texto, as mensagens de chat seguintes ja vao no envelope
+    offered = message.get("envelope")
+    if client_connection["framed"] and isinstance(offered, list) and ENVELOPE_VERSION in offered:
+        send_to_connection(client_connection, f"envelope={ENVELOPE_VERSION}")
+        client_connection["envelope"] = {"known": set(), "lock": threading.Lock()}
+
+def resume_session(client_connection, message):
+    """
+    Reconexao ("resume"): control = token da sessao, message = ultimo seq recebido
+    - O usuario volta com o mesmo nome e as mesmas salas e recebe so as
+      mensagens do diario depois desse seq ("resumed=N" e as mensagens), ou o
+      historico global se o diario ja descartou parte delas ("resumed=history")
+    - Se a conexao antiga ainda esta registrada (caiu sem aviso e o heartbeat
+      ainda nao percebeu), ela e encerrada sem anunciar saida
+    Falha (sessao expirada, nome com outro usuario): "resume_failed=motivo"
+    """
+    if client_connection["name"] is not None:
+        send_to_connection(client_connection, f"msg=[Servidor]: ❌ Você já está registrado como '{client_connection['name']}'.")
+        return
+    token = message.get("control")
+    session = sessions.resume(token) if client_connection["framed"] and SESSION_GRACE else None
+    if session is None:
+        send_to_connection(client_connection, "resume_failed=Sessão expirada ou inválida")
+        return
+    name = session["name"]
+    old = search_name_in_connections(name)
+    if (old is not None and old["session"] is not session) or (old is None and is_remote_user(name)):
+        sessions.discard(session) # O nome ficou com outro usuario
+        send_to_connection(client_connection, "resume_failed=Nome em uso por outro usuário")
+        return
+
+    rejoin = session["rooms"]
+    if old is not None:
+        # Conexao antiga ainda aberta: sai sem aviso de presenca (para os outros o usuario nunca saiu)
+        rejoin = set(old["rooms"])
+        connections.unregister(old)
+        old["session"] = None # A limpeza da conexao antiga nao mexe mais na sessao
+        rooms.leave_all(old)
+        try:
+            old["conn"].shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    client_connection["name"] = name
+    if not connections.register(client_connection):
+        client_connection["name"] = None
+        sessions.discard(session)
+        send_to_connection(client_connection, "resume_failed=Nome em uso por outro usuário")
+        return
+    client_connection["session"] = session
+    logger.info("Reconexão", "{} retomou a sessão de {}", name, client_connection["addr"], sample=True)
+    if old is None:
+        announce_presence("join", client_connection)
+    negotiate_options(client_connection, message)
+    for room_name in rejoin:
+        rooms.join(room_name, client_connection)
+
+    try:
+        last_seq = int(message.get("message") or 0)
+    except (TypeError, ValueError):
+        last_seq = 0
+    missed = journal.since(last_seq, name, client_connection["rooms"])
+    if missed is None:
+        send_to_connection(client_connection, "resumed=history")
+        view_global_history(client_connection)
+        return
+    send_to_connection(client_connection, f"resumed={len(missed)}")
+    for encoded in missed:
+        send_encoded(client_connection, encoded)
+
+def store_legacy_file(message):
+    """
+    Guarda no armazenamento o payload base64 de um arquivo do modo antigo
+    Retorna o registro para o historico, apenas com a referencia ao conteudo
+    (a mensagem original, com o payload, segue para os destinatarios)
+    """
+    try:
+        data = base64.b64decode(message["content"])
+        digest = file_store.put_bytes(data)
+    except (ValueError, OSError) as e:
+        logger.warning("Arquivo", f"Falha ao armazenar '{message['filename']}' ({e}), mantendo em memória")
+        return message
+    return dict(message, content=None, size=len(data), sha256=digest, path=file_store.path(digest))
+
+def record_file_message(message, delivered="framed"):
+    """
+    Registra uma mensagem de arquivo no historico global ou privado
+    - delivered (modo multiprocesso): quem ja recebeu o arquivo neste worker,
+      ver publish_global_message; destinatario privado em outro worker (ou
+      no da federacao) recebe a referencia pelo barramento (ou o arquivo)
+    """
+    if message["destination"] == "4all" and bus is not None:
+        publish_global_message(message, delivered)
+        logger.info("Arquivo Global", "{}: {}", message["sender"], message["filename"], sample=True)
+    elif message["destination"] == "4all":
+        global_messages.append(message)
+        forward_to_peers(message)
+        if logger.enabled(INFO):
+            usage = global_messages.memory_usage()
+            stored = file_store.stats()
+            logger.info("Arquivo Global", f"{message['sender']}: {message['filename']} "
+                        f"(histórico: {usage['messages']} msgs, {usage['bytes']/1024/1024:.1f}MB | "
+                        f"armazenamento: {stored['files']} arquivos, {stored['bytes']/1024/1024:.1f}MB)", sample=True)
+    else:
+        record_private_message(message)
+        if search_name_in_connections(message["destination"]) is None and is_remote_user(message["destination"]):
+            route_private_message(log_record(message))
+        logger.info("Arquivo Privado", "{} -> {}: {}", message["sender"], message["destination"], message["filename"], sample=True)
+
+def record_private_message(message):
+    """
+    Guarda uma mensagem privada no historico
+    Com workers, o log privado fica no worker PERSIST_WORKER; os outros guardam
+    so em memoria as privadas dos seus usuarios (para a busca) - as recebidas
+    de outro worker entram ao chegar pelo barramento
+    """
+    if bus is not None and bus.worker_id != PERSIST_WORKER:
+        private_messages.append(message)
+        bus.publish({"op": "private_log", "message": log_record(message)})
+    else:
+        private_messages.append(message)
+
+def remote_user_info(name):
+    """
+    Presenca de um usuario conectado em outro worker (modo multiprocesso) ou
+    em outro no da federacao: {"addr", "framed", ...}; None se nao e remoto
+    """
+    for remote in (bus, federation):
+        if remote is not None and name in remote.remote_users:
+            return remote.remote_users.get(name)
+    return None
+
+def is_remote_user(name):
+    """
+    True se o usuario esta conectado em outro worker ou em outro no
+    """
+    return remote_user_info(name) is not None
+
+def announce_presence(op, client_connection):
+    """
+    Registra na presenca que um usuario deste processo entrou ("join") ou
+    saiu ("leave") e avisa os outros workers / nos
+    """
+    event = {"op": op, "name": client_connection["name"]}
+    if op == "join":
+        addr = client_connection["addr"]
+        event.update(addr=f"{addr[0]}:{addr[1]}", framed=client_connection["framed"])
+        presence.join(event["name"], event["addr"])
+    else:
+        presence.leave(event["name"])
+    if bus is not None:
+        bus.publish(dict(event, worker=bus.worker_id))
+    if federation is not None:
+        federation.broadcast(event)
+
+def federation_users():
+    """
+    Usuarios deste servidor, como enviados aos nos que se ligam (presence)
+    """
+    return [{"name": conn["name"], "addr": f"{conn['addr'][0]}:{conn['addr'][1]}", "framed": conn["framed"]}
+            for conn in connections.snapshot()]
+
+def route_private_message(message):
+    """
+    Entrega uma mensagem privada a um destinatario em outro worker (pelo
+    barramento) ou em outro no (direto ao no dele; arquivos do armazenamento
+    so atravessam a ligacao se o outro no ainda nao tem o conteudo)
+    """
+    if bus is not None:
+        bus.publish({"op": "private", "message": message})
+        return
+    node = federation.node_of(message["destination"]) if federation is not None else None
+    if node is None:
+        return # Saiu enquanto a mensagem era processada
+    if message["type"] == "file" and message.get("content") is None:
+        federation.offer_file(message, [node])
+    else:
+        federation.send_to(node, {"op": "private", "message": message})
+
+def forward_to_peers(message):
+    """
+    Repassa uma mensagem global (ja no historico deste no) aos outros nos
+    """
+    if federation is None:
+        return
+    if message["type"] == "file" and message.get("sha256"):
+        federation.offer_file(log_record(message))
+    else:
+        federation.broadcast({"op": "global", "message": log_record(message)})
+
+def publish_global_message(message, delivered="none"):
+    """
+    Modo multiprocesso: envia uma mensagem global pelo barramento
+    O registro no historico e a entrega acontecem em handle_bus_event, na
+    ordem definida pelo hub (os ids do historico coincidem entre workers)
+    - delivered: o que este worker ja entregou aos seus usuarios
+      "none": nada | "framed": clientes no modo enquadrado (arquivo em
+      pedacos) | "all": todos (arquivo base64 do modo antigo)
+    """
+    bus.publish({"op": "global", "message": log_record(message), "worker": bus.worker_id, "delivered": delivered})
+
+def handle_bus_event(event):
+    """
+    Evento recebido do barramento (modo multiprocesso), ver bus.py
+    """
+    op = event["op"]
+    if op == "global":
+        message = event["message"]
+        digest = message.get("sha256")
+        if digest:
+            if file_store.acquire(digest, count_dedup=False):
+                message["path"] = file_store.path(digest)
+            else:
+                del message["sha256"]
+        if event["worker"] != bus.worker_id:
+            accept_global_message(message)
+        elif event["delivered"] == "framed":
+            accept_global_message(message, "legacy") # Os demais ja receberam os pedacos
+        else:
+            accept_global_message(message, "none" if event["delivered"] == "all" else "all")
+
+    elif op == "private":
+        message = event["message"]
+        dest_conn = search_name_in_connections(message["destination"])
+        if dest_conn is None:
+            return # Saiu enquanto a mensagem estava no barramento
+        if bus.worker_id != PERSIST_WORKER:
+            private_messages.append(message) # No PERSIST_WORKER ja entrou pelo private_log
+        if message["type"] == "file" and message.get("content") is None:
+            message["path"] = file_store.path(message["sha256"])
+            deliver_stored_file(message, [dest_conn])
+        else:
+            send_message_to_user(None, dest_conn, message)
+
+    elif op == "private_log":
+        private_messages.append(event["message"])
+
+    elif op == "room":
+        accept_room_message(event["message"])
+
+    elif op == "join" and event["worker"] != bus.worker_id:
+        presence.join(event["name"], event.get("addr", ""), ("worker", event["worker"]))
+
+    elif op == "leave" and event["worker"] != bus.worker_id:
+        presence.leave(event["name"], ("worker", event["worker"]))
+
+    elif op == "name_taken":
+        # Outro worker registrou o mesmo nome primeiro
+        release_taken_name(event["name"])
+
+def accept_global_message(message, deliver="all"):
+    """
+    Registra uma mensagem global vinda de outro worker ou no e entrega aos
+    usuarios deste processo
+    - deliver: "all" | "legacy" (so clientes no modo antigo) | "none"
+    """
+    global_messages.append(message)
+    if deliver == "none":
+        return
+    recipients = [conn for conn in connections.snapshot() if conn["name"] != message["sender"]]
+    if deliver == "legacy":
+        recipients = [conn for conn in recipients if not conn["framed"]]
+    if message["type"] == "file" and message.get("content") is None:
+        if message.get("path"):
+            deliver_stored_file(message, recipients)
+        return
+    encoded = encode_chat_message(message)
+    for conn in recipients:
+        try:
+            send_encoded(conn, encoded)
         except Exception as e:
-            print(f"Erro ao enviar mensagem para {dest_name}: {e}")
+            logger.error("Erro", f"Falha ao enviar mensagem para {conn['name']}: {e}")
 
-def send_message_to_all(user_conn):
+def handle_room_request(client_connection, message):
     """
-    Envia a ultima mensagem global para todos os usuarios conectados
-    Exclui o remetente da lista de destinatarios
+    Pedido "room": control = join | leave | list, message = nome da sala
+    - join: entra na sala e recebe a ultima pagina do historico dela
+    - A sala padrao (4all) tem todos os usuarios: nao da para entrar nem sair
     """
-    for conn in connections:
-        if conn["conn"] != user_conn["conn"]:
-            send_message_to_user(user_conn, conn, is_private=False)
+    action = message.get("control")
+    if action == "list":
+        joined = client_connection["rooms"]
+        listing = [{"name": DEFAULT_ROOM, "members": len(connections), "joined": True}]
+        listing += [{"name": name, "members": members, "joined": name in joined} for name, members in rooms.listing()]
+        send_to_connection(client_connection, f"rooms={json.dumps(listing)}")
+        return
+    if message.get("message") in (DEFAULT_ROOM, "#" + DEFAULT_ROOM):
+        send_to_connection(client_connection, "msg=[Servidor]: ❌ Todos já estão na sala padrão (4all).")
+        return
+    name = normalize_room(message.get("message"))
+    if name is None:
+        send_to_connection(client_connection, "msg=[Servidor]: ❌ Nome de sala inválido (letras, números, _ e -, até 32).")
+        return
+    if action == "join":
+        room, joined = rooms.join(name, client_connection)
+        if room is None:
+            send_to_connection(client_connection, "msg=[Servidor]: ❌ Limite de salas atingido, tente mais tarde.")
+            return
+        if joined:
+            logger.info("Sala", "{} entrou em {} ({} membros)", client_connection["name"], name, len(room.members), sample=True)
+        send_to_connection(client_connection, f"msg=[Servidor]: ✅ Você está na sala {name} ({len(room.members)} membros).")
+        view_global_history(client_connection, None, room)
+    elif action == "leave":
+        if rooms.leave(name, client_connection):
+            logger.info("Sala", "{} saiu de {}", client_connection["name"], name, sample=True)
+            send_to_connection(client_connection, f"msg=[Servidor]: Você saiu da sala {name}.")
+        else:
+            send_to_connection(client_connection, f"msg=[Servidor]: ❌ Você não está na sala {name}.")
+
+def send_room_message(user_conn, room_name, content):
+    """
+    Mensagem para uma sala: vai para o historico da sala e apenas para os membros
+    Com workers ou federacao, segue uma vez para cada outro processo/no, que
+    entrega aos seus membros
+    """
+    name = normalize_room(room_name)
+    room = rooms.get(name) if name else None
+    if room is None or user_conn["name"] not in room.members:
+        send_to_connection(user_conn, f"msg=[Servidor]: ❌ Você não está na sala {room_name}. Entre nela primeiro.")
+        return
+    new_message = {
+        "sender": user_conn["name"],
+        "destination": name,
+        "type": "msg",
+        "content": content
+    }
+    logger.info("Mensagem Sala", "{} -> {}: {:.50}...", user_conn["name"], name, content, sample=True)
+    if bus is not None:
+        bus.publish({"op": "room", "message": new_message, "worker": bus.worker_id}) # Historico e entrega na ordem do barramento
+        return
+    accept_room_message(new_message)
+    if federation is not None:
+        federation.broadcast({"op": "room", "message": new_message})
+
+def accept_room_message(message):
+    """
+    Registra uma mensagem no historico da sala e entrega aos membros deste
+    processo (exceto o remetente)
+    """
+    room = rooms.open(message["destination"])
+    if room is None:
+        return
+    room.history.append(message)
+    encoded = encode_chat_message(message)
+    for conn in room.members.snapshot():
+        if conn["name"] != message["sender"]:
+            try:
+                send_encoded(conn, encoded)
+            except Exception as e:
+                logger.error("Erro", f"Falha ao enviar mensagem para {conn['name']}: {e}")
+
+def release_taken_name(name):
+    """
+    Desfaz o registro de um usuario cujo nome ficou com outro worker / no
+    O cliente continua conectado e escolhe outro nome
+    Retorna True se havia um usuario local com o nome
+    """
+    conn = search_name_in_connections(name)
+    if conn is None or not connections.unregister(conn):
+        return False
+    presence.leave(name)
+    rooms.leave_all(conn)
+    if conn["session"] is not None:
+        sessions.discard(conn["session"])
+        conn["session"] = None
+    conn["name"] = None
+    send_to_connection(conn, f"msg=[Servidor]: ❌ Nome '{name}' já está sendo usado! Escolha outro nome.")
+    send_to_connection(conn, f"msg=[Servidor]: Digite um novo nome:")
+    return True
+
+def handle_federation_event(event):
+    """
+    Evento recebido de outro no da federacao, ver federation.py
+    No modo eventloop roda na thread do loop (call_soon_threadsafe)
+    """
+    op = event["op"]
+    if op in ("global", "room", "private", "file") and not accept_remote_fields(event["message"], op == "global"):
+        logger.warning("Federação", f"Arquivo de '{event['node']}' sem conteúdo neste nó, descartado")
+        return
+    if op == "join":
+        # Mesmo nome em dois nos (entraram ao mesmo tempo ou a rede estava
+        # partida): fica o usuario do no de nome menor
+        if federation.node > event["node"] and release_taken_name(event["name"]):
+            federation.broadcast({"op": "leave", "name": event["name"]})
+            logger.info("Federação", f"Nome '{event['name']}' ficou com o nó '{event['node']}'")
+        if search_name_in_connections(event["name"]) is None:
+            info = federation.remote_users.get(event["name"]) or {}
+            presence.join(event["name"], info.get("addr", ""), ("node", event["node"]))
+
+    elif op == "leave":
+        presence.leave(event["name"], ("node", event["node"]))
+
+    elif op == "global":
+        accept_global_message(event["message"])
+
+    elif op == "room":
+        accept_room_message(event["message"])
+
+    elif op in ("private", "file") and event["message"]["destination"] != "4all":
+        message = event["message"]
+        dest_conn = search_name_in_connections(message["destination"])
+        if dest_conn is None:
+            return # Saiu enquanto a mensagem estava a caminho
+        record_private_message(message)
+        if message["type"] == "file" and message.get("content") is None:
+            deliver_stored_file(message, [dest_conn])
+        else:
+            send_message_to_user(None, dest_conn, message)
+
+    elif op == "file":
+        accept_global_message(event["message"]) # Ja no armazenamento local (path)
+
+def accept_remote_fields(message, acquire):
+    """
+    Limpa uma mensagem recebida de outro no: caminhos locais (path, spilled)
+    e o id do historico nunca sao aceitos de fora; o caminho de um arquivo e
+    remontado aqui, e so para um sha256 valido cujo conteudo esta no
+    armazenamento deste no
+    - acquire: a mensagem vai para o historico global, que libera a
+      referencia ao conteudo quando ela sai (os eventos "file" ja chegam com
+      a referencia tomada por federation.py)
+    Retorna False se e um arquivo sem conteudo nem copia local
+    """
+    for field in TRANSIENT_FIELDS:
+        message.pop(field, None)
+    digest = message.get("sha256")
+    if digest is not None:
+        if file_store.acquire(digest, count_dedup=False) if acquire else file_store.has(digest):
+            message["path"] = file_store.path(digest)
+        else:
+            del message["sha256"] # Sem referencia local para liberar depois
+    return message["type"] != "file" or message.get("content") is not None or "path" in message
+
+def deliver_stored_file(message, recipients):
+    """
+    Entrega um arquivo que ja esta no armazenamento (envio dispensado)
+    Cada destinatario recebe a copia do disco em pedacos; clientes no modo
+    antigo recebem a referencia do historico
+    """
+    for conn in recipients:
+        if not conn["framed"] or not conn["stream"]:
+            if "id" in message:
+                send_to_connection(conn, format_history_entry(message))
+            continue
+        try:
+            conn["stream"](open_file_stream(message))
+        except OSError as e:
+            logger.warning("Arquivo", f"Falha ao abrir {message['path']}: {e}")
+
+def start_file_upload(client_connection, message):
+    """
+    Inicio de um envio de arquivo em pedacos (file_begin)
+    - Valida o destino
+    - Conteudo ja armazenado (sha256 conhecido): responde file_exists e
+      entrega a copia do disco, sem receber nada
+    - Envio interrompido do mesmo arquivo: retoma de onde parou
+      (file_accept com o offset); os destinatarios recebem o arquivo do
+      disco quando o envio terminar
+    - Caso contrario avisa os destinatarios (file_begin com o id do servidor),
+      prepara o arquivo no armazenamento e responde file_accept com offset 0
+    - Erros: file_reject
+    """
+    handle = message.get("message")
+    destination = message.get("control")
+    filename = os.path.basename(message.get("filename") or "arquivo_recebido")
+
+    def reject(reason):
+        send_to_connection(client_connection, f"file_reject={handle}||{reason}")
+
+    if not client_connection["framed"]:
+        reject("Envio em pedaços exige o protocolo enquadrado")
+        return
+    try:
+        handle = int(handle)
+        size = int(message["size"])
+    except (KeyError, TypeError, ValueError):
+        reject("Pedido de envio inválido")
+        return
+    if size < 0 or handle in client_connection["uploads"]:
+        reject("Pedido de envio inválido")
+        return
+
+    if destination == "4all":
+        recipients = [conn for conn in connections.snapshot() if conn is not client_connection]
+    else:
+        dest_conn = search_name_in_connections(destination)
+        remote = remote_user_info(destination) if dest_conn is None else None
+        if dest_conn is None and remote is None:
+            reject(f"Usuário '{destination}' não encontrado ou offline.")
+            return
+        if not (dest_conn or remote)["framed"]:
+            reject(f"Usuário '{destination}' não suporta envio em pedaços.")
+            return
+        # Destinatario em outro worker / no: recebe do disco quando o envio terminar
+        recipients = [dest_conn] if dest_conn else []
+
+    sender = client_connection["name"]
+    digest = message.get("sha256") or ""
+    if file_store.acquire(digest, size):
+        new_message = {
+            "sender": sender,
+            "destination": destination,
+            "type": "file",
+            "content": None,
+            "filename": filename,
+            "size": size,
+            "sha256": digest,
+            "path": file_store.path(digest)
+        }
+        send_to_connection(client_connection, f"file_exists={handle}")
+        logger.info("Arquivo", "{} -> {}: '{}' já armazenado, envio dispensado", sender, destination, filename, sample=True)
+        record_file_message(new_message)
+        deliver_stored_file(new_message, recipients)
+        return
+
+    tid = next(transfer_ids)
+    upload = {
+        "tid": tid,
+        "sender": sender,
+        "destination": destination,
+        "filename": filename,
+        "size": size,
+        "sha256": digest,
+        "acked": 0,
+        "retry": None, # Offset pedido em file_retry (pedacos em voo sao descartados ate la)
+        "recipients": [],
+        "legacy": []
+    }
+    with partial_uploads_lock:
+        partial = partial_uploads.pop((sender, digest), None) if digest else None
+    if partial is not None and partial.size <= size:
+        # Retomada: os destinatarios recebem o arquivo completo do disco no final
+        upload["pending"] = partial
+        upload["deliver_later"] = recipients
+    else:
+        if partial is not None:
+            partial.abort()
+        try:
+            upload["pending"] = file_store.begin()
+        except OSError as e:
+            logger.warning("Arquivo", f"Falha ao criar arquivo temporário: {e}")
+            reject("Falha ao gravar o arquivo no servidor")
+            return
+        upload["deliver_later"] = []
+        begin = encode_frame(f"file_begin={sender}||{filename}||{tid}||{size}||{digest}||0")
+        # Clientes no modo antigo nao entendem pedacos: recebem a referencia no final
+        upload["recipients"] = [conn for conn in recipients if conn["framed"] and send_reliable(conn, begin)]
+        upload["legacy"] = [conn for conn in recipients if not conn["framed"]]
+    upload["received"] = upload["acked"] = upload["pending"].size
+    client_connection["uploads"][handle] = upload
+    send_to_connection(client_connection, f"file_accept={handle}||{tid}||{upload['received']}")
+    resumed = f", retomado em {upload['received']/1024:.1f}KB" if upload["received"] else ""
+    logger.info("Arquivo", "{} -> {}: '{}' ({:.1f}KB, transferência #{}{})", sender, destination, filename, size / 1024, tid, resumed, sample=True)
+
+def relay_file_chunk(client_connection, payload):
+    """
+    Repassa um pedaco recebido a todos os destinatarios da transferencia
+    - Confere o CRC32: pedaco corrompido gera file_retry para o remetente,
+      que reenvia a partir do ultimo offset confirmado
+    - O mesmo buffer (cabecalho novo + memoryview dos dados recebidos) vai
+      para a fila de cada destinatario, sem copia. Um destinatario que nao
+      acompanha recebe file_abort e sai da transferencia; os demais seguem.
+    - A cada FILE_ACK_BYTES confirma ao remetente o que ja foi gravado (file_ack)
+    """
+    handle, offset, crc, data = decode_chunk(payload)
+    upload = client_connection["uploads"].get(handle)
+    if upload is None:
+        return # Transferencia desconhecida ou ja abortada: descartar
+    if upload["retry"] is not None:
+        if offset != upload["received"]:
+            return # Pedacos enviados antes do cliente ver o file_retry
+        upload["retry"] = None
+    if offset != upload["received"] or offset + len(data) > upload["size"]:
+        abort_file_upload(client_connection, handle, "Pedaço fora de ordem")
+        return
+    if chunk_crc(data) != crc:
+        upload["retry"] = offset
+        send_to_connection(client_connection, f"file_retry={handle}||{offset}")
+        logger.warning("Arquivo", f"Pedaço corrompido na transferência #{upload['tid']} (offset {offset}): pedindo reenvio")
+        return
+    upload["received"] += len(data)
+    upload["pending"].write(data)
+    if upload["received"] - upload["acked"] >= FILE_ACK_BYTES:
+        upload["acked"] = upload["received"]
+        send_to_connection(client_connection, f"file_ack={handle}||{upload['received']}")
+
+    item = (encode_chunk_header(upload["tid"], offset, len(data), crc), data)
+    for conn in list(upload["recipients"]):
+        if not send_reliable(conn, item):
+            upload["recipients"].remove(conn)
+            send_to_connection(conn, f"file_abort={upload['tid']}||Você não acompanhou a transferência")
+            logger.warning("Arquivo", f"{conn['name']} não acompanhou a transferência #{upload['tid']}: abortada para ele")
+
+def finish_file_upload(client_connection, message):
+    """
+    Fim de um envio em pedacos (file_end): fecha a transferencia para os
+    destinatarios e registra a mensagem no historico
+    """
+    try:
+        handle = int(message.get("message"))
+    except (TypeError, ValueError):
+        return
+    upload = client_connection["uploads"].get(handle)
+    if upload is None or upload["retry"] is not None:
+        return # Com reenvio pendente, o cliente ainda vai mandar o resto e outro file_end
+    if upload["received"] != upload["size"]:
+        abort_file_upload(client_connection, handle, "Arquivo incompleto")
+        return
+    try:
+        digest = file_store.commit(upload["pending"])
+    except OSError as e:
+        logger.warning("Arquivo", f"Falha ao armazenar '{upload['filename']}': {e}")
+        abort_file_upload(client_connection, handle, "Falha ao gravar o arquivo no servidor")
+        return
+    del client_connection["uploads"][handle]
+    if upload["sha256"] and upload["sha256"] != digest:
+        logger.warning("Arquivo", f"'{upload['filename']}': sha256 informado não confere com o conteúdo recebido")
+
+    new_message = {
+        "sender": upload["sender"],
+        "destination": upload["destination"],
+        "type": "file",
+        "content": None, # Os dados ficam apenas no armazenamento
+        "filename": upload["filename"],
+        "size": upload["size"],
+        "sha256": digest,
+        "path": file_store.path(digest)
+    }
+    end = encode_frame(f"file_end={upload['tid']}")
+    for conn in upload["recipients"]:
+        send_reliable(conn, end)
+
+    record_file_message(new_message)
+    if "id" in new_message: # Modo multiprocesso: o id so existe quando o barramento devolve a mensagem
+        for conn in upload["legacy"]:
+            send_to_connection(conn, format_history_entry(new_message))
+    deliver_stored_file(new_message, upload["deliver_later"])
+    send_to_connection(client_connection, f"file_done={handle}")
+
+def abort_file_upload(client_connection, handle, reason, keep_partial=False):
+    """
+    Cancela um envio em pedacos: avisa remetente e destinatarios
+    - keep_partial=True (remetente caiu): o que ja chegou fica guardado para
+      retomada, se o arquivo foi identificado pelo sha256
+    - Caso contrario o arquivo parcial e apagado
+    """
+    upload = client_connection["uploads"].pop(handle, None)
+    if upload is None:
+        return
+    for conn in upload["recipients"]:
+        send_to_connection(conn, f"file_abort={upload['tid']}||{reason}")
+    if keep_partial and upload["sha256"] and upload["received"]:
+        keep_partial_upload((upload["sender"], upload["sha256"]), upload["pending"])
+    else:
+        upload["pending"].abort()
+    send_to_connection(client_connection, f"file_reject={handle}||{reason}")
+    logger.info("Arquivo", f"Transferência #{upload['tid']} de {upload['sender']} cancelada: {reason}")
+
+def keep_partial_upload(key, pending):
+    """
+    Guarda um envio interrompido para retomada
+    Acima de PARTIAL_UPLOADS_MAX, o mais antigo e descartado
+    """
+    try:
+        pending.file.flush()
+    except OSError:
+        pending.abort()
+        return
+    with partial_uploads_lock:
+        previous = partial_uploads.pop(key, None)
+        partial_uploads[key] = pending
+        while len(partial_uploads) > PARTIAL_UPLOADS_MAX:
+            _, oldest = partial_uploads.popitem(last=False)
+            oldest.abort()
+    if previous is not None:
+        previous.abort()
+
+def process_payload(client_connection, payload):
+    """
+    Despacha um payload recebido: pedaco binario de arquivo, bloco comprimido
+    de mensagens ou mensagem JSON
+    """
+    if client_connection["framed"] and is_compressed(payload):
+        payloads = decompress_payload(payload)
+        if client_connection["compressor"] is not None:
+            client_connection["compressor"].count_inbound(len(payload), payloads)
+        for inner in payloads:
+            process_payload(client_connection, inner)
+    elif client_connection["framed"] and is_chunk(payload):
+        started = time.perf_counter()
+        relay_file_chunk(client_connection, payload)
+        metrics.observe("file_chunk", time.perf_counter() - started, len(payload))
+        throttle_file_bytes(client_connection, len(payload))
+    else:
+        # Latencia: do recebimento ate a mensagem estar na fila de saida de cada destinatario
+        started = time.perf_counter()
+        if client_connection["envelope"] is not None and is_envelope(payload):
+            message = decode_client_message(payload, user_ids.name)
+        else:
+            message = json.loads(payload.decode(FORMAT))
+        wait = client_connection["limits"].check(message["type"])
+        if wait:
+            reject_rate_limited(client_connection, message["type"], wait)
+            return
+        process_message(client_connection, message)
+        message_type = message["type"] if message["type"] in METRIC_MESSAGE_TYPES else "other"
+        metrics.observe(message_type, time.perf_counter() - started, len(payload))
+        if message["type"] == "file":
+            throttle_file_bytes(client_connection, len(payload)) # Arquivo inteiro em base64 (modo antigo)
+
+def reject_rate_limited(client_connection, message_type, wait):
+    """
+    Mensagem acima do limite: descartada, com um aviso ao cliente (no maximo
+    um por segundo). Depois de RATE_LIMIT_DISCONNECT recusas seguidas, a
+    conexao e encerrada (a excecao sobe ate o laco de leitura)
+    """
+    limits = client_connection["limits"]
+    if limits.strikes >= RATE_LIMIT_DISCONNECT:
+        raise ConnectionError(f"{limits.strikes} mensagens seguidas acima do limite")
+    if limits.should_notify():
+        logger.warning("Limite", f"{client_connection['name'] or client_connection['addr']}: mensagens '{message_type}' acima do limite")
+        send_to_connection(client_connection, f"msg=[Servidor]: ⏳ Limite de mensagens ({message_type}) excedido: "
+                                              f"mensagem descartada. Tente de novo em {max(wait, 0.1):.1f} s.")
+
+def throttle_file_bytes(client_connection, size):
+    """
+    Bytes de arquivo recebidos: acima do limite, a conexao para de ser lida
+    pelo tempo que falta (o TCP segura o remetente)
+    """
+    wait = client_connection["limits"].file_bytes(size)
+    if wait:
+        client_connection["throttle"](wait)
+
+def check_heartbeats(now=None):
+    """
+    Processa os prazos vencidos na roda de temporizadores (a cada HEARTBEAT_TICK)
+    - Sem nome depois de NAME_TIMEOUT: encerra
+    - Com heartbeat: ociosa ha HEARTBEAT_INTERVAL recebe ping (repetido a cada
+      intervalo); ociosa ha HEARTBEAT_TIMEOUT e encerrada
+    - Demais conexoes saem da roda (nao respondem a ping)
+    Enviar um ping ou encerrar so mexe na fila/socket da conexao, entao roda
+    tanto na thread do heartbeat (modo thread) quanto no loop de eventos
+    A conexao e encerrada com shutdown: a leitura termina e a limpeza normal
+    (remove_connection) tira o usuario da lista e das salas
+    """
+    now = time.monotonic() if now is None else now
+    for conn, client_connection in heartbeats.advance(now):
+        idle = now - client_connection["last_seen"]
+        if client_connection["name"] is None:
+            if idle < NAME_TIMEOUT:
+                heartbeats.schedule(conn, client_connection["last_seen"] + NAME_TIMEOUT, client_connection)
+                continue
+            logger.warning("Heartbeat", f"{client_connection['addr']} não registrou um nome em {NAME_TIMEOUT} s: desconectando")
+        elif not client_connection["heartbeat"]:
+            continue
+        elif idle < HEARTBEAT_INTERVAL:
+            heartbeats.schedule(conn, client_connection["last_seen"] + HEARTBEAT_INTERVAL, client_connection)
+            continue
+        elif idle < HEARTBEAT_TIMEOUT:
+            send_to_connection(client_connection, f"ping={int(time.time() * 1000)}")
+            metrics.count("heartbeat_pings")
+            heartbeats.schedule(conn, min(now + HEARTBEAT_INTERVAL, client_connection["last_seen"] + HEARTBEAT_TIMEOUT), client_connection)
+            continue
+        else:
+            logger.warning("Heartbeat", f"{client_connection['name']} ({client_connection['addr']}) sem resposta há {idle:.0f} s: desconectando")
+        metrics.count("connections_reaped")
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def heartbeat_thread():
+    """
+    Modo thread: avanca a roda de temporizadores a cada HEARTBEAT_TICK
+    """
+    while True:
+        time.sleep(HEARTBEAT_TICK)
+        try:
+            check_heartbeats()
+        except Exception as e:
+            logger.error("Erro", f"Heartbeat: {e}")
+
+def heartbeat_tick(loop):
+    """
+    Modo event-loop: o mesmo, num temporizador do proprio loop
+    """
+    check_heartbeats()
+    loop.call_later(HEARTBEAT_TICK, heartbeat_tick, loop)
+
+def admit_connection(conn, addr):
+    """
+    Controle de admissao, chamado ao aceitar uma conexao (modos thread e event-loop)
+    Acima de MAX_CONNECTIONS, a conexao e recusada: recebe o aviso numa thread
+    curta (no maximo REFUSE_THREADS ao mesmo tempo; sem vaga, so e fechada)
+    Retorna False se a conexao foi recusada
+    """
+    if admission.admit():
+        set_keepalive(conn, True) # Desligado de novo se o cliente pedir heartbeat
+        return True
+    metrics.count("connections_refused")
+    if refusal_slots.acquire(blocking=False):
+        threading.Thread(target=refuse_connection, args=(conn, addr), daemon=True).start()
+    else:
+        conn.close()
+    return False
+
+def set_keepalive(conn, enabled):
+    """
+    TCP keepalive para conexoes sem heartbeat (modo antigo, ai_client.py,
+    clientes que nao pedem): o SO sonda a conexao ociosa e a derruba se o
+    outro lado sumiu, e o recv falha como numa desconexao comum
+    Prazos curtos (KEEPALIVE_*) so onde o SO permite ajusta-los
+    """
+    try:
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1 if enabled else 0)
+        if enabled:
+            for option, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                                  ("TCP_KEEPCNT", KEEPALIVE_COUNT)):
+                if hasattr(socket, option):
+                    conn.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+    except OSError:
+        pass # Conexao ja fechada
+
+def refuse_connection(conn, addr):
+    """
+    Avisa uma conexao recusada (servidor cheio) no modo que ela pedir no handshake
+    """
+    try:
+        conn.settimeout(REFUSE_TIMEOUT)
+        framed, _ = read_handshake(conn)
+        conn.sendall(EncodedMessage("msg=[Servidor]: ❌ Servidor cheio. Tente novamente mais tarde.").for_connection(framed))
+        logger.info("Conexão", f"{addr} recusada: limite de {admission.max_connections} conexões")
+    except OSError:
+        pass
+    finally:
+        conn.close()
+        refusal_slots.release()
+
+def metrics_report():
+    """
+    Relatorio de metricas (tipo "metrics" e endpoint HTTP)
+    - Contadores e latencias por tipo de mensagem (metrics.py)
+    - Valores do momento: conexoes, bytes, filas de saida, memoria do
+      historico, armazenamento de arquivos e federacao
+    Conexoes ainda sem nome entram nos bytes so quando encerram
+    """
+    report = metrics.snapshot()
+    counters = report.pop("counters")
+    users = connections.snapshot()
+    queues = [conn["queue"].stats() for conn in users]
+    report["connections"] = {
+        "active": counters.get("connections_opened", 0) - counters.get("connections_closed", 0),
+        "users": len(users),
+        "opened": counters.get("connections_opened", 0),
+        "closed": counters.get("connections_closed", 0)
+    }
+    report["bytes"] = {
+        "in": counters.get("bytes_in", 0) + sum(conn["bytes_in"] for conn in users),
+        "out": counters.get("bytes_out", 0) + sum(queue["sent_bytes"] for queue in queues)
+    }
+    report["queues"] = {
+        "depth": sum(queue["depth"] for queue in queues),
+        "max_depth": max((queue["depth"] for queue in queues), default=0),
+        "bytes": sum(queue["bytes"] for queue in queues),
+        "dropped": sum(queue["dropped"] for queue in queues)
+    }
+    report["history"] = global_messages.memory_usage()
+    report["private_history"] = private_messages.memory_usage()
+    report["file_store"] = file_store.stats()
+    report["presence"] = presence.stats()
+    report["log"] = logger.stats()
+    report["heartbeat"] = {
+        "tracked": len(heartbeats),
+        "pings": counters.get("heartbeat_pings", 0),
+        "reaped": counters.get("connections_reaped", 0)
+    }
+    report["limits"] = dict(admission.stats(),
+                            rate_limited=counters.get("rate_limited", 0) + sum(conn["limits"].rejected for conn in users),
+                            throttled_s=counters.get("throttled_s", 0) + sum(conn["limits"].throttled_s for conn in users))
+    report["rooms"] = rooms.stats()
+    report["sessions"] = dict(sessions.stats(), journal=journal.stats())
+    report["search"] = search_index.stats()
+    if federation is not None:
+        report["federation"] = federation.stats()
+    return report
 
 def handle_clients(conn, addr):
     """
     Funcao principal para gerenciar cada cliente conectado
     Roda em thread separada para cada conexao
-    Processa todos os tipos de mensagem JSON recebidas:
-    - "name": definir nome do usuario
-    - "online_usr": solicitar lista de usuarios
-    - "msg": enviar mensagem de texto
-    - "file": enviar arquivo
+    - Detecta o modo do protocolo (enquadrado ou antigo) pelo handshake
+    - No modo enquadrado, um unico recv pode trazer varias mensagens:
+      todas sao remontadas pelo FrameBuffer e processadas em sequencia
+      (mensagens JSON ou pedacos de arquivo, ver process_payload)
+    - No modo antigo, cada recv e tratado como um JSON completo
+    Tipos de mensagem: ver process_message()
     """
-    print(f"[Conexão] Novo usuário conectado: {addr}")
-    global connections
+    logger.info("Conexão", "Novo usuário conectado: {}", addr, sample=True)
 
-    user_conn = None # Sera definido quando o usuario enviar seu nome
+    # Registro da conexao; "name" sera definido quando o usuario enviar seu nome
+    client_connection = new_connection(conn, addr) # Inicia tambem a thread escritora
+    frame_buffer = FrameBuffer()
 
-    while True:
+    try:
+        framed, data = read_handshake(conn)
+        client_connection["framed"] = framed
+        if framed:
+            client_connection["history_delay"] = 0 # Quadros dispensam o delay
+            logger.info("Conexão", "{} usando protocolo enquadrado", addr, sample=True)
+    except Exception as e:
+        logger.error("Erro", f"Handshake com {addr} falhou. Motivo: {e}")
+        data = None
+
+    while data is not None:
         try:
-            data = conn.recv(2048 * 10) # Buffer grande para arquivos
+            client_connection["bytes_in"] += len(data)
+            client_connection["last_seen"] = time.monotonic()
+            if framed:
+                for payload in frame_buffer.feed(data):
+                    process_payload(client_connection, payload)
+            elif data:
+                process_payload(client_connection, data)
+
+            data = conn.recv(RECV_SIZE if framed else 2048 * 10) # Buffer grande para arquivos
             if not data:
                 break
 
-            message = json.loads(data.decode(FORMAT))
-
-            if message["type"] == "name":
-                name = message["message"]
-                
-                # Verificar se o nome ja existe
-                if name_already_exists(name):
-                    error_msg = f"❌ Nome '{name}' já está sendo usado! Escolha outro nome."
-                    conn.send(f"msg=[Servidor]: {error_msg}".encode(FORMAT))
-                    # Solicitar novo nome
-                    conn.send(f"msg=[Servidor]: Digite um novo nome:".encode(FORMAT))
-                    continue
-                
-                # Criar registro do usuario
-                user_conn = {"conn": conn, "addr": addr, "name": name}
-                connections.append(user_conn)
-                print(f"[Nome definido] {name} conectado de {addr}")
-                
-                # Enviar mensagem de boas-vindas
-                welcome_msg = f"✅ Bem-vindo ao chat, {name}!"
-                conn.send(f"msg=[Servidor]: {welcome_msg}".encode(FORMAT))
-                
-                # Enviar historico de mensagens globais
-                view_global_history(user_conn)
-
-            elif message["type"] == "online_usr":
-                # Verificar se o usuário já se registrou
-                if user_conn is None:
-                    error_msg = "❌ Você precisa definir um nome primeiro!"
-                    conn.send(f"msg=[Servidor]: {error_msg}".encode(FORMAT))
-                    continue
-                    
-                # Envia a lista de usuários online
-                send_online_users_list(user_conn)
-
-            elif message["type"] == "msg":
-                # Verificar se o usuário já se registrou
-                if user_conn is None:
-                    error_msg = "❌ Você precisa definir um nome primeiro!"
-                    conn.send(f"msg=[Servidor]: {error_msg}".encode(FORMAT))
-                    continue
-                    
-                if message["control"] == "4all":
-                    # Mensagem global para todos
-                    new_message = {
-                        "sender": user_conn["name"],
-                        "destination": "all",
-                        "type": "msg",
-                        "content": message["message"]
-                    }
-                    global_messages.append(new_message)
-                    print(f"[Mensagem Global] {user_conn['name']}: {message['message'][:50]}...")
-                    send_message_to_all(user_conn)
-                else:
-                    # Mensagem privada para usuario especifico
-                    destination = message["control"]
-                    dest_conn = search_name_in_connections(destination)
-                    if dest_conn:
-                        new_message = {
-                            "sender": user_conn["name"],
-                            "destination": destination,
-                            "type": "msg",
-                            "content": message["message"]
-                        }
-                        private_messages.append(new_message)
-                        print(f"[Mensagem Privada] {user_conn['name']} -> {destination}: {message['message'][:50]}...")
-                        send_message_to_user(user_conn, dest_conn, is_private=True)
-                    else:
-                        # Enviar mensagem de erro para o remetente
-                        error_msg = f"❌ Usuário '{destination}' não encontrado ou offline."
-                        conn.send(f"msg=[Servidor]: {error_msg}".encode(FORMAT))
-
-            elif message["type"] == "file":
-                # Verificar se o usuário já se registrou
-                if user_conn is None:
-                    error_msg = "❌ Você precisa definir um nome primeiro!"
-                    conn.send(f"msg=[Servidor]: {error_msg}".encode(FORMAT))
-                    continue
-                    
-                destination = message["control"]
-                filename = message.get("filename", "arquivo_recebido")
-                file_data = message["message"] # Dados em base64
-                
-                # Verificar tamanho do arquivo (em Base64)
-                file_size_b64 = len(file_data)
-                file_size_bytes = (file_size_b64 * 3) // 4  # Aproximação do tamanho real
-                
-                print(f"[Arquivo] {user_conn['name']} enviando '{filename}' ({file_size_bytes/1024:.1f}KB)")
-                
-                new_message = {
-                    "sender": user_conn["name"],
-                    "destination": destination,
-                    "type": "file",
-                    "content": file_data,
-                    "filename": filename
-                }
-                
-                if destination == "4all":
-                    # Arquivo global para todos
-                    global_messages.append(new_message)
-                    print(f"[Arquivo Global] {user_conn['name']}: {filename}")
-                    send_message_to_all(user_conn)
-                else:
-                    # Arquivo privado para usuario especifico
-                    dest_conn = search_name_in_connections(destination)
-                    if dest_conn:
-                        private_messages.append(new_message)
-                        print(f"[Arquivo Privado] {user_conn['name']} -> {destination}: {filename}")
-                        send_message_to_user(user_conn, dest_conn, is_private=True)
-                    else:
-                        # Enviar mensagem de erro para o remetente
-                        error_msg = f"❌ Usuário '{destination}' não encontrado. Arquivo '{filename}' não foi entregue."
-                        conn.send(f"msg=[Servidor]: {error_msg}".encode(FORMAT))
-
         except json.JSONDecodeError as e:
-            print(f"[Erro JSON] Conexão {addr}: {e}")
+            logger.error("Erro JSON", f"Conexão {addr}: {e}")
+            break
+        except FrameError as e:
+            logger.error("Erro Protocolo", f"Conexão {addr}: {e}")
             break
         except Exception as e:
-            print(f"[Erro] Conexão com {addr} encerrada. Motivo: {e}")
+            logger.error("Erro", f"Conexão com {addr} encerrada. Motivo: {e}")
             break
 
     # Limpeza da conexao ao desconectar
-    if user_conn:
-        connections.remove(user_conn)
-        print(f"[Desconexão] {user_conn['name']} ({addr}) desconectado")
-        print(f"[Conexões ativas]: {len(connections)}")
-    else:
-        # Remover conexao mesmo se user_conn nao foi criado (nome nao definido)
-        for i, conn_data in enumerate(connections):
-            if conn_data["conn"] == conn:
-                connections.pop(i)
-                print(f"[Desconexão] Usuário não identificado ({addr}) desconectado")
-                print(f"[Conexões ativas]: {len(connections)}")
-                break
-    
+    remove_connection(client_connection)
     conn.close()
 
-def start():
+def start(mode="thread", port=PORT, discovery=True):
     """
     Funcao principal do servidor
-    - Inicia o sistema de descoberta automatica
+    - Inicia o sistema de descoberta automatica (discovery=False: outro
+      worker ja responde a descoberta)
     - Coloca o servidor em modo de escuta
-    - Cria thread separada para cada cliente que se conecta
+    - mode="thread": cria thread separada para cada cliente que se conecta
+    - mode="eventloop": atende todos os clientes num unico loop de eventos
+      (selectors), ver event_server.py
+    - Com barramento (worker do modo multiprocesso), tambem le os eventos
+      dos outros workers
+    - Com federacao, liga-se aos outros nos
+    - Com METRICS_PORT, abre o endpoint HTTP local de metricas
     """
-    print("[Servidor] Iniciando...")
-    handle_discovery() # Inicia descoberta automatica em background
-    server.listen()
-    print(f"[Servidor] Ouvindo em {SERVER_IP}:{PORT}")
-    print(f"[Servidor] Pronto para receber conexões!")
+    logger.info("Servidor", "Iniciando...")
+    if discovery:
+        handle_discovery() # Inicia descoberta automatica em background
+    server.bind((SERVER_IP, port))
+    server.listen(LISTEN_BACKLOG)
+    logger.info("Servidor", f"Ouvindo em {SERVER_IP}:{port} (modo {mode})")
+    logger.info("Servidor", f"Pronto para receber conexões!")
+    if METRICS_PORT:
+        start_metrics_http(METRICS_PORT, metrics_report)
+
+    if mode == "eventloop":
+        from event_server import EventLoopServer
+        loop = EventLoopServer(server, new_connection, process_payload, remove_connection, admit_connection)
+        if bus is not None:
+            loop.add_reader(bus.sock, bus.read) # Eventos do barramento no proprio loop, sem locks
+        loop.call_later(HEARTBEAT_TICK, heartbeat_tick, loop)
+        if federation is not None:
+            # Os eventos dos outros nos chegam nas threads da federacao: rodam na thread do loop
+            federation.handler = lambda event: loop.call_soon_threadsafe(handle_federation_event, event)
+            federation.start()
+        loop.serve_forever()
+        return
+
+    if bus is not None:
+        threading.Thread(target=bus.run, daemon=True).start()
+    threading.Thread(target=heartbeat_thread, daemon=True).start()
+    if federation is not None:
+        federation.start()
     
     while True:
         try:
             conn, addr = server.accept() # Aceita nova conexao
+            if not admit_connection(conn, addr):
+                continue
             # Cria thread separada para cada cliente
-            thread = threading.Thread(target=handle_clients, args=(conn, addr))
+            thread = threading.Thread(target=handle_clients, args=(conn, addr), daemon=True) # Nao segura o encerramento
             thread.start()
-            print(f"[Conexões ativas]: {threading.active_count() - 1}")
+            logger.info("Conexões ativas", "{}", admission.active, sample=True)
         except KeyboardInterrupt:
-            print("\n[Servidor] Encerrando servidor...")
+            logger.info("Servidor", "Encerrando servidor...")
             break
         except Exception as e:
-            print(f"[Erro do Servidor]: {e}")
+            logger.error("Erro do Servidor", f"{e}")
+
+def start_workers(count, mode="thread", port=PORT, log_dir=None, fsync=MESSAGE_LOG_FSYNC):
+    """
+    Modo multiprocesso: `count` workers aceitando conexoes na mesma porta
+    - Cada worker e um processo (fork) com o seu proprio socket de escuta e
+      SO_REUSEPORT: o kernel distribui as conexoes e cada worker usa um nucleo,
+      no modo escolhido (thread ou eventloop)
+    - Mensagens globais, privadas e a lista de usuarios passam pelo
+      barramento (bus.py); o hub roda neste processo
+    - O historico ja carregado e herdado por todos; apenas o worker
+      PERSIST_WORKER responde a descoberta e grava o log de mensagens
+    - Os workers compartilham o armazenamento de arquivos, que passa a nao
+      apagar conteudo (outro worker pode ainda apontar para ele)
+    """
+    if not hasattr(socket, "SO_REUSEPORT") or not hasattr(os, "fork"):
+        logger.info("Servidor", "SO_REUSEPORT/fork indisponível neste sistema: usando um único processo")
+        start(mode, port)
+        return
+    file_store.shared = True
+    pairs = [socket.socketpair() for _ in range(count)] # (ponta do hub, ponta do worker)
+    pids = []
+    for worker_id in range(count):
+        pid = os.fork()
+        if pid == 0:
+            for other_id, (hub_end, worker_end) in enumerate(pairs):
+                hub_end.close()
+                if other_id != worker_id:
+                    worker_end.close()
+            try:
+                run_worker(worker_id, pairs[worker_id][1], mode, port, log_dir, fsync)
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    for _, worker_end in pairs:
+        worker_end.close()
+    logger.info("Servidor", f"{count} workers na porta {port} (modo {mode}), pids {pids}")
+
+    hub = BusHub({worker_id: hub_end for worker_id, (hub_end, _) in enumerate(pairs)})
+    try:
+        hub.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Servidor", "Encerrando workers...")
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+def stop_on_sigterm(signum, frame):
+    """
+    SIGTERM encerra como o Ctrl+C: o processo principal do modo --workers
+    tambem encerra os workers, e cada processo fecha o log de mensagens
+    """
+    raise KeyboardInterrupt
+
+def run_worker(worker_id, bus_socket, mode, port, log_dir, fsync):
+    """
+    Corpo de um worker (processo filho de start_workers)
+    """
+    global server, bus, METRICS_PORT
+    # Socket de escuta proprio: o herdado do processo principal e compartilhado por todos
+    server.close()
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    bus = WorkerBus(bus_socket, worker_id, handle_bus_event)
+    if worker_id == PERSIST_WORKER and log_dir:
+        # O log foi fechado antes do fork (a thread de fsync nao sobrevive a ele); so este worker grava
+        global_messages.log = MessageLog(os.path.join(log_dir, "global"), fsync)
+        private_messages.log = MessageLog(os.path.join(log_dir, "private"), fsync)
+    if METRICS_PORT:
+        METRICS_PORT += worker_id # Cada worker tem as suas metricas, em portas seguidas
+    logger.info(f"Worker {worker_id}", f"pid {os.getpid()}")
+    try:
+        start(mode, port, discovery=worker_id == PERSIST_WORKER)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for log in (global_messages.log, private_messages.log):
+            if log is not None:
+                log.close()
+        logger.flush() # os._exit a seguir nao roda o atexit
+
+def parse_args():
+    """
+    Le as opcoes de linha de comando do servidor
+    """
+    parser = argparse.ArgumentParser(description="Servidor do chat")
+    parser.add_argument("--mode", choices=["thread", "eventloop"], default="thread",
+                        help="thread: uma thread por conexao | eventloop: loop de eventos unico (selectors)")
+    parser.add_argument("--port", type=int, default=PORT, help="Porta TCP do chat")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="Processos aceitando conexoes na mesma porta (SO_REUSEPORT); 1 = processo unico")
+    parser.add_argument("--federation-port", type=int, default=FEDERATION_PORT,
+                        help="Porta para ligacoes com outros servidores (federacao); omitida = servidor isolado")
+    parser.add_argument("--peer", action="append", default=[], metavar="HOST:PORTA",
+                        help="Porta de federacao de outro no (pode repetir)")
+    parser.add_argument("--federation-host", default=FEDERATION_HOST,
+                        help="Endereco da porta de federacao (padrao: so esta maquina; outro exige --federation-secret)")
+    parser.add_argument("--federation-secret", default=FEDERATION_SECRET,
+                        help="Segredo compartilhado pelos nos (ou CHAT_FEDERATION_SECRET no ambiente)")
+    parser.add_argument("--node", default=None,
+                        help="Nome deste no na federacao (padrao: maquina:porta)")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="Porta do endpoint HTTP local de metricas (com --workers, uma porta por worker)")
+    parser.add_argument("--history-messages", type=int, default=HISTORY_MAX_MESSAGES,
+                        help="Maximo de mensagens no historico global")
+    parser.add_argument("--search-messages", type=int, default=SEARCH_MAX_MESSAGES,
+                        help="Mensagens no indice de busca (as mais antigas saem primeiro)")
+    parser.add_argument("--history-mb", type=float, default=HISTORY_MAX_BYTES / 1024 / 1024,
+                        help="Orcamento de memoria do historico global (MB)")
+    parser.add_argument("--history-spill", default=HISTORY_SPILL_DIR,
+                        help="Diretorio para payloads antigos de arquivos ('' = descartar)")
+    parser.add_argument("--file-store", default=FILE_STORE_DIR,
+                        help="Diretorio do armazenamento de arquivos (por sha256)")
+    parser.add_argument("--log-dir", default=MESSAGE_LOG_DIR,
+                        help="Diretorio do log persistente de mensagens ('' = historico so em memoria)")
+    parser.add_argument("--fsync", choices=FSYNC_POLICIES, default=MESSAGE_LOG_FSYNC,
+                        help="Quando o log de mensagens e gravado em disco (fsync)")
+    parser.add_argument("--queue-items", type=int, default=OUTBOUND_MAX_ITEMS,
+                        help="Mensagens pendentes por cliente antes de aplicar a politica")
+    parser.add_argument("--queue-mb", type=float, default=OUTBOUND_MAX_BYTES / 1024 / 1024,
+                        help="MB pendentes por cliente antes de aplicar a politica")
+    parser.add_argument("--overflow-policy", choices=POLICIES, default=OUTBOUND_POLICY,
+                        help="O que fazer com clientes lentos quando a fila enche")
+    parser.add_argument("--log-level", choices=list(LEVELS), default="info",
+                        help="Nivel minimo das linhas do log do servidor (saida padrao)")
+    parser.add_argument("--log-sample", type=int, default=1,
+                        help="Registra 1 a cada N linhas por mensagem/conexao (erros e avisos sempre saem)")
+    parser.add_argument("--log-format", choices=["text", "json"], default="text",
+                        help="text: '[Tag] texto' | json: uma linha JSON por registro")
+    parser.add_argument("--log-queue", type=int, default=LOG_QUEUE_LINES,
+                        help="Linhas aguardando a escrita do log antes de descartar")
+    parser.add_argument("--heartbeat", type=float, default=HEARTBEAT_INTERVAL,
+                        help="Segundos sem receber nada antes de mandar ping (0 = sem heartbeat)")
+    parser.add_argument("--heartbeat-timeout", type=float, default=HEARTBEAT_TIMEOUT,
+                        help="Segundos sem receber nada ate encerrar a conexao")
+    parser.add_argument("--name-timeout", type=float, default=NAME_TIMEOUT,
+                        help="Segundos para registrar o nome (0 = sem limite)")
+    parser.add_argument("--session-grace", type=float, default=SESSION_GRACE,
+                        help="Segundos que uma sessao desconectada espera a reconexao (0 = sem sessoes; desligado com --workers)")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="Conexoes simultaneas por processo (0 = sem limite)")
+    parser.add_argument("--msg-rate", type=float, default=RATE_LIMITS["*"][0],
+                        help="Mensagens/s por conexao, somando todos os tipos (0 = sem limites de mensagens)")
+    parser.add_argument("--file-rate-mb", type=float, default=FILE_RATE_BYTES / 1024 / 1024,
+                        help="MB/s de arquivo recebidos por conexao (0 = sem limite)")
+    args = parser.parse_args()
+    if args.peer and args.federation_port is None:
+        parser.error("--peer exige --federation-port")
+    if args.federation_port is not None and args.workers > 1:
+        parser.error("federação exige --workers 1")
+    if args.federation_port is not None and not args.federation_secret and not args.federation_host.startswith("127."):
+        parser.error("--federation-host fora desta máquina exige --federation-secret (ou CHAT_FEDERATION_SECRET)")
+    try:
+        args.peer = [(host, int(port)) for host, port in (peer.rsplit(":", 1) for peer in args.peer)]
+    except ValueError:
+        parser.error("--peer deve ser HOST:PORTA")
+    return args
 
 if __name__ == "__main__":
+    args = parse_args()
+    logger.configure(LEVELS[args.log_level], args.log_queue, args.log_sample, args.log_format)
+    file_store = FileStore(args.file_store)
+    global_log = private_log = None
+    if args.log_dir:
+        # Historico sobrevive ao reinicio: as mensagens recentes voltam do log
+        started = time.perf_counter()
+        global_log = MessageLog(os.path.join(args.log_dir, "global"), args.fsync)
+        private_log = MessageLog(os.path.join(args.log_dir, "private"), args.fsync)
+    search_index = SearchIndex(args.search_messages)
+    global_messages = GlobalHistory(args.history_messages, int(args.history_mb * 1024 * 1024),
+                                    args.history_spill or None, file_store, global_log, search_index)
+    private_messages = PrivateHistory(private_log, args.history_messages, search_index, PRIVATE_HISTORY_MESSAGES,
+                                      PRIVATE_HISTORY_BYTES, PRIVATE_CONVERSATION_MESSAGES)
+    if args.log_dir:
+        logger.info("Histórico", f"{len(global_messages)} mensagens globais e {len(private_messages)} privadas "
+                    f"recarregadas ({search_index.stats()['messages']} no índice de busca) de {args.log_dir} "
+                    f"em {(time.perf_counter() - started) * 1000:.1f} ms (fsync: {args.fsync})")
+    OUTBOUND_MAX_ITEMS = args.queue_items
+    OUTBOUND_MAX_BYTES = int(args.queue_mb * 1024 * 1024)
+    OUTBOUND_POLICY = args.overflow_policy
+    METRICS_PORT = args.metrics_port
+    admission.max_connections = args.max_connections
+    if args.msg_rate > 0:
+        RATE_LIMITS["*"] = (args.msg_rate, 2 * args.msg_rate)
+    else:
+        RATE_LIMITS = {}
+    FILE_RATE_BYTES = int(args.file_rate_mb * 1024 * 1024) or None
+    HEARTBEAT_INTERVAL = args.heartbeat
+    HEARTBEAT_TIMEOUT = max(args.heartbeat_timeout, args.heartbeat)
+    NAME_TIMEOUT = args.name_timeout
+    SESSION_GRACE = args.session_grace if args.workers == 1 else 0 # O diario e as sessoes sao de um processo
+    sessions.grace = SESSION_GRACE
+    signal.signal(signal.SIGTERM, stop_on_sigterm)
+    if args.federation_port is not None:
+        federation = Federation(args.node or f"{socket.gethostname()}:{args.port}", args.federation_port,
+                                args.peer, file_store, handle_federation_event, federation_users,
+                                args.federation_host, args.federation_secret)
     try:
-        start()
+        if args.workers > 1:
+            for log in (global_log, private_log):
+                if log is not None:
+                    log.close() # Reaberto no worker que grava (ver run_worker)
+            start_workers(args.workers, args.mode, args.port, args.log_dir, args.fsync)
+        else:
+            start(args.mode, args.port)
     except KeyboardInterrupt:
-        print("\n[Servidor] Servidor encerrado pelo usuário.")
+        logger.info("Servidor", "Servidor encerrado pelo usuário.")
     finally:
         try:
             server.close()
         except:
-            pass
\ No newline at end of file
+            pass
+        for log in (global_log, private_log):
+            if log is not None:
+                log.close() # Grava o que ainda nao passou pelo fsync
@@ -0,0 +1,151 @@
+#sessions.py
+
+import time
+import secrets
+import itertools
+import threading
+from collections import deque, OrderedDict
+
+class ReplayJournal:
+    """
+    Diario das mensagens recentes entregues por este servidor, para reenviar
+    a quem reconecta so o que perdeu
+
+    Funcionalidades:
+        - add(): numera a mensagem com um seq crescente (unico no servidor)
+          e guarda a mensagem ja codificada, com quem deve recebe-la:
+          None = todos, "#sala" = membros da sala, nome = mensagem privada
+        - since(seq, nome, salas): mensagens depois de `seq` que esse usuario
+          teria recebido (sem as que ele mesmo mandou); None se o diario ja
+          descartou alguma delas (quem reconecta recebe o historico completo)
+        - Limitado por quantidade e por bytes: sai sempre a mais antiga
+    O diario guarda copias sem as versoes ja montadas da mensagem (quadro,
+    comprimidas, envelope), que a entrega ao vivo manteria vivas: o limite
+    de bytes conta o que fica de fato em memoria, e a reconexao monta de novo
+    so as versoes de que precisa.
+    """
+    def __init__(self, max_messages=10000, max_bytes=16 * 1024 * 1024):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self._entries = deque() # (seq, remetente, publico, EncodedMessage sem cache, bytes)
+        self._bytes = 0
+        self._seq = itertools.count(1)
+        self.last_seq = 0
+        self.evicted_seq = 0 # Maior seq ja descartado
+        self._lock = threading.Lock()
+
+    def add(self, encoded_factory, sender, audience):
+        """
+        encoded_factory(seq) -> EncodedMessage ja numerada
+        Numerar e guardar acontecem juntos (lock): o diario fica em ordem de seq
+        Retorna a mensagem completa, para a entrega ao vivo
+        """
+        with self._lock:
+            seq = next(self._seq)
+            encoded = encoded_factory(seq)
+            stored = encoded.bare()
+            size = len(stored.payload) + (len(stored.chat[2]) if stored.chat else 0)
+            self._entries.append((seq, sender, audience, stored, size))
+            self._bytes += size
+            self.last_seq = seq
+            while self._entries and (len(self._entries) > self.max_messages or self._bytes > self.max_bytes):
+                old_seq, _, _, _, old_size = self._entries.popleft()
+                self._bytes -= old_size
+                self.evicted_seq = old_seq
+            return encoded
+
+    def since(self, seq, name, rooms):
+        with self._lock:
+            if seq < self.evicted_seq:
+                return None
+            missed = []
+            for entry_seq, sender, audience, stored, _ in reversed(self._entries):
+                if entry_seq <= seq:
+                    break
+                if sender != name and (audience is None or audience == name or audience in rooms):
+                    missed.append(stored.bare()) # Versoes montadas na reconexao nao ficam no diario
+        missed.reverse()
+        return missed
+
+    def stats(self):
+        with self._lock:
+            return {"messages": len(self._entries), "bytes": self._bytes,
+                    "last_seq": self.last_seq, "evicted_seq": self.evicted_seq}
+
+class SessionRegistry:
+    """
+    Sessoes retomaveis: um token por usuario registrado
+
+    Funcionalidades:
+        - create(nome): token aleatorio (nao adivinhavel) para a conexao
+        - detach(sessao, salas): a conexao caiu; a sessao espera `grace`
+          segundos por uma reconexao, guardando as salas em que estava
+        - resume(token): a sessao, se ainda valida (None se expirou ou nao existe)
+        - waiting(nome): ha uma sessao desse usuario esperando reconexao
+          (mensagens privadas para ele vao para o diario em vez de falhar)
+    Sessoes desconectadas expiram na ordem em que cairam: a limpeza tira do
+    inicio da fila, sem varrer todas.
+    """
+    def __init__(self, grace=120):
+        self.grace = grace
+        self._sessions = {}          # token -> sessao
+        self._detached = OrderedDict() # token -> prazo, na ordem em que cairam
+        self._waiting = {}           # nome -> token da sessao desconectada
+        self._lock = threading.Lock()
+
+    def create(self, name):
+        token = secrets.token_urlsafe(18)
+        with self._lock:
+            self._expire()
+            self._sessions[token] = {"token": token, "name": name, "rooms": set()}
+            return self._sessions[token]
+
+    def detach(self, session, rooms):
+        with self._lock:
+            self._expire()
+            if self._sessions.get(session["token"]) is not session:
+                return
+            session["rooms"] = set(rooms)
+            self._detached[session["token"]] = time.monotonic() + self.grace
+            self._detached.move_to_end(session["token"])
+            self._waiting[session["name"]] = session["token"]
+
+    def resume(self, token):
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(token) if isinstance(token, str) else None
+            if session is not None and self._detached.pop(token, None) is not None:
+                if self._waiting.get(session["name"]) == token:
+                    del self._waiting[session["name"]]
+            return session
+
+    def waiting(self, name):
+        with self._lock:
+            self._expire()
+            return name in self._waiting
+
+    def discard(self, session):
+        """
+        Encerra a sessao (o nome foi liberado para outro usuario)
+        """
+        with self._lock:
+            self._sessions.pop(session["token"], None)
+            self._detached.pop(session["token"], None)
+            if self._waiting.get(session["name"]) == session["token"]:
+                del self._waiting[session["name"]]
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._detached:
+            token, deadline = next(iter(self._detached.items()))
+            if deadline > now:
+                break
+            del self._detached[token]
+            session = self._sessions.pop(token)
+            if self._waiting.get(session["name"]) == token:
+                del self._waiting[session["name"]]
+
+    def stats(self):
+        with self._lock:
+            self._expire()
+            return {"sessions": len(self._sessions), "detached": len(self._detached)}
@@ -0,0 +1,68 @@
+#timerwheel.py
+
+import threading
+
+class TimerWheel:
+    """
+    Roda de temporizadores (hashed timing wheel) para muitos prazos com
+    resolucao grosseira (ex.: heartbeats de dezenas de milhares de conexoes)
+
+    Funcionalidades:
+        - schedule(chave, prazo, item): O(1); reagendar a mesma chave
+          substitui o prazo anterior
+        - cancel(chave): O(1)
+        - advance(agora): devolve os itens vencidos, visitando so os slots
+          dos ticks que passaram (nao percorre todos os prazos)
+        - Prazos alem de uma volta da roda (tick * slots) ficam no slot e sao
+          ignorados ate a volta certa
+
+    A resolucao e de um tick: um item pode vencer ate `tick` segundos depois
+    do prazo, nunca antes. O lock deixa agendar de varias threads (modo thread).
+    """
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self._slots = [{} for _ in range(slots)] # chave -> (tick do prazo, item)
+        self._where = {}     # chave -> indice do slot
+        self._current = None # Ultimo tick processado
+        self._lock = threading.Lock()
+
+    def schedule(self, key, deadline, item=None):
+        with self._lock:
+            target = int(deadline / self.tick) + 1 # Nunca vence antes do prazo
+            if self._current is not None and target <= self._current:
+                target = self._current + 1
+            old = self._where.get(key)
+            if old is not None:
+                del self._slots[old][key]
+            index = target % len(self._slots)
+            self._slots[index][key] = (target, item)
+            self._where[key] = index
+
+    def cancel(self, key):
+        with self._lock:
+            index = self._where.pop(key, None)
+            if index is not None:
+                del self._slots[index][key]
+
+    def advance(self, now):
+        """
+        Retorna [(chave, item)] com prazo vencido ate `now` (tirados da roda)
+        """
+        expired = []
+        with self._lock:
+            now_tick = int(now / self.tick)
+            if self._current is None:
+                self._current = now_tick - 1
+            # Mais de uma volta sem avancar: basta visitar cada slot uma vez
+            first = max(self._current + 1, now_tick - len(self._slots) + 1)
+            for tick in range(first, now_tick + 1):
+                slot = self._slots[tick % len(self._slots)]
+                due = [key for key, (target, _) in slot.items() if target <= now_tick]
+                for key in due:
+                    expired.append((key, slot.pop(key)[1]))
+                    del self._where[key]
+            self._current = max(self._current, now_tick)
+        return expired
+
+    def __len__(self):
+        return len(self._where)